@@ -1,17 +1,45 @@
-import psycopg2
-
 from psycopg2 import sql
 from psycopg2.extras import DictCursor
 from src.galaxy import get_db_connection_params
+from src.galaxy.app import connect_for_request
+from src.galaxy.country_stats import CountryStatsIndex, create_country_names_query, create_country_stats_query
 from . import ChangesetResult, FilterParams
 from .utils import geom_filter_subquery
-from fastapi import APIRouter
+from ..utils import run_cancellable
+from fastapi import APIRouter, Request
 
 router = APIRouter(prefix="/changesets")
 
 
-@router.post("/", response_model=ChangesetResult)
-def get_changesets(params: FilterParams):
+def fetch_changesets(query, db_params=None):
+    db_params = db_params or get_db_connection_params()
+    with connect_for_request(db_params) as conn:
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            cur.execute(query)
+            return cur.fetchall()
+
+
+def fetch_country_stats(params, db_params=None):
+    """Returns /changesets result of an iso3 filter from the country aggregates, None when the code matches no priority country"""
+    db_params = db_params or get_db_connection_params()
+    with connect_for_request(db_params) as conn:
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            cur.execute(create_country_names_query(params.value, cur))
+            names = [row["name"] for row in cur.fetchall()]
+            if not names:
+                return None
+            cur.execute(create_country_stats_query(
+                names, params.start_datetime, params.end_datetime, params.hashtag, cur))
+            rows = cur.fetchall()
+    if not rows:
+        return ChangesetResult(name=names[0], total_changesets=0, contributors=0,
+                               added_highway=0, modified_highway=0, deleted_highway=0,
+                               added_highway_km=0, modified_highway_km=0, deleted_highway_km=0)
+    return ChangesetResult(**dict(rows[0]))
+
+
+def create_changesets_query(params):
+    """/changesets query reading changesets of the filter directly"""
     geom_filter_sq = geom_filter_subquery(params.dict())
 
     t3 = """
@@ -60,7 +88,7 @@ def get_changesets(params: FilterParams):
         t4 AS (
         SELECT 
             name,
-            count(id) AS total_changesets,
+            count(DISTINCT id) AS total_changesets,
             count(DISTINCT user_id) AS contributors
         from t3 GROUP BY name
         )
@@ -99,12 +127,18 @@ def get_changesets(params: FilterParams):
         ) AS deleted_filter_highway_km
         ON deleted_filter_highway_km.name = t4.name;
         """
+    return query
 
-    db_params = get_db_connection_params()
-    with psycopg2.connect(**db_params) as conn:
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute(query)
-            result = cur.fetchall()
+
+@router.post("/", response_model=ChangesetResult)
+async def get_changesets(params: FilterParams, request: Request):
+    if CountryStatsIndex.enabled() and params.type.value == "iso3":
+        result = await run_cancellable(request, "changesets", fetch_country_stats, params)
+        if result is not None:
+            return result
+
+    query = create_changesets_query(params)
+    result = await run_cancellable(request, "changesets", fetch_changesets, query)
 
     result_dto = ChangesetResult(**dict(result[0]))
 
@@ -1,8 +1,12 @@
 import psycopg2
 from psycopg2.extras import DictCursor
-from fastapi import APIRouter
+from typing import List, Optional
+
+from fastapi import APIRouter, HTTPException, Query
 from geojson_pydantic import FeatureCollection
 from src.galaxy import get_db_connection_params
+from src.galaxy.countries import CountryIndex
+from src.galaxy.validation.models import Country
 
 router = APIRouter(prefix="/countries")
 @router.get("/", response_model=FeatureCollection)
@@ -34,3 +38,21 @@ def get_countries():
             result = cur.fetchall()[0][0]
 
     return FeatureCollection(**result)
+
+
+@router.get("/lookup", response_model=List[Country])
+def lookup_countries(lon: Optional[float] = Query(None, ge=-180, le=180),
+                     lat: Optional[float] = Query(None, ge=-90, le=90),
+                     bbox: Optional[str] = Query(None, description="minx,miny,maxx,maxy")):
+    """Countries containing the point lon lat, or intersecting bbox, answered from the in process boundary index"""
+    if bbox is not None:
+        try:
+            minx, miny, maxx, maxy = [float(v) for v in bbox.split(",")]
+        except ValueError:
+            raise HTTPException(status_code=422, detail="bbox must be minx,miny,maxx,maxy")
+        if minx > maxx or miny > maxy:
+            raise HTTPException(status_code=422, detail="bbox minimums must not exceed maximums")
+        return CountryIndex.load().lookup_bbox(minx, miny, maxx, maxy)
+    if lon is None or lat is None:
+        raise HTTPException(status_code=422, detail="Either lon and lat or bbox is required")
+    return CountryIndex.load().lookup_point(lon, lat)
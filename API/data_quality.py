@@ -19,19 +19,52 @@
 
 from csv import DictWriter
 from fastapi import APIRouter
-from src.galaxy.validation.models import DataQuality_TM_RequestParams,DataQuality_username_RequestParams,DataQualityHashtagParams,OutputType
-from src.galaxy.app import DataQuality, DataQualityHashtags
+from fastapi import HTTPException, Query, Response
+from psycopg2 import Error as Psycopg2Error
+from psycopg2.errors import QueryCanceled
+from pydantic import ValidationError
+from typing import List, Optional
+from src.galaxy.validation.models import DataQuality_TM_RequestParams,DataQuality_username_RequestParams,DataQualityHashtagParams,OutputType,DataQualityTileParams,IssueType
+from src.galaxy.app import DataQuality, DataQualityHashtags, DataQualityTiles
 from fastapi.responses import StreamingResponse
 import io
 from datetime import datetime
 
 router = APIRouter(prefix="/data-quality")
 
+COLUMNAR_MEDIA_TYPES = {
+    OutputType.ARROW.value: "application/vnd.apache.arrow.stream",
+    OutputType.PARQUET.value: "application/vnd.apache.parquet",
+}
+
+
+def geojson_seq_response(chunks):
+    """Streams newline delimited geojson features, so clients can render while the report is being read"""
+    return StreamingResponse(chunks, media_type="application/x-ndjson")
+
+
+def columnar_response(chunks, output_type, exportname):
+    """Streams Arrow IPC / Parquet chunks as file download"""
+    response = StreamingResponse(chunks,
+                                 media_type=COLUMNAR_MEDIA_TYPES[output_type])
+    response.headers["Content-Disposition"] = f"attachment; filename={exportname}.{output_type}"
+    return response
+
 
 @router.post("/hashtag-reports")
 def data_quality_hashtag_reports(params: DataQualityHashtagParams):
     data_quality = DataQualityHashtags(params)
 
+    if params.output_type == OutputType.GRID.value:
+        return data_quality.get_report_as_grid()
+    if params.output_type == OutputType.NDJSON.value:
+        return geojson_seq_response(data_quality.get_report_as_geojson_seq())
+    if params.output_type in COLUMNAR_MEDIA_TYPES:
+        return columnar_response(
+            data_quality.get_report_as_columnar(params.output_type),
+            params.output_type,
+            f"DataQuality_Hashtags_{datetime.now().isoformat()}")
+
     results = data_quality.get_report()
 
     if params.output_type == OutputType.GEOJSON.value:
@@ -53,6 +86,14 @@ def data_quality_reports(params: DataQuality_TM_RequestParams):
 
     if params.output_type == OutputType.GEOJSON.value:
         return data_quality.get_report()
+    if params.output_type == OutputType.GRID.value:
+        return data_quality.get_report_as_grid()
+    if params.output_type == OutputType.NDJSON.value:
+        return geojson_seq_response(data_quality.get_report_as_geojson_seq())
+    if params.output_type in COLUMNAR_MEDIA_TYPES:
+        return columnar_response(
+            data_quality.get_report_as_columnar(params.output_type),
+            params.output_type, "TM_DataQuality_"+str(datetime.now()))
 
     stream = io.StringIO()
     exportname="TM_DataQuality_"+str(datetime.now())
@@ -70,6 +111,14 @@ def data_quality_reports(params: DataQuality_username_RequestParams):
     
     if params.output_type == OutputType.GEOJSON.value:
         return data_quality.get_report()
+    if params.output_type == OutputType.GRID.value:
+        return data_quality.get_report_as_grid()
+    if params.output_type == OutputType.NDJSON.value:
+        return geojson_seq_response(data_quality.get_report_as_geojson_seq())
+    if params.output_type in COLUMNAR_MEDIA_TYPES:
+        return columnar_response(
+            data_quality.get_report_as_columnar(params.output_type),
+            params.output_type, "Username_DataQuality_"+str(datetime.now()))
     stream = io.StringIO()
    
     exportname="Username_DataQuality_"+str(datetime.now())
@@ -80,3 +129,28 @@ def data_quality_reports(params: DataQuality_username_RequestParams):
     response.headers["Content-Disposition"] = "attachment; filename="+exportname+".csv"
     return response
 
+
+@router.get("/tiles/{z}/{x}/{y}.mvt")
+def data_quality_tiles(z: int, x: int, y: int,
+                       from_timestamp: datetime = Query(..., alias="fromTimestamp"),
+                       to_timestamp: datetime = Query(..., alias="toTimestamp"),
+                       issue_type: List[IssueType] = Query(..., alias="issueType"),
+                       hashtags: Optional[List[str]] = Query(None)):
+    try:
+        params = DataQualityTileParams(from_timestamp=from_timestamp,
+                                       to_timestamp=to_timestamp,
+                                       issue_type=issue_type,
+                                       hashtags=hashtags)
+    except ValidationError as err:
+        raise HTTPException(status_code=422, detail=err.errors())
+
+    try:
+        tile = DataQualityTiles(params).get_tile(z, x, y)
+    except ValueError as err:
+        raise HTTPException(status_code=400, detail=str(err))
+    except QueryCanceled:
+        raise HTTPException(status_code=504, detail="Tile exceeded its statement timeout")
+    except Psycopg2Error:
+        raise HTTPException(status_code=503, detail="Tile could not be read, try again later")
+
+    return Response(content=tile, media_type="application/vnd.mapbox-vector-tile")
@@ -0,0 +1,91 @@
+# Copyright (C) 2021 Humanitarian OpenStreetmap Team
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Humanitarian OpenStreetmap Team
+# 1100 13th Street NW Suite 800 Washington, D.C. 20005
+# <info@hotosm.org>
+
+"""[Router submitting long running reports as background jobs, polled for status and downloaded once finished]
+"""
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import FileResponse, JSONResponse
+
+from src.galaxy.jobs import FINISHED, JobQueue
+from src.galaxy.validation.models import (DataQuality_TM_RequestParams,
+                                          DataQuality_username_RequestParams,
+                                          DataQualityHashtagParams,
+                                          MapathonRequestParams)
+from .auth import login_required
+
+router = APIRouter(prefix="/jobs")
+
+job_queue = JobQueue.from_config()
+
+
+def job_response(job, status_code=200):
+    content = {k: v for k, v in job.items() if k not in ("params", "owner")}
+    if job["status"] == FINISHED:
+        content["downloadUrl"] = f"{router.prefix}/{job['id']}/download"
+    return JSONResponse(content=content, status_code=status_code,
+                        headers={"Location": f"{router.prefix}/{job['id']}"})
+
+
+@router.post("/data-quality/project-reports", status_code=202)
+def submit_data_quality_project_report(params: DataQuality_TM_RequestParams):
+    return job_response(job_queue.submit("data-quality-project", params), 202)
+
+
+@router.post("/data-quality/user-reports", status_code=202)
+def submit_data_quality_user_report(params: DataQuality_username_RequestParams):
+    return job_response(job_queue.submit("data-quality-user", params), 202)
+
+
+@router.post("/data-quality/hashtag-reports", status_code=202)
+def submit_data_quality_hashtag_report(params: DataQualityHashtagParams):
+    return job_response(job_queue.submit("data-quality-hashtag", params), 202)
+
+
+@router.post("/mapathon/detail", status_code=202)
+def submit_mapathon_detailed_report(params: MapathonRequestParams,
+                                    user_data=Depends(login_required)):
+    return job_response(job_queue.submit("mapathon-detail", params, owner=user_data["id"]), 202)
+
+
+@router.post("/mapathon/summary", status_code=202)
+def submit_mapathon_summary(params: MapathonRequestParams):
+    return job_response(job_queue.submit("mapathon-summary", params), 202)
+
+
+def get_job(job_id, user_data):
+    """Job status readable by user, jobs owned by another user are reported missing"""
+    job = job_queue.status(job_id)
+    if job is None or job.get("owner") not in (None, user_data["id"]):
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@router.get("/{job_id}")
+def get_job_status(job_id: str, user_data=Depends(login_required)):
+    return job_response(get_job(job_id, user_data))
+
+
+@router.get("/{job_id}/download")
+def download_job_result(job_id: str, user_data=Depends(login_required)):
+    job = get_job(job_id, user_data)
+    path = job_queue.result_path(job_id)
+    if path is None:
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}")
+    return FileResponse(path, media_type=job["mediaType"],
+                        filename=f"{job['kind']}_{job['id']}.{job['filename'].rsplit('.', 1)[1]}")
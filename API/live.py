@@ -0,0 +1,187 @@
+# Copyright (C) 2021 Humanitarian OpenStreetmap Team
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Humanitarian OpenStreetmap Team
+# 1100 13th Street NW Suite 800 Washington, D.C. 20005
+# <info@hotosm.org>
+
+"""[Live mapathon feeds, one summary computation per running mapathon pushed to all of its subscribers]
+"""
+import asyncio
+import json
+import logging
+from datetime import datetime, timedelta, timezone
+
+from starlette.concurrency import run_in_threadpool
+
+from src.galaxy import config
+from src.galaxy.app import LiveMapathon
+from src.galaxy.cache import cache_key
+from src.galaxy.validation.models import MapathonRequestParams
+
+# seconds between two computations of a feed
+LIVE_INTERVAL = config.getint("LIVE_MAPATHON", "interval", fallback=30)
+# seconds after which an idle subscriber gets a keep alive comment, so proxies do not drop it
+KEEP_ALIVE_INTERVAL = 15
+# events queued for a subscriber, a slower one is sent a fresh snapshot instead
+SUBSCRIBER_QUEUE_SIZE = 16
+
+MAX_WINDOW = timedelta(hours=24)
+
+logger = logging.getLogger(__name__)
+
+
+def naive_utc(value):
+    """Timestamps are compared as naive UTC, as changesets store them"""
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def feed_params(params):
+    return dict(params, from_timestamp=naive_utc(params["from_timestamp"]),
+                to_timestamp=naive_utc(params["to_timestamp"]))
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class MapathonFeed:
+    """Summary of one mapathon computed every interval seconds, while it has subscribers, with the incremental LiveMapathon aggregate
+
+    Subscribers get a snapshot of the current summary when they join, then a delta event whenever feature counts or contributors changed: the features whose count changed with their new count and change, and the contributors total
+    """
+
+    def __init__(self, key, params, source, interval=LIVE_INTERVAL):
+        self.key = key
+        self.params = feed_params(params)
+        self.source = source
+        self.interval = interval
+        self.subscribers = set()
+        # (feature, action) : count
+        self.counts = {}
+        self.total_contributors = 0
+        self.computed = False
+        self.task = None
+
+    def window_params(self):
+        """Mapathon parameters up to now, None while the mapathon has not started"""
+        from_timestamp = self.params["from_timestamp"]
+        to_timestamp = min(datetime.utcnow(), from_timestamp + MAX_WINDOW)
+        if self.params["to_timestamp"] is not None:
+            to_timestamp = min(to_timestamp, self.params["to_timestamp"])
+        if to_timestamp < from_timestamp:
+            return None
+        return MapathonRequestParams(**dict(self.params, to_timestamp=to_timestamp))
+
+    def snapshot(self):
+        return sse_event("snapshot", {
+            "totalContributors": self.total_contributors,
+            "mappedFeatures": [{"feature": f, "action": a, "count": c}
+                               for (f, a), c in sorted(self.counts.items(), key=lambda i: -i[1])],
+        })
+
+    def update(self, summary):
+        """Stores summary and returns event to publish, a snapshot the first time then deltas, None when nothing changed"""
+        counts = {(m.feature, m.action): m.count for m in summary.mapped_features}
+        changed = [{"feature": f, "action": a, "count": counts.get((f, a), 0),
+                    "change": counts.get((f, a), 0) - self.counts.get((f, a), 0)}
+                   for (f, a) in set(counts) | set(self.counts)
+                   if counts.get((f, a), 0) != self.counts.get((f, a), 0)]
+        contributors_change = summary.total_contributors - self.total_contributors
+        first = not self.computed
+        self.counts = counts
+        self.total_contributors = summary.total_contributors
+        self.computed = True
+        if first:
+            return self.snapshot()
+        if len(changed) == 0 and contributors_change == 0:
+            return None
+        return sse_event("delta", {"totalContributors": summary.total_contributors,
+                                   "contributorsChange": contributors_change,
+                                   "mappedFeatures": changed})
+
+    def publish(self, event):
+        for queue in self.subscribers:
+            if queue.full():
+                # subscriber fell behind, drop what it has not read and resynchronise it
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(self.snapshot())
+            else:
+                queue.put_nowait(event)
+
+    def compute(self):
+        params = self.window_params()
+        if params is None:
+            return None
+        return LiveMapathon(params, self.source).get_summary()
+
+    async def run(self):
+        try:
+            while self.subscribers:
+                try:
+                    summary = await run_in_threadpool(self.compute)
+                except Exception:
+                    logger.exception("Live mapathon %s update failed", self.key)
+                    summary = None
+                if summary is not None:
+                    event = self.update(summary)
+                    if event is not None:
+                        self.publish(event)
+                await asyncio.sleep(self.interval)
+        finally:
+            feeds.pop(self.key, None)
+
+    def subscribe(self):
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        if self.computed:
+            queue.put_nowait(self.snapshot())
+        self.subscribers.add(queue)
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+
+
+# mapathon key : running feed, a feed removes itself once its last subscriber left
+feeds = {}
+
+
+def get_feed(params, source):
+    # mapathons given in any time zone share one feed
+    params = feed_params(params)
+    key = cache_key("mapathon-feed", source, params)
+    feed = feeds.get(key)
+    if feed is None:
+        feed = MapathonFeed(key, params, source)
+        feeds[key] = feed
+    return feed
+
+
+async def stream_feed(feed):
+    """Yields server sent events of feed until the client goes away"""
+    queue = feed.subscribe()
+    try:
+        while True:
+            try:
+                yield await asyncio.wait_for(queue.get(), KEEP_ALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+    finally:
+        feed.unsubscribe(queue)
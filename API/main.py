@@ -17,7 +17,10 @@
 # 1100 13th Street NW Suite 800 Washington, D.C. 20005
 # <info@hotosm.org>
 
+import asyncio
+
 from fastapi import FastAPI
+from starlette.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 
 from .countries.routers import router as countries_router
@@ -28,12 +31,60 @@ from .mapathon import router as mapathon_router
 from .osm_users import router as osm_users_router
 from .data_quality import router as data_quality_router
 from .trainings import router as training_router
+from .metrics import router as metrics_router
+from .jobs import job_queue, router as jobs_router
+from .middleware import (AdmissionControlMiddleware, CompressionMiddleware,
+                         EndpointClass, ReportCacheMiddleware)
+from src.galaxy import config
+from src.galaxy.app import Training
+from src.galaxy.countries import CountryIndex
+from src.galaxy.hashtag_index import ChangesetHashtagIndex
+from src.galaxy.country_stats import CountryStatsIndex
+from src.galaxy.user_names import OsmUsersIndex
+from src.galaxy.schema import check_indexes
+
+
+
+
+def admission_classes():
+    """Endpoint classes listed in classes of ADMISSION config section"""
+    classes = []
+    for name in config.get("ADMISSION", "classes", fallback="").split(","):
+        name = name.strip()
+        if not name:
+            continue
+        classes.append(EndpointClass(
+            name,
+            paths=[p.strip() for p in config.get("ADMISSION", f"{name}_paths").split(",") if p.strip()],
+            limit=config.getint("ADMISSION", f"{name}_limit"),
+            queue_size=config.getint("ADMISSION", f"{name}_queue_size"),
+            queue_timeout=config.getfloat("ADMISSION", f"{name}_queue_timeout", fallback=30),
+        ))
+    return classes
 
 
 app = FastAPI()
+app.state.admission_classes = admission_classes()
 
 origins = ["*"]
 
+# middlewares added last run first, CORS stays outermost so cached responses get CORS headers too
+# admission control is innermost, cached responses do not take a slot
+app.add_middleware(AdmissionControlMiddleware, classes=app.state.admission_classes)
+app.add_middleware(
+    ReportCacheMiddleware,
+    paths=("/countries", "/data-quality", "/mapathon/detail"),
+    exclude_paths=("/data-quality/tiles",),
+    ttl=config.getint("CACHE", "report_ttl", fallback=60),
+    maxsize=config.getint("CACHE", "report_maxsize", fallback=256),
+    max_body_size=config.getint("CACHE", "report_max_body_size", fallback=10485760),
+)
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=config.getint("COMPRESSION", "minimum_size", fallback=1024),
+    gzip_level=config.getint("COMPRESSION", "gzip_level", fallback=6),
+    brotli_quality=config.getint("COMPRESSION", "brotli_quality", fallback=4),
+)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -50,4 +101,92 @@ app.include_router(data_router)
 app.include_router(osm_users_router)
 app.include_router(data_quality_router)
 app.include_router(training_router)
+app.include_router(metrics_router)
+app.include_router(jobs_router)
+
+
+@app.on_event("startup")
+async def check_required_indexes():
+    # raises when check of SCHEMA section is fail, so the server does not start without them
+    await run_in_threadpool(check_indexes)
+
+
+@app.on_event("startup")
+def load_training_catalogue():
+    try:
+        Training.catalogue.refresh()
+    except Exception as err:
+        # loaded on first training request instead
+        print(f"Training catalogue could not be loaded at startup: {err}")
+
+
+@app.on_event("startup")
+async def load_country_index():
+    try:
+        await run_in_threadpool(CountryIndex.load)
+    except Exception as err:
+        # loaded on first lookup instead
+        print(f"Country index could not be loaded at startup: {err}")
+
+
+async def update_hashtag_index(interval):
+    """Keeps changeset_hashtag up to date, workers skip the round while another one holds the update lock"""
+    hashtag_index = ChangesetHashtagIndex.from_config()
+    await run_in_threadpool(hashtag_index.create)
+    while True:
+        try:
+            await run_in_threadpool(hashtag_index.update)
+        except Exception as err:
+            print(f"Changeset hashtag index update failed: {err}")
+        await asyncio.sleep(interval)
+
+
+@app.on_event("startup")
+async def start_hashtag_index_updates():
+    if ChangesetHashtagIndex.enabled():
+        asyncio.ensure_future(update_hashtag_index(
+            config.getint("HASHTAG_INDEX", "update_interval", fallback=60)))
+
+
+async def update_osm_users(interval):
+    """Keeps osm_user_days up to date, workers skip the round while another one holds the update lock"""
+    osm_users = OsmUsersIndex.from_config()
+    await run_in_threadpool(osm_users.create)
+    while True:
+        try:
+            await run_in_threadpool(osm_users.update)
+        except Exception as err:
+            print(f"osm_users update failed: {err}")
+        await asyncio.sleep(interval)
+
+
+@app.on_event("startup")
+async def start_osm_users_updates():
+    if OsmUsersIndex.enabled():
+        asyncio.ensure_future(update_osm_users(
+            config.getint("OSM_USERS", "update_interval", fallback=60)))
+
+
+async def update_country_stats(interval):
+    """Keeps changeset_country and the daily country tables up to date, workers skip the round while another one holds the update lock"""
+    country_stats = CountryStatsIndex.from_config()
+    await run_in_threadpool(country_stats.create)
+    while True:
+        try:
+            await run_in_threadpool(country_stats.update)
+        except Exception as err:
+            print(f"Country stats update failed: {err}")
+        await asyncio.sleep(interval)
+
+
+@app.on_event("startup")
+async def start_country_stats_updates():
+    if CountryStatsIndex.enabled():
+        asyncio.ensure_future(update_country_stats(
+            config.getint("COUNTRY_STATS", "update_interval", fallback=300)))
+
+
+@app.on_event("shutdown")
+def shutdown_job_queue():
+    job_queue.shutdown()
 
@@ -17,33 +17,83 @@
 # 1100 13th Street NW Suite 800 Washington, D.C. 20005
 # <info@hotosm.org>
 
-from fastapi import APIRouter, Depends
-from src.galaxy.app import Mapathon
+from datetime import datetime
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+from src.galaxy.app import LiveMapathon, Mapathon, MultiMapathon
 from src.galaxy.validation.models import (
     MapathonSummary,
     MapathonRequestParams,
     MapathonDetail,
+    MultiMapathonRequestParams,
+    MultiMapathonSummary,
 )
 
 
 from .auth import login_required
+from .utils import report_response, run_cancellable
+from .live import get_feed, stream_feed
 
 router = APIRouter(prefix="/mapathon")
 
 
 @router.post("/detail", response_model=MapathonDetail)
-def get_mapathon_detailed_report(params: MapathonRequestParams,
-                                 user_data=Depends(login_required)):
-    mapathon = Mapathon(params,"insight")
-    return mapathon.get_detailed_report()
+async def get_mapathon_detailed_report(params: MapathonRequestParams, request: Request,
+                                       user_data=Depends(login_required)):
+    def detailed_report():
+        mapathon = Mapathon(params,"insight")
+        return mapathon.get_detailed_report()
+
+    return report_response(await run_cancellable(request, "mapathon_detail", detailed_report))
 
 
 @router.post("/summary", response_model=MapathonSummary)
-def get_mapathon_summary(params: MapathonRequestParams):
-   
-    if params.source == "underpass":
-        mapathon = Mapathon(params,"underpass")
-    else:
-        mapathon = Mapathon(params,"insight")
-    
-    return mapathon.get_summary()
\ No newline at end of file
+async def get_mapathon_summary(params: MapathonRequestParams, request: Request,
+                               live: bool = False):
+    """Summary of mapathon, live=true serves polls of a running event from an incrementally updated aggregate"""
+    def summary():
+        if live:
+            source = "underpass" if params.source == "underpass" else "insight"
+            return LiveMapathon(params, source).get_summary()
+        if params.source == "underpass":
+            mapathon = Mapathon(params,"underpass")
+        else:
+            mapathon = Mapathon(params,"insight")
+        return mapathon.get_summary()
+
+    return report_response(await run_cancellable(request, "mapathon_summary", summary))
+
+
+@router.post("/summary/events", response_model=MultiMapathonSummary)
+async def get_multi_mapathon_summary(params: MultiMapathonRequestParams, request: Request):
+    """Summaries of several mapathons computed in one pass over their changesets, in the order of events"""
+    def summary():
+        source = "underpass" if params.source == "underpass" else "insight"
+        return MultiMapathon(params, source).get_summary()
+
+    return report_response(await run_cancellable(request, "mapathon_summary", summary))
+
+
+@router.get("/live")
+async def get_mapathon_live_feed(from_timestamp: datetime = Query(..., alias="fromTimestamp"),
+                                 to_timestamp: Optional[datetime] = Query(None, alias="toTimestamp"),
+                                 project_ids: List[int] = Query([], alias="projectIds"),
+                                 hashtags: List[str] = Query([]),
+                                 source: Optional[str] = Query(None)):
+    """Server sent events of a running mapathon summary: a snapshot on connect, then deltas of feature counts and contributors. The summary is computed once per mapathon whatever the number of viewers, up to now or toTimestamp"""
+    try:
+        # validates the mapathon definition, the window itself moves with time
+        MapathonRequestParams(from_timestamp=from_timestamp, to_timestamp=from_timestamp,
+                              project_ids=project_ids, hashtags=hashtags, source=source)
+    except ValidationError as err:
+        raise HTTPException(status_code=422, detail=err.errors())
+
+    source = "underpass" if source == "underpass" else "insight"
+    feed = get_feed({"from_timestamp": from_timestamp, "to_timestamp": to_timestamp,
+                     "project_ids": project_ids, "hashtags": hashtags, "source": source},
+                    source)
+    return StreamingResponse(stream_feed(feed), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
@@ -0,0 +1,31 @@
+# Copyright (C) 2021 Humanitarian OpenStreetmap Team
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Humanitarian OpenStreetmap Team
+# 1100 13th Street NW Suite 800 Washington, D.C. 20005
+# <info@hotosm.org>
+
+"""[Router exposing runtime metrics of the API]
+"""
+from fastapi import APIRouter, Request
+
+router = APIRouter(prefix="/metrics")
+
+
+@router.get("/admission")
+def get_admission_metrics(request: Request):
+    """Queue depth, wait times and rejections of every endpoint class, counted by this worker process"""
+    return {endpoint_class.name: endpoint_class.metrics()
+            for endpoint_class in request.app.state.admission_classes}
@@ -0,0 +1,429 @@
+# Copyright (C) 2021 Humanitarian OpenStreetmap Team
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Humanitarian OpenStreetmap Team
+# 1100 13th Street NW Suite 800 Washington, D.C. 20005
+# <info@hotosm.org>
+
+"""[ASGI middlewares for response compression, report caching and admission control]
+"""
+import asyncio
+import json
+import math
+import time
+import zlib
+from collections import deque
+from hashlib import sha1
+
+from starlette.datastructures import Headers, MutableHeaders
+
+from src.galaxy.cache import TTLCache, cache_key
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# already compressed formats are passed through untouched
+INCOMPRESSIBLE_MEDIA_TYPES = ("application/vnd.apache.parquet", "application/zip",
+                              "image/")
+
+
+def add_vary_header(headers, value):
+    vary = headers.get("vary")
+    if vary is None:
+        headers["Vary"] = value
+    elif value.lower() not in [v.strip().lower() for v in vary.split(",")]:
+        headers["Vary"] = f"{vary}, {value}"
+
+
+class GzipCompressor:
+    encoding = "gzip"
+
+    def __init__(self, level):
+        # wbits 16 + MAX_WBITS writes gzip header and trailer
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data, finish):
+        body = self.compressor.compress(data)
+        return body + self.compressor.flush(zlib.Z_FINISH if finish else zlib.Z_SYNC_FLUSH)
+
+
+class BrotliCompressor:
+    encoding = "br"
+
+    def __init__(self, quality):
+        self.compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data, finish):
+        body = self.compressor.process(data)
+        return body + (self.compressor.finish() if finish else self.compressor.flush())
+
+
+class CompressionMiddleware:
+    """Compresses responses with brotli or gzip, whichever the client prefers, when the body is bigger than minimum_size. Streaming responses are compressed chunk by chunk and flushed so clients keep receiving data progressively
+
+    Parameters:
+        minimum_size : bytes below which responses are sent as they are
+        gzip_level : zlib compression level
+        brotli_quality : brotli quality, brotli is only offered when the brotli package is installed
+    """
+
+    def __init__(self, app, minimum_size=1024, gzip_level=6, brotli_quality=4):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    def negotiate(self, accept_encoding):
+        """Returns compressor for the best encoding accepted by client or None"""
+        accepted = {}
+        for item in accept_encoding.split(","):
+            parts = [p.strip() for p in item.split(";")]
+            if not parts[0]:
+                continue
+            quality = 1.0
+            for param in parts[1:]:
+                if param.startswith("q="):
+                    try:
+                        quality = float(param[2:])
+                    except ValueError:
+                        quality = 0.0
+            accepted[parts[0].lower()] = quality
+
+        candidates = []
+        if brotli is not None and accepted.get("br", 0) > 0:
+            candidates.append((accepted["br"], 1, "br"))
+        gzip_quality = accepted.get("gzip", accepted.get("*", 0))
+        if gzip_quality > 0:
+            candidates.append((gzip_quality, 0, "gzip"))
+        if len(candidates) == 0:
+            return None
+        encoding = max(candidates)[2]
+        if encoding == "br":
+            return BrotliCompressor(self.brotli_quality)
+        return GzipCompressor(self.gzip_level)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        compressor = self.negotiate(Headers(scope=scope).get("accept-encoding", ""))
+        if compressor is None:
+            await self.app(scope, receive, send)
+            return
+
+        state = {"start": None, "started": False, "compress": False}
+
+        async def send_compressed(message):
+            if message["type"] == "http.response.start":
+                # headers are sent with the first body chunk, once we know whether body is compressed
+                state["start"] = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if not state["started"]:
+                state["started"] = True
+                start = state["start"]
+                headers = MutableHeaders(raw=start["headers"])
+                media_type = headers.get("content-type", "")
+                state["compress"] = (
+                    "content-encoding" not in headers
+                    and start["status"] not in (204, 304)
+                    and not media_type.startswith(INCOMPRESSIBLE_MEDIA_TYPES)
+                    and (more_body or len(body) >= self.minimum_size))
+                if state["compress"]:
+                    headers["Content-Encoding"] = compressor.encoding
+                    add_vary_header(headers, "Accept-Encoding")
+                    if "content-length" in headers:
+                        del headers["Content-Length"]
+                    if not more_body:
+                        body = compressor.compress(body, finish=True)
+                        headers["Content-Length"] = str(len(body))
+                        await send(start)
+                        await send({"type": "http.response.body", "body": body})
+                        return
+                await send(start)
+
+            if state["compress"]:
+                message = {"type": "http.response.body",
+                           "body": compressor.compress(body, finish=not more_body),
+                           "more_body": more_body}
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
+
+
+class ReportCacheMiddleware:
+    """Caches successful report responses by request and answers repeat requests from the cache
+
+    The cache key is the hash of method, path, query string, request body and access token. Cached responses carry a strong ETag made from that key and the response body, so it is the same on every worker and across refills and only changes with the content. A client sending it back in If-None-Match gets 304, without the report being computed or serialised again when it is cached, and without the body being sent when another worker computed it. Streamed responses, whose first body message announces more body, and responses bigger than max_body_size are passed through without ETag
+
+    Parameters:
+        paths : path prefixes whose responses are cached
+        exclude_paths : path prefixes under paths that are never cached
+        ttl : seconds a cached report is served
+        maxsize : number of cached reports
+        max_body_size : biggest body cached, in bytes
+    """
+
+    def __init__(self, app, paths, exclude_paths=(), ttl=60, maxsize=256, max_body_size=10 * 1024 * 1024):
+        self.app = app
+        self.paths = tuple(paths)
+        self.exclude_paths = tuple(exclude_paths)
+        self.max_body_size = max_body_size
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    @staticmethod
+    def etag_matches(if_none_match, etag):
+        if if_none_match is None:
+            return False
+        tags = [t.strip() for t in if_none_match.split(",")]
+        return "*" in tags or etag in [t[2:] if t.startswith("W/") else t for t in tags]
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] != "http" or scope["method"] not in ("GET", "POST")
+                or not scope["path"].startswith(self.paths)
+                or (self.exclude_paths and scope["path"].startswith(self.exclude_paths))):
+            await self.app(scope, receive, send)
+            return
+
+        # request body is read up front, it is part of the key, then replayed to the app
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] != "http.request":
+                return
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+        request_headers = Headers(scope=scope)
+        key = cache_key(scope["method"], scope["path"], scope.get("query_string", b""),
+                        body, request_headers.get("access-token"))
+
+        cached = self.cache.get(key)
+        if cached is not None:
+            status, headers, cached_body, etag = cached
+            if self.etag_matches(request_headers.get("if-none-match"), etag):
+                await send({"type": "http.response.start", "status": 304,
+                            "headers": [(b"etag", etag.encode("latin-1"))]})
+                await send({"type": "http.response.body", "body": b""})
+                return
+            # inner middlewares edit headers in place, cached list is never handed out
+            await send({"type": "http.response.start", "status": status, "headers": list(headers)})
+            await send({"type": "http.response.body", "body": cached_body})
+            return
+
+        body_sent = False
+
+        async def replay_receive():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        state = {"start": None, "chunks": [], "size": 0, "passthrough": False}
+
+        async def send_caching(message):
+            if state["passthrough"]:
+                await send(message)
+                return
+            if message["type"] == "http.response.start":
+                state["start"] = message
+                headers = Headers(raw=message["headers"])
+                if message["status"] != 200 or "set-cookie" in headers:
+                    state["passthrough"] = True
+                    await send(message)
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            if not state["chunks"] and message.get("more_body", False):
+                # streamed report, holding it back would delay the first bytes until it is complete
+                state["passthrough"] = True
+                await send(state["start"])
+                await send(message)
+                return
+            state["chunks"].append(message.get("body", b""))
+            state["size"] += len(state["chunks"][-1])
+            if state["size"] > self.max_body_size:
+                # too big to keep, flush what was held back and stream the rest
+                state["passthrough"] = True
+                await send(state["start"])
+                for chunk in state["chunks"]:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                await send({"type": "http.response.body", "body": b"",
+                            "more_body": message.get("more_body", False)})
+                return
+            if message.get("more_body", False):
+                return
+
+            response_body = b"".join(state["chunks"])
+            etag = '"%s"' % sha1(key.encode("utf-8") + b":" + response_body).hexdigest()
+            headers = MutableHeaders(raw=list(state["start"]["headers"]))
+            headers["ETag"] = etag
+            headers["Content-Length"] = str(len(response_body))
+            self.cache.set(key, (200, list(headers.raw), response_body, etag))
+            if self.etag_matches(request_headers.get("if-none-match"), etag):
+                await send({"type": "http.response.start", "status": 304,
+                            "headers": [(b"etag", etag.encode("latin-1"))]})
+                await send({"type": "http.response.body", "body": b""})
+                return
+            await send({"type": "http.response.start", "status": 200, "headers": headers.raw})
+            await send({"type": "http.response.body", "body": response_body})
+
+        await self.app(scope, replay_receive, send_caching)
+
+
+class EndpointClass:
+    """Concurrency limit of a group of endpoints with a bounded queue of requests waiting for a slot
+
+    Parameters:
+        name : name the class is reported under in metrics
+        paths : path prefixes belonging to the class
+        limit : requests of the class served at the same time
+        queue_size : requests allowed to wait for a slot, the ones above it are rejected at once
+        queue_timeout : seconds a request waits for a slot before it is rejected
+    """
+
+    def __init__(self, name, paths, limit, queue_size, queue_timeout=30):
+        self.name = name
+        self.paths = tuple(paths)
+        self.limit = limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiters = deque()
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        # moving average of time a request holds its slot, used for Retry-After
+        self.service_time = 1.0
+
+    async def acquire(self):
+        """Waits for a slot and returns seconds spent in queue, raises OverflowError when the queue is full or the wait timed out"""
+        if self.active < self.limit and len(self.waiters) == 0:
+            self.active += 1
+            self.admitted += 1
+            return 0.0
+        if len(self.waiters) >= self.queue_size:
+            self.rejected += 1
+            raise OverflowError(f"{self.name} queue is full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        started_at = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except BaseException as err:
+            if waiter.done() and not waiter.cancelled():
+                # slot was handed over while we were giving up, pass it on
+                self.release()
+            else:
+                waiter.cancel()
+                self.waiters.remove(waiter)
+            if isinstance(err, asyncio.TimeoutError):
+                self.timed_out += 1
+                raise OverflowError(f"{self.name} queue wait timed out")
+            raise
+
+        waited = time.monotonic() - started_at
+        self.admitted += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        return waited
+
+    def release(self, service_time=None):
+        """Frees a slot, it goes straight to the oldest waiting request if there is one"""
+        if service_time is not None:
+            self.service_time = 0.8 * self.service_time + 0.2 * service_time
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def retry_after(self):
+        """Seconds a rejected client should wait, time for the queue in front of it to drain"""
+        return max(1, math.ceil(self.service_time * (len(self.waiters) + 1) / self.limit))
+
+    def metrics(self):
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "queueDepth": len(self.waiters),
+            "queueSize": self.queue_size,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timedOut": self.timed_out,
+            "averageWait": self.total_wait / self.admitted if self.admitted else 0.0,
+            "maxWait": self.max_wait,
+            "averageServiceTime": self.service_time,
+        }
+
+
+class AdmissionControlMiddleware:
+    """Limits requests served at the same time per endpoint class, so heavy reports can not starve cheap endpoints
+
+    Requests are matched to the class with the longest matching path prefix, paths of no class are not limited. A request finding its class queue full, or waiting longer than queue_timeout, gets 429 with Retry-After. The slot is held until the response is fully sent, streamed reports included. Limits apply per worker process
+
+    Parameters:
+        classes : EndpointClass list
+    """
+
+    def __init__(self, app, classes):
+        self.app = app
+        self.prefixes = sorted(((path, endpoint_class) for endpoint_class in classes
+                                for path in endpoint_class.paths),
+                               key=lambda item: len(item[0]), reverse=True)
+
+    def match(self, path):
+        for prefix, endpoint_class in self.prefixes:
+            if path.startswith(prefix):
+                return endpoint_class
+        return None
+
+    async def __call__(self, scope, receive, send):
+        endpoint_class = self.match(scope["path"]) if scope["type"] == "http" else None
+        if endpoint_class is None:
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            await endpoint_class.acquire()
+        except OverflowError as err:
+            body = json.dumps({"detail": str(err)}).encode("utf-8")
+            await send({"type": "http.response.start", "status": 429,
+                        "headers": [(b"content-type", b"application/json"),
+                                    (b"content-length", str(len(body)).encode("latin-1")),
+                                    (b"retry-after", str(endpoint_class.retry_after()).encode("latin-1"))]})
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        started_at = time.monotonic()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            endpoint_class.release(time.monotonic() - started_at)
@@ -17,12 +17,14 @@
 # 1100 13th Street NW Suite 800 Washington, D.C. 20005
 # <info@hotosm.org>
 
-from fastapi import APIRouter
+from fastapi import APIRouter, Request
 from typing import List
 
 
 from src.galaxy.validation.models import UsersListParams, User, UserStatsParams, MappedFeature
 from src.galaxy.app import UserStats
+from src.galaxy.user_names import OsmUsersIndex
+from .utils import report_response, run_cancellable
 
 
 router = APIRouter(prefix="/osm-users")
@@ -30,14 +32,19 @@ router = APIRouter(prefix="/osm-users")
 
 @router.post("/ids", response_model=List[User])
 def list_users(params: UsersListParams):
-    return UserStats().list_users(params)
+    if OsmUsersIndex.enabled():
+        return report_response(UserStats.resolve_users(params))
+    return report_response(UserStats().list_users(params))
 
 
 @router.post("/statistics", response_model=List[MappedFeature])
-def user_statistics(params: UserStatsParams):
-    user_stats = UserStats()
+async def user_statistics(params: UserStatsParams, request: Request):
+    def statistics():
+        user_stats = UserStats()
 
-    if len(params.hashtags) > 0:
-        return user_stats.get_statistics_with_hashtags(params)
+        if len(params.hashtags) > 0:
+            return user_stats.get_statistics_with_hashtags(params)
 
-    return user_stats.get_statistics(params)
+        return user_stats.get_statistics(params)
+
+    return report_response(await run_cancellable(request, "user_statistics", statistics))
@@ -23,6 +23,7 @@ from fastapi import APIRouter, Depends
 from src.galaxy.app import Training
 from src.galaxy.validation.models import TrainingOrganisations, TrainingParams , Trainings
 from .auth import login_required
+from .utils import report_response
 from typing import List
 router = APIRouter(prefix="/training")
 
@@ -31,10 +32,18 @@ router = APIRouter(prefix="/training")
 # def get_organisations_list(user_data=Depends(login_required)):
 def get_organisations_list():
     training = Training("underpass")
-    return training.get_all_organisations()
+    return report_response(training.get_all_organisations())
 
 @router.post("",response_model=List[Trainings])
 # def get_organisations_list(user_data=Depends(login_required)):
 def get_trainings_list(params:TrainingParams):
     training= Training("underpass")
-    return training.get_trainingslist(params)
+    return report_response(training.get_trainingslist(params))
+
+
+@router.post("/refresh")
+def refresh_training_catalogue(user_data=Depends(login_required)):
+    """Reloads training and organisations tables into the catalogue serving the training endpoints"""
+    Training.catalogue.refresh()
+    return {"trainings": len(Training.catalogue.trainings),
+            "organisations": len(Training.catalogue.organisations)}
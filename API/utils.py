@@ -0,0 +1,102 @@
+# Copyright (C) 2021 Humanitarian OpenStreetmap Team
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Humanitarian OpenStreetmap Team
+# 1100 13th Street NW Suite 800 Washington, D.C. 20005
+# <info@hotosm.org>
+
+"""[Helpers shared by the routers]
+"""
+import asyncio
+import contextvars
+import json
+import threading
+
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from psycopg2 import Error as Psycopg2Error
+from psycopg2.errors import QueryCanceled
+from starlette.concurrency import run_in_threadpool
+
+from src.galaxy.app import open_connections, report_json_default, request_cancelled, statement_timeout
+from src.galaxy.config import get_statement_timeout
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# seconds between two checks of client connection while a report is running
+DISCONNECT_POLL_INTERVAL = 0.5
+
+
+async def run_cancellable(request, endpoint, func, *args):
+    """Runs blocking report call func(*args) in the threadpool with the statement timeout configured for endpoint
+
+    The client connection is watched while the report runs, when it goes away the queries in flight on every connection opened by func are cancelled on the backend and the report issues no further query, so abandoned reports stop using database CPU. A query stopped by the statement timeout is answered with 504
+    """
+    connections = []
+    cancelled = threading.Event()
+
+    def call():
+        statement_timeout.set(get_statement_timeout(endpoint))
+        open_connections.set(connections)
+        request_cancelled.set(cancelled)
+        return func(*args)
+
+    # a copied context keeps the values above to this call, threadpool threads are reused
+    context = contextvars.copy_context()
+    task = asyncio.ensure_future(run_in_threadpool(context.run, call))
+    disconnected = False
+    while not task.done():
+        await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+        if not task.done() and await request.is_disconnected():
+            disconnected = True
+            cancelled.set()
+            for conn in list(connections):
+                try:
+                    conn.cancel()
+                except Psycopg2Error:
+                    # connection was already closed by the report
+                    pass
+            # wait for the worker to unwind, nothing is sent to a gone client
+            await asyncio.wait({task})
+
+    try:
+        return task.result()
+    except QueryCanceled:
+        if disconnected:
+            raise HTTPException(status_code=499, detail="Client closed request")
+        raise HTTPException(status_code=504, detail="Report exceeded its statement timeout")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse encoded with orjson when it is installed, dates and datetimes are encoded natively"""
+
+    def render(self, content):
+        if orjson is not None:
+            return orjson.dumps(content, default=report_json_default)
+        return json.dumps(content, default=report_json_default,
+                          separators=(",", ":")).encode("utf-8")
+
+
+def report_response(report):
+    """Response of a report model or list of models built from trusted rows
+
+    Models are serialised by alias like response_model does, returning a Response skips the response_model validation and jsonable_encoder pass FastAPI would run on every row again. Keep response_model on the route for the documentation
+    """
+    if isinstance(report, list):
+        return FastJSONResponse([r.dict(by_alias=True) for r in report])
+    return FastJSONResponse(report.dict(by_alias=True))
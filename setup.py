@@ -10,11 +10,22 @@ setuptools.setup(
     'The osm_galaxy module makes it simple for you to get osm data stats provided by api in your own project',
     packages=["galaxy","galaxy.query_builder","galaxy.validation"],
     package_dir={'galaxy': 'src/galaxy'},
+    entry_points={
+        "console_scripts": [
+            "galaxy = galaxy.cli:main",
+        ],
+    },
     extras_require={
         "dev": [
             "pytest == 3.7",
             "psycopg2",
             "testing.postgresql==1.3.0",
+        ],
+        "pandas": [
+            "pandas",
+        ],
+        "arrow": [
+            "pyarrow",
         ]
     },
     classifiers=[
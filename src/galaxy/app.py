@@ -19,6 +19,12 @@
 '''Main page contains class for database mapathon and funtion for error printing  '''
 
 import sys
+import threading
+import time
+import weakref
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from contextvars import ContextVar
 from psycopg2 import connect, sql
 from psycopg2.extras import DictCursor
 from psycopg2 import OperationalError, errorcodes, errors
@@ -27,14 +33,50 @@ from pydantic.types import Json
 from pydantic import parse_obj_as
 from .validation.models import *
 from .query_builder.builder import *
+import csv
 import json
-import pandas
 import os
 from json import loads as json_loads
 from geojson import Feature, FeatureCollection, Point
 from io import StringIO
-
-from .config import config
+from uuid import uuid4
+from decimal import Decimal
+from datetime import timedelta
+
+from .config import config, get_db_params
+from .replicas import ReplicaSet
+from .user_names import OsmUsersIndex, UserNameResolver
+from .cache import TTLCache, cache_key
+
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# rows fetched per round trip from server side cursors, also the size of arrow record batches
+OUTPUT_BATCH_SIZE = 10000
+
+# postgres type oids mapped to arrow type names, anything else is inferred from the values
+ARROW_TYPE_NAMES = {
+    16: "bool_",
+    20: "int64",
+    21: "int16",
+    23: "int32",
+    700: "float32",
+    701: "float64",
+    1700: "float64",
+    25: "string",
+    1043: "string",
+    1082: "date32",
+    1114: "timestamp",
+    1184: "timestamptz",
+}
 
 def print_psycopg2_exception(err):
     """ 
@@ -54,6 +96,48 @@ def print_psycopg2_exception(err):
     raise err
 
 
+def json_default(value):
+    """json.dumps fallback for values coming from the cursor"""
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    return str(value)
+
+
+def report_json_default(value):
+    """json encoder fallback for report models built with from_row, sums come from the database as Decimal and integral ones stay integers"""
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def from_row(model, row):
+    """Builds model from a trusted database row without validating it again, columns that are not fields of model are left out"""
+    keys = row.keys()
+    return model.construct(**{name: row[name] for name in model.__fields__ if name in keys})
+
+
+# statement timeout in seconds, connection list and cancel event of the request being served, set by API around report calls
+statement_timeout = ContextVar("statement_timeout", default=0)
+open_connections = ContextVar("open_connections", default=None)
+request_cancelled = ContextVar("request_cancelled", default=None)
+
+
+def connect_for_request(params):
+    """Connects with params, applying the statement timeout of current request and registering the connection so its queries can be cancelled when the client goes away"""
+    timeout = statement_timeout.get()
+    if timeout:
+        params = dict(params, options=f"-c statement_timeout={timeout * 1000}")
+    conn = connect(**params)
+    connections = open_connections.get()
+    if connections is not None:
+        connections.append(conn)
+    return conn
+
+
 def check_for_json(result_str):
     """Check if the Payload is a JSON document
 
@@ -70,17 +154,44 @@ def check_for_json(result_str):
 class Database:
     """ Database class is used to connect with your database , run query  and get result from it . It has all tests and validation inside class """
 
-    def __init__(self, db_params):
-        """Database class constructor"""
+    def __init__(self, db_params, replicas=None):
+        """Database class constructor, connections go to the read endpoints of replicas when it is given"""
 
         self.db_params = db_params
+        self.replicas = replicas
+        self.endpoint = None
+        self.release_endpoint = None
         print('Database class object created...')
 
+    @classmethod
+    def for_reads(cls, section):
+        """Database for read only report queries of config section, routed to its read replicas when they are configured"""
+        return cls(get_db_params(section), ReplicaSet.for_section(section))
+
+    def connect_replica(self):
+        """Connects to the least busy healthy read endpoint, falls back to primary"""
+        for endpoint in self.replicas.candidates():
+            try:
+                conn = connect_for_request(endpoint.params)
+            except OperationalError:
+                if endpoint is self.replicas.primary:
+                    raise
+                self.replicas.mark_failed(endpoint)
+                continue
+            self.replicas.acquire(endpoint)
+            self.endpoint = endpoint
+            # endpoint is released on close_conn or when this object is garbage collected
+            self.release_endpoint = weakref.finalize(self, self.replicas.release, endpoint)
+            return conn
+
     def connect(self):
         """Database class instance method used to connect to database parameters with error printing"""
 
         try:
-            self.conn = connect(**self.db_params)
+            if self.replicas is not None:
+                self.conn = self.connect_replica()
+            else:
+                self.conn = connect_for_request(self.db_params)
             self.cur = self.conn.cursor(cursor_factory=DictCursor)
             print('Database connection has been Successful...')
             return self.conn, self.cur
@@ -100,6 +211,10 @@ class Database:
                 # catch exception for invalid SQL statement
 
                 try:
+                    cancelled = request_cancelled.get()
+                    if cancelled is not None and cancelled.is_set():
+                        # client went away between two queries of the report
+                        raise errors.QueryCanceled("canceling statement due to user request")
                     self.cursor.execute(query)
                     try:
                         result = self.cursor.fetchall()
@@ -107,6 +222,11 @@ class Database:
                         return result
                     except:
                         return self.cursor.statusmessage
+                except errors.QueryCanceled:
+                    # statement timeout or cancel of a gone client, the report can not go on so it is raised to the API
+                    if not self.conn.closed:
+                        self.conn.rollback()
+                    raise
                 except Exception as err:
                     print_psycopg2_exception(err)
 
@@ -117,6 +237,8 @@ class Database:
                 # self.conn.close()
             else:
                 print("Database is not connected")
+        except errors.QueryCanceled:
+            raise
         except Exception as err:
             print("Oops ! You forget to have connection first")
             raise err
@@ -131,6 +253,8 @@ class Database:
                     self.cursor.close()
                     self.conn.close()
                     print("Connection closed")
+            if self.release_endpoint is not None:
+                self.release_endpoint()
         except Exception as err:
             raise err
 
@@ -139,7 +263,7 @@ class Underpass:
     """This class connects to underpass database and responsible for all the underpass related functionality"""
 
     def __init__(self, parameters=None):
-        self.database = Database(dict(config.items("UNDERPASS")))
+        self.database = Database.for_reads("UNDERPASS")
         self.con, self.cur = self.database.connect()
         self.params = parameters
 
@@ -151,6 +275,16 @@ class Underpass:
         total_contributors_result = self.database.executequery(
             total_contributor_query)
         return osm_history_result, total_contributors_result
+
+    def get_mapathon_increment(self, since):
+        """Rows of mapathon changesets created after since ( None for all ), with created and modified feature counts"""
+        query = generate_mapathon_increment_underpass_query(self.params, since, self.cur)
+        return self.database.executequery(query)
+
+    def get_multi_mapathon_summary_result(self, events):
+        """Rows of event position, feature, action and count of several mapathons, contributor counts have NULL feature"""
+        query = generate_multi_mapathon_summary_underpass_query(events, self.cur)
+        return self.database.executequery(query)
     
     def all_training_organisations(self):
         """[Resposible for the total organisations result generation]
@@ -177,7 +311,7 @@ class Insight:
     """This class connects to Insight database and responsible for all the Insight related functionality"""
 
     def __init__(self, parameters=None):
-        self.database = Database(dict(config.items("INSIGHTS_PG")))
+        self.database = Database.for_reads("INSIGHTS_PG")
         self.con, self.cur = self.database.connect()
         self.params = parameters
 
@@ -199,6 +333,16 @@ class Insight:
         total_contributors_result = self.database.executequery(total_contributor_query)
         return osm_history_result, total_contributors_result
 
+    def get_mapathon_increment(self, since):
+        """Rows of mapathon changesets created after since ( None for all ), with the feature, action and id of their elements"""
+        query = create_mapathon_increment_query(self.params, since, self.con, self.cur)
+        return self.database.executequery(query)
+
+    def get_multi_mapathon_summary_result(self, events):
+        """Rows of event position, feature, action and count of several mapathons, contributor counts have NULL feature"""
+        query = create_multi_mapathon_summary_query(events, self.con, self.cur)
+        return self.database.executequery(query)
+
     def get_mapathon_detailed_result(self):
         changeset_query, _, _ = create_changeset_query(
             self.params, self.con, self.cur)
@@ -234,8 +378,8 @@ class Mapathon:
     def get_summary(self):
         """Function to get summary of your mapathon event """
         osm_history_result,total_contributors=self.database.get_mapathon_summary_result()
-        mapped_features = [MappedFeature(**r) for r in osm_history_result]
-        report = MapathonSummary(total_contributors=total_contributors[0].get(
+        mapped_features = [from_row(MappedFeature, r) for r in osm_history_result]
+        report = MapathonSummary.construct(total_contributors=total_contributors[0].get(
             "contributors_count", "None"),
             mapped_features=mapped_features)
         return report
@@ -243,104 +387,553 @@ class Mapathon:
     def get_detailed_report(self):
         """Function to get detail report of your mapathon event. It includes individual user contribution"""
         osm_history_result,total_contributors=self.database.get_mapathon_detailed_result()
-        mapped_features = [MappedFeatureWithUser(**r) for r in osm_history_result]
-        contributors = [MapathonContributor(**r) for r in total_contributors]
-        report = MapathonDetail(contributors=contributors,
+        mapped_features = [from_row(MappedFeatureWithUser, r) for r in osm_history_result]
+        contributors = [from_row(MapathonContributor, r) for r in total_contributors]
+        report = MapathonDetail.construct(contributors=contributors,
                                 mapped_features=mapped_features)
         # print(Output(osm_history_query,self.con).to_list())
         return report
 
 
+class MultiMapathon:
+    """Summaries of several mapathons computed together, changesets and their elements are read once whatever the number of events"""
+
+    def __init__(self, parameters, source):
+        if type(parameters) is MultiMapathonRequestParams:
+            self.params = parameters
+        else:
+            self.params = MultiMapathonRequestParams(**parameters)
+
+        if source == "underpass":
+            self.database = Underpass()
+        elif source == "insight":
+            self.database = Insight()
+        else:
+            raise ValueError("Source is not Supported")
+
+    def get_summary(self):
+        """Function to get summary of every event, in the order of the request"""
+        events = self.params.events
+        rows = self.database.get_multi_mapathon_summary_result(events)
+        mapped_features = [[] for _ in events]
+        total_contributors = [0] * len(events)
+        for row in rows:
+            if row["feature"] is None:
+                total_contributors[row["event"]] = row["count"]
+            else:
+                mapped_features[row["event"]].append(from_row(MappedFeature, row))
+        return MultiMapathonSummary.construct(events=[
+            MapathonEventSummary.construct(name=event.name,
+                                           total_contributors=total_contributors[position],
+                                           mapped_features=mapped_features[position])
+            for position, event in enumerate(events)])
+
+
+class LiveMapathonState:
+    """Running summary of one mapathon, merged from changesets newer than the watermark
+
+    Changesets keep receiving edits after they are created, so the ones created less than lookback before the watermark are read again on each merge and their previous contribution is replaced. Older changesets are folded into the totals and forgotten
+
+    Parameters:
+        distinct : counts are distinct element ids ( insight ) instead of sums of per changeset counts ( underpass )
+        lookback : timedelta of changesets read again
+    """
+
+    def __init__(self, distinct, lookback, to_timestamp):
+        self.distinct = distinct
+        self.lookback = lookback
+        self.to_timestamp = to_timestamp
+        self.watermark = None
+        # (feature, action) : count
+        self.totals = Counter()
+        # (feature, action, element id) : number of changesets it appears in, insight only
+        self.element_refs = Counter()
+        # changeset id : (created_at, contribution) of changesets within lookback
+        self.recent = {}
+        self.contributors = set()
+        self.lock = threading.Lock()
+
+    def since(self):
+        """Timestamp after which changesets have to be read, None before the first merge"""
+        if self.watermark is None:
+            return None
+        return self.watermark - self.lookback
+
+    def apply(self, contribution, sign):
+        for key, count in contribution.items():
+            if not self.distinct:
+                self.totals[key[:2]] += sign * count
+                continue
+            before = self.element_refs[key]
+            self.element_refs[key] = before + sign
+            if before == 0 and sign > 0:
+                self.totals[key[:2]] += 1
+            elif before == 1 and sign < 0:
+                self.totals[key[:2]] -= 1
+                del self.element_refs[key]
+
+    def merge(self, rows):
+        """Merges rows of ( changeset_id, user_id, created_at, feature, action, count or element id )"""
+        changesets = {}
+        for changeset_id, user_id, created_at, feature, action, value in rows:
+            self.contributors.add(user_id)
+            contribution = changesets.setdefault(changeset_id, (created_at, Counter()))[1]
+            if feature is None:
+                continue
+            if self.distinct:
+                contribution[(feature, action, value)] = 1
+            else:
+                contribution[(feature, action)] += value
+
+        for changeset_id, (created_at, contribution) in changesets.items():
+            previous = self.recent.get(changeset_id)
+            if previous is not None:
+                self.apply(previous[1], -1)
+            self.apply(contribution, 1)
+            self.recent[changeset_id] = (created_at, contribution)
+            if self.watermark is None or created_at > self.watermark:
+                self.watermark = created_at
+
+        if self.watermark is not None:
+            frozen_before = self.watermark - self.lookback
+            self.recent = {k: v for k, v in self.recent.items() if v[0] > frozen_before}
+
+    def summary(self):
+        mapped_features = [MappedFeature(feature=feature, action=action, count=count)
+                           for (feature, action), count in self.totals.most_common()
+                           if count > 0]
+        return MapathonSummary(total_contributors=len(self.contributors),
+                               mapped_features=mapped_features)
+
+
+class LiveMapathon:
+    """Mapathon summary for polling during a running event. Aggregates are kept per mapathon and each call only reads changesets newer than the last one it has seen, so its cost follows new activity instead of event duration
+
+    to_timestamp is not part of the mapathon key, clients move it forward between polls. A window moved backwards starts over
+    """
+
+    states = TTLCache(maxsize=config.getint("LIVE_MAPATHON", "state_maxsize", fallback=256),
+                      ttl=config.getint("LIVE_MAPATHON", "state_ttl", fallback=21600))
+    lookback = timedelta(seconds=config.getint("LIVE_MAPATHON", "lookback", fallback=3600))
+    # guards creation of states, merges hold the lock of their state
+    states_lock = threading.Lock()
+
+    def __init__(self, parameters, source):
+        if type(parameters) is MapathonRequestParams:
+            self.params = parameters
+        else:
+            self.params = MapathonRequestParams(**parameters)
+        if source not in ("underpass", "insight"):
+            raise ValueError("Source is not Supported")
+        self.source = source
+
+    def get_state(self):
+        key = cache_key("live-mapathon", self.source,
+                        self.params.dict(exclude={"to_timestamp", "source"}))
+        with self.states_lock:
+            state = self.states.get(key)
+            if state is None or self.params.to_timestamp < state.to_timestamp:
+                state = LiveMapathonState(distinct=self.source == "insight",
+                                          lookback=self.lookback,
+                                          to_timestamp=self.params.to_timestamp)
+                self.states.set(key, state)
+        return state
+
+    def get_summary(self):
+        """Merges changesets created since the last call and returns the up to date MapathonSummary"""
+        state = self.get_state()
+        with state.lock:
+            if self.source == "underpass":
+                database = Underpass(self.params)
+            else:
+                database = Insight(self.params)
+            rows = database.get_mapathon_increment(state.since())
+            database.database.close_conn()
+            state.merge(rows)
+            state.to_timestamp = max(state.to_timestamp, self.params.to_timestamp)
+            return state.summary()
+
+
 class Output:
-    """Class to convert sql query result to specific output format. It uses Pandas Dataframe
+    """Class to convert sql query result to specific output format. It works directly on the cursor rows and column names, pandas is only used when backend="pandas" is requested
 
     Parameters:
         supports : list, dict , json and sql query string along with connection
+        backend : "native" (default) or "pandas"
 
     Returns:
         json,csv,dict,list,dataframe
     """
 
-    def __init__(self, result, connection=None):
+    BACKENDS = ("native", "pandas")
+
+    def __init__(self, result, connection=None, backend="native"):
         """Constructor"""
+        if backend not in self.BACKENDS:
+            raise ValueError("Backend " + str(backend) + " is not supported")
+        if backend == "pandas" and pandas is None:
+            raise ValueError("pandas is required for the pandas backend")
+        self.backend = backend
+        self._dataframe = None
+
         if isinstance(result, (list, dict)):
-            print(type(result))
-            try:
-                self.dataframe = pandas.DataFrame(result)
-            except Exception as err:
-                raise err
+            self.columns, self.rows = Output.from_python(result)
         elif isinstance(result, str):
             check, r_json = check_for_json(result)
             if check is True:
-                print("i am json")
-                try:
-                    self.dataframe = pandas.json_normalize(r_json)
-                except Exception as err:
-                    raise err
+                self.columns, self.rows = Output.from_python(
+                    Output.normalize_json(r_json))
             else:
                 if connection is not None:
-                    try:
-                        self.dataframe = pandas.read_sql_query(
-                            result, connection)
-                    except Exception as err:
-                        raise err
+                    self.columns, self.rows = Output.from_query(
+                        result, connection)
                 else:
                     raise ValueError("Connection is required for SQL Query")
         else:
             raise ValueError("Input type " + str(type(result)) +
                              " is not supported")
-        # print(self.dataframe)
-        if self.dataframe.empty:
-            raise ValueError("Dataframe is Null")
+        if len(self.rows) == 0:
+            raise ValueError("Result is Null")
+
+    @staticmethod
+    def from_query(query, connection):
+        """Runs query on a plain cursor and returns column names and row tuples"""
+        with connection.cursor() as cursor:
+            cursor.execute(query)
+            columns = [desc[0] for desc in cursor.description]
+            rows = cursor.fetchall()
+        return columns, rows
+
+    @staticmethod
+    def from_python(result):
+        """Returns column names and row tuples for list of records, list of lists or dict of columns"""
+        if isinstance(result, dict):
+            if all(isinstance(v, (list, tuple)) for v in result.values()):
+                return list(result.keys()), list(zip(*result.values()))
+            result = [result]
+
+        if len(result) == 0:
+            return [], []
+
+        if all(hasattr(r, "keys") for r in result):
+            records = [r if isinstance(r, dict) else dict(r) for r in result]
+            columns = []
+            for record in records:
+                for key in record:
+                    if key not in columns:
+                        columns.append(key)
+            rows = [tuple(record.get(c) for c in columns) for record in records]
+            return columns, rows
+
+        rows = [tuple(r) for r in result]
+        return list(range(max(len(r) for r in rows))), rows
+
+    @staticmethod
+    def normalize_json(r_json, separator="."):
+        """Flattens nested json objects the same way pandas.json_normalize does"""
+
+        def flatten(record, prefix=""):
+            flat = {}
+            for key, value in record.items():
+                name = f"{prefix}{key}"
+                if isinstance(value, dict):
+                    flat.update(flatten(value, name + separator))
+                else:
+                    flat[name] = value
+            return flat
+
+        records = r_json if isinstance(r_json, list) else [r_json]
+        return [flatten(r) for r in records]
+
+    @property
+    def dataframe(self):
+        """pandas Dataframe of the result, built only when asked for"""
+        if self._dataframe is None:
+            if pandas is None:
+                raise ValueError("pandas is required to build a dataframe")
+            self._dataframe = pandas.DataFrame.from_records(
+                self.rows, columns=self.columns)
+        return self._dataframe
+
+    def records(self):
+        """Yields every row as dict"""
+        columns = self.columns
+        for row in self.rows:
+            yield dict(zip(columns, row))
 
     def to_JSON(self):
         """Function to convert query result to JSON, Returns JSON"""
-        # print(self.dataframe)
-        js = self.dataframe.to_json(orient='records')
-        return js
+        if self.backend == "pandas":
+            return self.dataframe.to_json(orient='records')
+        return json.dumps(self.to_dict(), separators=(",", ":"), default=json_default)
 
     def to_list(self):
         """Function to convert query result to list, Returns list"""
-
-        result_list = self.dataframe.values.tolist()
-        return result_list
+        if self.backend == "pandas":
+            return self.dataframe.values.tolist()
+        return [list(row) for row in self.rows]
 
     def to_dict(self):
         """Function to convert query result to dict, Returns dict"""
-        dic = self.dataframe.to_dict(orient='records')
-        return dic
+        if self.backend == "pandas":
+            return self.dataframe.to_dict(orient='records')
+        return list(self.records())
 
     def to_CSV(self, output_file_path):
-        """Function to return CSV data , takes output location string as input"""
-        try:
+        """Function to return CSV data , takes output location string or file like object as input"""
+        if self.backend == "pandas":
             self.dataframe.to_csv(output_file_path, encoding='utf-8')
             return "CSV: Generated at : " + str(output_file_path)
-        except Exception as err:
-            raise err
 
-    def to_GeoJSON(self, lat_column, lng_column):
-        '''to_Geojson converts pandas dataframe to geojson , Currently supports only Point Geometry and hence takes parameter of lat and lng ( You need to specify lat lng column )'''
-        # print(self.dataframe)
-        # columns used for constructing geojson object
-        properties = self.dataframe.drop([lat_column, lng_column],
-                                         axis=1).to_dict('records')
-
-        features = self.dataframe.apply(
-            lambda row: Feature(geometry=Point(
-                (float(row[lng_column]), float(row[lat_column]))),
-                properties=properties[row.name]),
-            axis=1).tolist()
+        if hasattr(output_file_path, "write"):
+            Output.write_csv(output_file_path, self.columns, self.rows)
+        else:
+            with open(output_file_path, "w", newline="",
+                      encoding="utf-8") as csv_file:
+                Output.write_csv(csv_file, self.columns, self.rows)
+        return "CSV: Generated at : " + str(output_file_path)
+
+    @staticmethod
+    def write_csv(stream, columns, rows):
+        """Writes rows with a leading index column, same layout as pandas to_csv"""
+        writer = csv.writer(stream, lineterminator="\n")
+        writer.writerow(["", *columns])
+        for index, row in enumerate(rows):
+            writer.writerow([index, *row])
 
+    def to_GeoJSON(self, lat_column, lng_column):
+        '''to_Geojson converts query result to geojson , Currently supports only Point Geometry and hence takes parameter of lat and lng ( You need to specify lat lng column )'''
+        if self.backend == "pandas":
+            # columns used for constructing geojson object
+            properties = self.dataframe.drop([lat_column, lng_column],
+                                             axis=1).to_dict('records')
+
+            features = self.dataframe.apply(
+                lambda row: Feature(geometry=Point(
+                    (float(row[lng_column]), float(row[lat_column]))),
+                    properties=properties[row.name]),
+                axis=1).tolist()
+            return FeatureCollection(features=features)
+
+        lat_index = self.columns.index(lat_column)
+        lng_index = self.columns.index(lng_column)
+        property_columns = [(i, c) for i, c in enumerate(self.columns)
+                            if i not in (lat_index, lng_index)]
+        features = [
+            Feature(geometry=Point((float(row[lng_index]),
+                                    float(row[lat_index]))),
+                    properties={c: row[i] for i, c in property_columns})
+            for row in self.rows
+        ]
         # whole geojson object
         feature_collection = FeatureCollection(features=features)
         return feature_collection
 
+    def to_arrow(self, output_file_path):
+        """Function to write query result as Arrow IPC stream, takes output location string or file like object as input"""
+        return self.write_columnar(output_file_path, "arrow")
+
+    def to_parquet(self, output_file_path):
+        """Function to write query result as Parquet file, takes output location string or file like object as input"""
+        return self.write_columnar(output_file_path, "parquet")
+
+    def write_columnar(self, output_file_path, file_format):
+        batches = ((self.columns, None, self.rows[i:i + OUTPUT_BATCH_SIZE])
+                   for i in range(0, len(self.rows), OUTPUT_BATCH_SIZE))
+        chunks = Output.iter_columnar(batches, file_format)
+        if hasattr(output_file_path, "write"):
+            for chunk in chunks:
+                output_file_path.write(chunk)
+        else:
+            with open(output_file_path, "wb") as output_file:
+                for chunk in chunks:
+                    output_file.write(chunk)
+        return file_format + ": Generated at : " + str(output_file_path)
+
+    @staticmethod
+    def iter_query(query, connection, batch_size=OUTPUT_BATCH_SIZE):
+        """Yields (columns, type codes, rows) batches of query result from a server side cursor, so the whole result is never held in memory"""
+        try:
+            with connection.cursor(name=f"galaxy_output_{uuid4().hex}") as cursor:
+                cursor.itersize = batch_size
+                cursor.execute(query)
+                rows = cursor.fetchmany(batch_size)
+                columns = [desc[0] for desc in cursor.description]
+                type_codes = [desc[1] for desc in cursor.description]
+                # first batch is always yielded so that empty results still carry their columns
+                yield columns, type_codes, rows
+                while len(rows) == batch_size:
+                    rows = cursor.fetchmany(batch_size)
+                    if len(rows) > 0:
+                        yield columns, type_codes, rows
+        finally:
+            # server side cursor runs inside a transaction, end it also when the consumer stops early
+            if not connection.closed:
+                connection.rollback()
+
+    @staticmethod
+    def close_batches(batches):
+        """Closes batches generator so that its cursor transaction ends as soon as the encoder stops"""
+        close = getattr(batches, "close", None)
+        if close is not None:
+            close()
+
+    @staticmethod
+    def point_feature(lat_column, lng_column):
+        """Returns function building geojson point feature from a row dict, other columns become properties"""
+
+        def to_feature(row):
+            properties = {k: v for k, v in row.items()
+                          if k not in (lat_column, lng_column)}
+            return {
+                "type": "Feature",
+                "geometry": {
+                    "type": "Point",
+                    "coordinates": [float(row[lng_column]),
+                                    float(row[lat_column])]
+                },
+                "properties": properties
+            }
+
+        return to_feature
+
+    @staticmethod
+    def iter_geojson_seq(batches, to_feature):
+        """Encodes (columns, type codes, rows) batches as newline delimited geojson, one feature per line, and yields text batch by batch"""
+        try:
+            for columns, _, rows in batches:
+                if len(rows) == 0:
+                    continue
+                lines = [
+                    json.dumps(to_feature(dict(zip(columns, row))),
+                               default=json_default) for row in rows
+                ]
+                yield "\n".join(lines) + "\n"
+        finally:
+            Output.close_batches(batches)
+
+    @staticmethod
+    def arrow_schema(columns, type_codes, rows):
+        """Arrow schema from postgres type oids when known, otherwise inferred from first batch"""
+        fields = []
+        for index, column in enumerate(columns):
+            type_name = None
+            if type_codes is not None:
+                type_name = ARROW_TYPE_NAMES.get(type_codes[index])
+            if type_name == "timestamp":
+                arrow_type = pyarrow.timestamp("us")
+            elif type_name == "timestamptz":
+                arrow_type = pyarrow.timestamp("us", tz="UTC")
+            elif type_name is not None:
+                arrow_type = getattr(pyarrow, type_name)()
+            else:
+                values = [row[index] for row in rows if row[index] is not None]
+                try:
+                    arrow_type = pyarrow.array(values).type
+                except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+                    arrow_type = pyarrow.string()
+                if pyarrow.types.is_null(arrow_type):
+                    arrow_type = pyarrow.string()
+            fields.append(pyarrow.field(str(column), arrow_type))
+        return pyarrow.schema(fields)
+
+    @staticmethod
+    def arrow_batch(schema, rows):
+        """Builds one arrow record batch column by column"""
+        arrays = []
+        for index, field in enumerate(schema):
+            values = [row[index] for row in rows]
+            if pyarrow.types.is_string(field.type):
+                values = [v if v is None or isinstance(v, str) else str(v)
+                          for v in values]
+            elif pyarrow.types.is_floating(field.type):
+                values = [v if v is None else float(v) for v in values]
+            arrays.append(pyarrow.array(values, type=field.type))
+        return pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+    @staticmethod
+    def iter_columnar(batches, file_format):
+        """Encodes (columns, type codes, rows) batches as Arrow IPC stream or Parquet and yields the bytes written after every batch"""
+        if pyarrow is None:
+            raise ValueError("pyarrow is required for arrow and parquet output")
+        sink = ChunkSink()
+        writer = None
+        try:
+            for columns, type_codes, rows in batches:
+                if writer is None:
+                    schema = Output.arrow_schema(columns, type_codes, rows)
+                    if file_format == "parquet":
+                        writer = pyarrow.parquet.ParquetWriter(sink, schema)
+                    else:
+                        writer = pyarrow.ipc.new_stream(sink, schema)
+                batch = Output.arrow_batch(schema, rows)
+                if file_format == "parquet":
+                    writer.write_table(pyarrow.Table.from_batches([batch]))
+                else:
+                    writer.write_batch(batch)
+                yield sink.take()
+        finally:
+            Output.close_batches(batches)
+        if writer is None:
+            raise ValueError("Result is Null")
+        writer.close()
+        yield sink.take()
+
+
+class ChunkSink:
+    """Write only file object that hands out the bytes written so far, used to stream arrow output without buffering the whole file"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
 
 class UserStats:
+    user_names = UserNameResolver.from_config()
+
     def __init__(self):
-        self.db = Database(dict(config.items("INSIGHTS_PG")))
+        self.db = Database.for_reads("INSIGHTS_PG")
         self.con, self.cur = self.db.connect()
 
+    @classmethod
+    def resolve_users(cls, params):
+        """Users of list_users resolved through the osm_user_days table and the in process name cache, names already cached need no connection"""
+        database = Database.for_reads("INSIGHTS_PG")
+        try:
+            users = cls.user_names.resolve(database, params.user_names,
+                                           params.from_timestamp, params.to_timestamp)
+        finally:
+            if getattr(database, "conn", None) is not None:
+                database.close_conn()
+        return [User.construct(user_id=user_id, user_name=user_name) for user_id, user_name in users]
+
     def list_users(self, params):
         user_names_str = ",".join(
             ["%s" for n in range(len(params.user_names))])
@@ -356,7 +949,7 @@ class UserStats:
 
         result = self.db.executequery(list_users_query)
 
-        users_list = [User(**r) for r in result]
+        users_list = [from_row(User, r) for r in result]
 
         return users_list
 
@@ -364,7 +957,7 @@ class UserStats:
         query = create_UserStats_get_statistics_query(params, self.con,
                                                       self.cur)
         result = self.db.executequery(query)
-        summary = [MappedFeature(**r) for r in result]
+        summary = [from_row(MappedFeature, r) for r in result]
         return summary
 
     def get_statistics_with_hashtags(self, params):
@@ -372,14 +965,14 @@ class UserStats:
             params, self.con, self.cur)
         result = self.db.executequery(query)
 
-        summary = [MappedFeature(**r) for r in result]
+        summary = [from_row(MappedFeature, r) for r in result]
 
         return summary
 
 
 class DataQualityHashtags:
     def __init__(self, params: DataQualityHashtagParams):
-        self.db = Database(dict(config.items("UNDERPASS")))
+        self.db = Database.for_reads("UNDERPASS")
         self.con, self.cur = self.db.connect()
         self.params = params
 
@@ -406,23 +999,27 @@ class DataQualityHashtags:
 
         return iter(stream.getvalue())
 
+    @staticmethod
+    def to_feature(row):
+        return {
+            "type": "Feature",
+            "geometry": {
+                "type": "Point",
+                "coordinates": [row["lon"], row["lat"]]
+            },
+            "properties": {
+                "created_at": row["created_at"],
+                "changeset_id": row["changeset_id"],
+                "osm_id": row["osm_id"],
+                "issue_type": row["issues"].split(",")
+            }
+        }
+
     @staticmethod
     def to_geojson(results):
         features = []
         for row in results:
-            geojson_feature = {
-                "type": "Feature",
-                "geometry": {
-                    "type": "Point",
-                    "coordinates": [row["lon"], row["lat"]]
-                },
-                "properties": {
-                    "created_at": row["created_at"],
-                    "changeset_id": row["changeset_id"],
-                    "osm_id": row["osm_id"],
-                    "issue_type": row["issues"].split(",")
-                }
-            }
+            geojson_feature = DataQualityHashtags.to_feature(row)
             features.append(Feature(**geojson_feature))
 
         feature_collection = FeatureCollection(features=features)
@@ -436,6 +1033,62 @@ class DataQualityHashtags:
 
         return feature_collection
 
+    def get_report_as_geojson_seq(self):
+        """Yields the report as newline delimited geojson features, batch by batch from the cursor"""
+        query = generate_data_quality_hashtag_reports(self.cur, self.params)
+        return Output.iter_geojson_seq(Output.iter_query(query, self.con),
+                                       DataQualityHashtags.to_feature)
+
+    def get_report_as_columnar(self, file_format):
+        """Yields the report encoded as Arrow IPC stream or Parquet, batch by batch from the cursor"""
+        query = generate_data_quality_hashtag_reports(self.cur, self.params)
+        return Output.iter_columnar(Output.iter_query(query, self.con),
+                                    file_format)
+
+    def get_report_as_grid(self):
+        """Returns issue counts per grid cell as geojson FeatureCollection"""
+        query = generate_data_quality_grid_query(
+            self.cur, generate_data_quality_hashtag_reports(self.cur, self.params),
+            # lat holds x of location in hashtag reports
+            "lat", "lon", "issues", self.params.issue_type,
+            self.params.grid_shape, self.params.grid_size)
+        return self.db.executequery(query)[0][0]
+
+
+class DataQualityTiles:
+    """Mapbox Vector Tiles of data quality issues from underpass validation table. Tiles are cached by filter hash and tile, database is only hit on cache miss"""
+
+    cache = TTLCache(maxsize=config.getint("CACHE", "tile_maxsize", fallback=4096),
+                     ttl=config.getint("CACHE", "tile_ttl", fallback=300))
+
+    def __init__(self, params: DataQualityTileParams):
+        self.params = params
+
+    def get_tile(self, z, x, y):
+        """Returns encoded tile as bytes"""
+        if z < 0 or z > 22 or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            raise ValueError("Tile " + f"{z}/{x}/{y}" + " does not exist")
+
+        key = cache_key("data-quality-tile", self.params, z, x, y)
+        tile = self.cache.get(key)
+        if tile is None:
+            db = Database.for_reads("UNDERPASS")
+            connection = db.connect()
+            if connection is None:
+                raise OperationalError("Tile database is not reachable")
+            con, cur = connection
+            try:
+                query = generate_data_quality_tile_query(cur, self.params, z, x, y)
+                result = db.executequery(query)
+            finally:
+                db.close_conn()
+            # only tiles actually read are cached, a failed read would otherwise be served as an empty tile until it expires
+            if not result:
+                raise OperationalError("Tile query failed")
+            tile = bytes(result[0][0]) if result[0][0] is not None else b""
+            self.cache.set(key, tile)
+        return tile
+
 
 class DataQuality:
     """Class for data quality report this is the class that self connects to database and provide you detail report about data quality inside specific tasking manager project
@@ -447,7 +1100,7 @@ class DataQuality:
     """
 
     def __init__(self, parameters, inputtype):
-        self.db = Database(dict(config.items("UNDERPASS")))
+        self.db = Database.for_reads("UNDERPASS")
         self.con, self.cur = self.db.connect()
         self.inputtype = inputtype
         # parameter validation using pydantic model
@@ -464,12 +1117,15 @@ class DataQuality:
         else:
             raise ValueError("Input Type Must be in ['TM','username']")
 
+    def get_query(self):
+        """Returns data_quality query for the input type"""
+        if self.inputtype == "TM":
+            return generate_data_quality_TM_query(self.params, self.cur)
+        return generate_data_quality_username_query(self.params, self.cur)
+
     def get_report(self):
         """Functions that returns data_quality Report"""
-        if self.inputtype == "TM":
-            query = generate_data_quality_TM_query(self.params)
-        elif self.inputtype == "username":
-            query = generate_data_quality_username_query(self.params)
+        query = self.get_query()
         try:
             result = Output(query, self.con).to_GeoJSON('lat', 'lng')
             return result
@@ -480,26 +1136,139 @@ class DataQuality:
     def get_report_as_csv(self, filelocation):
         """Functions that returns data_quality Report as CSV Format , requires file path where csv is meant to be generated"""
 
-        if self.inputtype == "TM":
-            query = generate_data_quality_TM_query(self.params)
-        elif self.inputtype == "username":
-            query = generate_data_quality_username_query(self.params)
+        query = self.get_query()
         try:
             result = Output(query, self.con).to_CSV(filelocation)
             return result
         except Exception as err:
             return err  
 
+    def get_report_as_geojson_seq(self):
+        """Functions that yields data_quality Report as newline delimited geojson features, batch by batch from the cursor"""
+        query = self.get_query()
+        return Output.iter_geojson_seq(Output.iter_query(query, self.con),
+                                       Output.point_feature('lat', 'lng'))
+
+    def get_report_as_columnar(self, file_format):
+        """Functions that yields data_quality Report encoded as Arrow IPC stream or Parquet ( "arrow" or "parquet" ), batch by batch from the cursor"""
+        query = self.get_query()
+        return Output.iter_columnar(Output.iter_query(query, self.con),
+                                    file_format)
+
+    def get_report_as_grid(self):
+        """Functions that returns data_quality Report as issue counts per grid cell, a geojson FeatureCollection"""
+        query = generate_data_quality_grid_query(
+            self.cur, self.get_query(), "lng", "lat", "Issue_type", self.params.issue_types,
+            self.params.grid_shape, self.params.grid_size)
+        return self.db.executequery(query)[0][0]
+
 
 from .validation.models import Source
+
+
+class TrainingCatalogue:
+    """In process copy of underpass training and organizations tables, indexed for the TrainingParams filters
+
+    Both tables are small and rarely change. They are loaded once, rows validated on load, and read again when refresh_interval seconds passed or refresh is called. When reloading fails the previous copy keep being served
+
+    Parameters:
+        refresh_interval : seconds after which the catalogue is loaded again on next query
+    """
+
+    def __init__(self, refresh_interval=600):
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self.loaded_at = None
+        self.organisations = []
+        self.trainings = []
+        # sorted dates with positions in trainings, for range filters
+        self.dates = []
+        self.date_positions = []
+        # indexes : value -> set of positions in trainings
+        self.by_organisation = {}
+        self.by_topic_type = {}
+        self.by_event_type = {}
+
+    def load(self):
+        database = Underpass()
+        try:
+            organisations = [TrainingOrganisations(**r) for r in database.all_training_organisations()]
+            trainings = [Trainings(**r) for r in database.training_list(TrainingParams())]
+        finally:
+            database.database.close_conn()
+        self.index(organisations, trainings)
+
+    def index(self, organisations, trainings):
+        """Serves the given organisations and trainings, indexed for the filters"""
+        by_organisation, by_topic_type, by_event_type = {}, {}, {}
+        for position, training in enumerate(trainings):
+            by_organisation.setdefault(str(training.organization), set()).add(position)
+            by_topic_type.setdefault(training.topictype, set()).add(position)
+            by_event_type.setdefault(training.eventtype, set()).add(position)
+        date_index = sorted((training.date, position) for position, training in enumerate(trainings))
+
+        # swapped in one go, queries running meanwhile see either copy whole
+        (self.organisations, self.trainings, self.by_organisation, self.by_topic_type,
+         self.by_event_type, self.dates, self.date_positions) = (
+            organisations, trainings, by_organisation, by_topic_type, by_event_type,
+            [d for d, _ in date_index], [p for _, p in date_index])
+        self.loaded_at = time.monotonic()
+
+    def refresh(self):
+        """Loads tables again now"""
+        with self.lock:
+            self.load()
+
+    def ensure_loaded(self):
+        if self.loaded_at is not None and time.monotonic() - self.loaded_at < self.refresh_interval:
+            return
+        with self.lock:
+            if self.loaded_at is not None and time.monotonic() - self.loaded_at < self.refresh_interval:
+                return
+            try:
+                self.load()
+            except Exception as err:
+                if self.loaded_at is None:
+                    raise
+                print(f"Training catalogue refresh failed, serving previous copy: {err}")
+                self.loaded_at = time.monotonic()
+
+    def get_organisations(self):
+        self.ensure_loaded()
+        return self.organisations
+
+    def query(self, params: TrainingParams):
+        """Trainings matching params, in table order"""
+        self.ensure_loaded()
+        candidates = []
+        if params.oid:
+            candidates.append(self.by_organisation.get(str(params.oid), set()))
+        if params.topic_type:
+            candidates.append(set().union(*[self.by_topic_type.get(t, set()) for t in params.topic_type]))
+        if params.event_type:
+            candidates.append(self.by_event_type.get(params.event_type, set()))
+        if params.from_datestamp or params.to_datestamp:
+            low = bisect_left(self.dates, params.from_datestamp) if params.from_datestamp else 0
+            high = bisect_right(self.dates, params.to_datestamp) if params.to_datestamp else len(self.dates)
+            candidates.append(set(self.date_positions[low:high]))
+
+        if len(candidates) == 0:
+            return list(self.trainings)
+        candidates.sort(key=len)
+        positions = candidates[0].intersection(*candidates[1:])
+        return [self.trainings[p] for p in sorted(positions)]
+
+
 class Training :
-    """[Class responsible for Training data API]
+    """[Class responsible for Training data API], answered from the in process TrainingCatalogue
     """
+    catalogue = TrainingCatalogue(
+        refresh_interval=config.getint("TRAINING", "refresh_interval", fallback=600))
+
     def __init__(self,source):
-        if source == Source.UNDERPASS.value:
-                self.database = Underpass()
-        else:
+        if source != Source.UNDERPASS.value:
             raise ValueError("Source is not Supported")
+        self.source = source
     
     def get_all_organisations(self):
         """[Generates result for all list of available organisations within the database.]
@@ -507,15 +1276,7 @@ class Training :
         Returns:
             [type]: [List of Training Organisations ( id, name )]
         """
-        query_result = self.database.all_training_organisations()
-        Training_organisations_list= [TrainingOrganisations(**r) for r in query_result]
-        print(Training_organisations_list)
-        return Training_organisations_list
+        return self.catalogue.get_organisations()
         
     def get_trainingslist(self,params: TrainingParams):
-        query_result=self.database.training_list(params)
-        Trainings_list= [Trainings(**r) for r in query_result]
-        print(Trainings_list)
-        return Trainings_list
-
-
+        return self.catalogue.query(params)
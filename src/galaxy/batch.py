@@ -0,0 +1,148 @@
+# Copyright (C) 2021 Humanitarian OpenStreetmap Team
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Humanitarian OpenStreetmap Team
+# 1100 13th Street NW Suite 800 Washington, D.C. 20005
+# <info@hotosm.org>
+'''Batch runs of many reports from a manifest, written to a directory by a bounded pool of workers
+
+Manifest is a json list of reports, each with the kind and parameters accepted by the /jobs endpoints :
+
+    [{"name": "project-9928", "kind": "data-quality-project",
+      "params": {"projectIds": [9928], "issueTypes": ["badgeom"], "outputType": "csv"}},
+     {"kind": "mapathon-summary", "params": {...}}]
+'''
+
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed)
+
+from .app import statement_timeout
+from .cache import cache_key
+from .jobs import JOB_KINDS, file_extension_of
+
+FINISHED = "finished"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+SUMMARY_FILENAME = "batch-summary.json"
+
+
+class BatchReport:
+    """One report of a manifest, name is used as output file name and defaults to kind with a hash of parameters"""
+
+    def __init__(self, kind, params, name=None):
+        if kind not in JOB_KINDS:
+            raise ValueError(f"Report kind {kind} is not supported")
+        model, _ = JOB_KINDS[kind]
+        self.kind = kind
+        self.params = model(**params)
+        self.params_dict = json.loads(self.params.json())
+        self.name = name or f"{kind}-{cache_key(kind, self.params_dict)[:12]}"
+        self.filename = f"{self.name}.{file_extension_of(self.params)}"
+
+
+def read_manifest(path):
+    """Returns reports of manifest file, every entry is validated before anything runs"""
+    with open(path, encoding="utf-8") as f:
+        entries = json.load(f)
+    reports = []
+    for position, entry in enumerate(entries):
+        try:
+            reports.append(BatchReport(entry["kind"], entry.get("params", {}), entry.get("name")))
+        except Exception as err:
+            raise ValueError(f"Report {position} of manifest is invalid : {err}") from err
+    names = [report.name for report in reports]
+    duplicates = {name for name in names if names.count(name) > 1}
+    if duplicates:
+        raise ValueError(f"Report names are not unique : {', '.join(sorted(duplicates))}")
+    return reports
+
+
+def run_report(kind, params_dict, path, timeout=0):
+    """Entry point of batch workers, writes one report to path and returns seconds spent"""
+    started = time.monotonic()
+    statement_timeout.set(timeout)
+    model, run = JOB_KINDS[kind]
+    tmp_path = f"{path}.tmp"
+    try:
+        run(model(**params_dict), tmp_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    # a report file only exists once it is complete, so resumed runs can trust it
+    os.replace(tmp_path, path)
+    return time.monotonic() - started
+
+
+def run_batch(reports, directory, workers=4, threads=False, resume=True, timeout=0, progress=sys.stderr):
+    """Runs reports with at most workers at a time, returns one timing record per report
+
+    threads runs them in threads of this process sharing its read replica sets, processes are used otherwise. With resume, reports whose output file already exists in directory are skipped. Timings are also written to batch-summary.json of directory
+    """
+    os.makedirs(directory, exist_ok=True)
+    records = {}
+    pending = []
+    for report in reports:
+        path = os.path.join(directory, report.filename)
+        if resume and os.path.exists(path):
+            records[report.name] = {"name": report.name, "kind": report.kind, "status": SKIPPED,
+                                    "file": report.filename, "seconds": None}
+        else:
+            pending.append(report)
+
+    if threads:
+        executor = ThreadPoolExecutor(max_workers=workers)
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    total = len(pending)
+    if progress is not None:
+        print(f"{len(records)} reports already written, running {total}", file=progress)
+    with executor:
+        futures = {executor.submit(run_report, report.kind, report.params_dict,
+                                   os.path.join(directory, report.filename), timeout): report
+                   for report in pending}
+        for done, future in enumerate(as_completed(futures), start=1):
+            report = futures[future]
+            record = {"name": report.name, "kind": report.kind, "file": report.filename}
+            try:
+                record.update(status=FINISHED, seconds=round(future.result(), 3))
+            except Exception as err:
+                record.update(status=FAILED, seconds=None, error=str(err))
+            records[report.name] = record
+            if progress is not None:
+                outcome = f"in {record['seconds']}s" if record["status"] == FINISHED else f"failed : {record['error']}"
+                print(f"[{done}/{total}] {report.name} {outcome}", file=progress)
+
+    summary = [records[report.name] for report in reports]
+    with open(os.path.join(directory, SUMMARY_FILENAME), "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+def print_timings(summary, out=sys.stdout):
+    """Prints reports run, slowest first, with counts of each outcome"""
+    run = sorted((r for r in summary if r["seconds"] is not None), key=lambda r: r["seconds"], reverse=True)
+    for record in run:
+        print(f"{record['seconds']:>10.3f}s  {record['name']}", file=out)
+    counts = {status: sum(1 for r in summary if r["status"] == status) for status in (FINISHED, FAILED, SKIPPED)}
+    total_seconds = sum(r["seconds"] for r in run)
+    print(f"{counts[FINISHED]} finished, {counts[FAILED]} failed, {counts[SKIPPED]} skipped, "
+          f"{total_seconds:.3f}s of report time", file=out)
@@ -0,0 +1,69 @@
+# Copyright (C) 2021 Humanitarian OpenStreetmap Team
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Humanitarian OpenStreetmap Team
+# 1100 13th Street NW Suite 800 Washington, D.C. 20005
+# <info@hotosm.org>
+'''galaxy command line
+
+    galaxy batch manifest.json --output reports/ --workers 8
+    galaxy schema check
+'''
+
+import argparse
+import sys
+
+from . import schema
+from .batch import FAILED, print_timings, read_manifest, run_batch
+
+
+def batch(args):
+    try:
+        reports = read_manifest(args.manifest)
+    except (OSError, ValueError) as err:
+        # json errors are ValueError too, the manifest is reported without a traceback
+        print(f"galaxy batch: {err}", file=sys.stderr)
+        return 2
+    summary = run_batch(reports, args.output, workers=args.workers, threads=args.threads,
+                        resume=not args.no_resume, timeout=args.timeout)
+    print_timings(summary)
+    return 1 if any(record["status"] == FAILED for record in summary) else 0
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    # schema keeps its own arguments
+    if argv and argv[0] == "schema":
+        return schema.main(argv[1:])
+
+    parser = argparse.ArgumentParser(prog="galaxy", description="galaxy reports from the command line")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("schema", help="checks and creates indexes used by reports")
+    batch_parser = commands.add_parser("batch", help="runs reports listed in a manifest")
+    batch_parser.add_argument("manifest", help="json list of reports with kind, params and optional name")
+    batch_parser.add_argument("--output", "-o", default="reports", help="directory reports are written to")
+    batch_parser.add_argument("--workers", "-w", type=int, default=4, help="reports run at the same time")
+    batch_parser.add_argument("--threads", action="store_true",
+                              help="run reports in threads instead of processes")
+    batch_parser.add_argument("--no-resume", action="store_true",
+                              help="run reports again even when their file already exists")
+    batch_parser.add_argument("--timeout", type=int, default=0,
+                              help="statement timeout of report queries in seconds, 0 disables it")
+    args = parser.parse_args(argv)
+    return batch(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,3 +2,31 @@ from configparser import ConfigParser
 
 config = ConfigParser()
 config.read("src/config.txt")
+
+# keys of database sections used by galaxy itself, they are not passed to psycopg2
+DATABASE_OPTION_KEYS = ("read_hosts", "max_replication_lag", "health_check_interval")
+
+
+def get_db_params(section):
+    """Returns psycopg2 connection parameters of config section"""
+    return {k: v for k, v in config.items(section) if k not in DATABASE_OPTION_KEYS}
+
+
+def get_read_params(section):
+    """Returns connection parameters of every read replica listed in read_hosts of config section, as host or host:port separated by comma"""
+    primary = get_db_params(section)
+    read_hosts = config.get(section, "read_hosts", fallback="")
+    endpoints = []
+    for read_host in [h.strip() for h in read_hosts.split(",") if h.strip()]:
+        host, _, port = read_host.partition(":")
+        params = dict(primary, host=host)
+        if port:
+            params["port"] = port
+        endpoints.append(params)
+    return endpoints
+
+
+def get_statement_timeout(endpoint):
+    """Returns statement timeout of endpoint in seconds from TIMEOUTS section, falls back to its default key, 0 disables it"""
+    default = config.getint("TIMEOUTS", "default", fallback=0)
+    return config.getint("TIMEOUTS", endpoint, fallback=default)
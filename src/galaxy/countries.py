@@ -0,0 +1,240 @@
+# Copyright (C) 2021 Humanitarian OpenStreetmap Team
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Humanitarian OpenStreetmap Team
+# 1100 13th Street NW Suite 800 Washington, D.C. 20005
+# <info@hotosm.org>
+'''In process spatial index of country boundaries, answers point and bounding box lookups without the database
+
+    index = CountryIndex.load()
+    index.lookup_point(85.32, 27.7)
+    index.lookup_bbox(80.0, 26.0, 89.0, 31.0)
+'''
+
+import json
+import threading
+from array import array
+
+from psycopg2 import connect
+
+from .config import config, get_db_params
+
+# boundaries are simplified by tolerance degrees before they are read, lookups near a border may answer either side within it
+BOUNDARIES_QUERY = """
+    SELECT name, tags -> 'name:iso_a3' AS iso_a3, tags -> 'name:iso_w3' AS iso_w3,
+        ST_AsGeoJSON(ST_SimplifyPreserveTopology(boundary, %(tolerance)s), 7) AS geometry
+    FROM geoboundaries
+    WHERE priority = true
+"""
+
+# horizontal bands of edges per polygon, a point test only reads the edges of its band
+MAX_BANDS = 256
+EDGES_PER_BAND = 8
+
+
+def bbox_of(points):
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+def bboxes_intersect(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def segments_cross(p1, p2, q1, q2):
+    """Whether segments p1 p2 and q1 q2 share a point"""
+    def orientation(a, b, c):
+        value = (b[1] - a[1]) * (c[0] - b[0]) - (b[0] - a[0]) * (c[1] - b[1])
+        return (value > 0) - (value < 0)
+
+    def on_segment(a, b, c):
+        return min(a[0], c[0]) <= b[0] <= max(a[0], c[0]) and min(a[1], c[1]) <= b[1] <= max(a[1], c[1])
+
+    o1, o2 = orientation(p1, p2, q1), orientation(p1, p2, q2)
+    o3, o4 = orientation(q1, q2, p1), orientation(q1, q2, p2)
+    if o1 != o2 and o3 != o4:
+        return True
+    return ((o1 == 0 and on_segment(p1, q1, p2)) or (o2 == 0 and on_segment(p1, q2, p2))
+            or (o3 == 0 and on_segment(q1, p1, q2)) or (o4 == 0 and on_segment(q1, p2, q2)))
+
+
+class Polygon:
+    """Rings of one polygon, exterior and holes, kept only as their edges grouped in horizontal bands
+
+    Each band is a flat array of edge coordinates x1, y1, x2, y2, so a vertex costs a few doubles instead of Python tuples
+    """
+
+    def __init__(self, rings):
+        self.bbox = bbox_of(rings[0])
+        edge_count = sum(len(ring) - 1 for ring in rings)
+        self.band_count = max(1, min(MAX_BANDS, edge_count // EDGES_PER_BAND))
+        self.band_height = (self.bbox[3] - self.bbox[1]) / self.band_count or 1.0
+        self.bands = [array("d") for _ in range(self.band_count)]
+        for ring in rings:
+            for (x1, y1), (x2, y2) in zip(ring, ring[1:]):
+                for band in range(self.band_of(min(y1, y2)), self.band_of(max(y1, y2)) + 1):
+                    self.bands[band].extend((x1, y1, x2, y2))
+
+    def band_of(self, y):
+        band = int((y - self.bbox[1]) / self.band_height)
+        return min(max(band, 0), self.band_count - 1)
+
+    def edges(self, band):
+        values = iter(self.bands[band])
+        return zip(values, values, values, values)
+
+    def contains(self, x, y):
+        """Even odd ray casting over the edges of the band of y, points on the boundary may fall either side"""
+        if not (self.bbox[0] <= x <= self.bbox[2] and self.bbox[1] <= y <= self.bbox[3]):
+            return False
+        inside = False
+        for x1, y1, x2, y2 in self.edges(self.band_of(y)):
+            if (y1 > y) != (y2 > y) and x < (x2 - x1) * (y - y1) / (y2 - y1) + x1:
+                inside = not inside
+        return inside
+
+    def intersects_bbox(self, bbox):
+        minx, miny, maxx, maxy = bbox
+        if not bboxes_intersect(self.bbox, bbox):
+            return False
+        # polygon within the box, or box within the polygon
+        if minx <= self.bbox[0] and self.bbox[2] <= maxx and miny <= self.bbox[1] and self.bbox[3] <= maxy:
+            return True
+        if self.contains(minx, miny):
+            return True
+        corners = [(minx, miny), (maxx, miny), (maxx, maxy), (minx, maxy), (minx, miny)]
+        box_edges = list(zip(corners, corners[1:]))
+        for band in range(self.band_of(miny), self.band_of(maxy) + 1):
+            for x1, y1, x2, y2 in self.edges(band):
+                if minx <= x1 <= maxx and miny <= y1 <= maxy:
+                    return True
+                if not bboxes_intersect((min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)), bbox):
+                    continue
+                if any(segments_cross((x1, y1), (x2, y2), c, d) for c, d in box_edges):
+                    return True
+        return False
+
+
+class STRtree:
+    """Sort tile recursive packed R-tree of (bbox, item), built once and only queried afterwards
+
+    Parameters:
+        entries : list of (bbox, item), bbox as (minx, miny, maxx, maxy)
+        node_capacity : children per node
+    """
+
+    def __init__(self, entries, node_capacity=10):
+        self.node_capacity = node_capacity
+        level = [(bbox, True, item) for bbox, item in entries]
+        while len(level) > node_capacity:
+            level = self.pack(level)
+        self.root = (self.union(level), False, level) if level else None
+
+    @staticmethod
+    def union(nodes):
+        return (min(n[0][0] for n in nodes), min(n[0][1] for n in nodes),
+                max(n[0][2] for n in nodes), max(n[0][3] for n in nodes))
+
+    def pack(self, nodes):
+        """Groups nodes in parents, tiles sorted by x then runs sorted by y within each tile"""
+        parent_count = -(-len(nodes) // self.node_capacity)
+        slice_count = max(1, int(parent_count ** 0.5 + 0.999999))
+        slice_size = slice_count * self.node_capacity
+        nodes = sorted(nodes, key=lambda n: (n[0][0] + n[0][2]) / 2)
+        parents = []
+        for start in range(0, len(nodes), slice_size):
+            tile = sorted(nodes[start:start + slice_size], key=lambda n: (n[0][1] + n[0][3]) / 2)
+            for child_start in range(0, len(tile), self.node_capacity):
+                children = tile[child_start:child_start + self.node_capacity]
+                parents.append((self.union(children), False, children))
+        return parents
+
+    def query(self, bbox):
+        """Yields items whose bbox intersects bbox"""
+        if self.root is None:
+            return
+        stack = [self.root]
+        while stack:
+            node_bbox, is_leaf, content = stack.pop()
+            if not bboxes_intersect(node_bbox, bbox):
+                continue
+            if is_leaf:
+                yield content
+            else:
+                stack.extend(content)
+
+
+class CountryIndex:
+    """Priority boundaries of geoboundaries indexed in memory, every polygon of a country is a separate entry of the tree so far away parts do not widen its bbox
+
+    Parameters:
+        countries : list of (country, geojson geometry), country is a dict with name and iso3
+    """
+
+    instance = None
+    instance_lock = threading.Lock()
+
+    def __init__(self, countries):
+        self.countries = [country for country, _ in countries]
+        entries = []
+        for position, (_, geometry) in enumerate(countries):
+            if geometry["type"] == "Polygon":
+                parts = [geometry["coordinates"]]
+            elif geometry["type"] == "MultiPolygon":
+                parts = geometry["coordinates"]
+            else:
+                continue
+            for rings in parts:
+                polygon = Polygon([[tuple(p[:2]) for p in ring] for ring in rings])
+                entries.append((polygon.bbox, (position, polygon)))
+        self.tree = STRtree(entries)
+
+    @classmethod
+    def from_database(cls, db_params=None, tolerance=None):
+        """Reads priority boundaries simplified by tolerance degrees, [COUNTRIES] simplify_tolerance by default, from the database of PG section by default"""
+        if tolerance is None:
+            tolerance = config.getfloat("COUNTRIES", "simplify_tolerance", fallback=0.001)
+        conn = connect(**(db_params or get_db_params("PG")))
+        try:
+            with conn.cursor() as cur:
+                cur.execute(BOUNDARIES_QUERY, {"tolerance": tolerance})
+                rows = cur.fetchall()
+        finally:
+            conn.close()
+        return cls([({"name": name, "iso3": iso_a3 or iso_w3}, json.loads(geometry))
+                    for name, iso_a3, iso_w3, geometry in rows if geometry is not None])
+
+    @classmethod
+    def load(cls, reload=False):
+        """Returns the index shared by the process, read from the database on first use"""
+        with cls.instance_lock:
+            if cls.instance is None or reload:
+                cls.instance = cls.from_database()
+            return cls.instance
+
+    def matches(self, positions):
+        return [self.countries[p] for p in sorted(positions)]
+
+    def lookup_point(self, lon, lat):
+        """Countries containing the point"""
+        return self.matches({position for position, polygon in self.tree.query((lon, lat, lon, lat))
+                             if polygon.contains(lon, lat)})
+
+    def lookup_bbox(self, minx, miny, maxx, maxy):
+        """Countries intersecting the bounding box"""
+        bbox = (minx, miny, maxx, maxy)
+        return self.matches({position for position, polygon in self.tree.query(bbox)
+                             if polygon.intersects_bbox(bbox)})
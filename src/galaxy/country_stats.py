@@ -0,0 +1,313 @@
+# Copyright (C) 2021 Humanitarian OpenStreetmap Team
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Humanitarian OpenStreetmap Team
+# 1100 13th Street NW Suite 800 Washington, D.C. 20005
+# <info@hotosm.org>
+'''Changesets assigned to the countries their bbox intersects and daily statistics per country, kept up to date incrementally from underpass changesets'''
+
+from datetime import datetime, time, timedelta
+
+from psycopg2 import connect
+
+from .config import config, get_db_params
+
+CREATE_STATS_TABLES = """
+    CREATE TABLE IF NOT EXISTS changeset_country (
+        changeset_id bigint NOT NULL,
+        country text NOT NULL,
+        created_at timestamp NOT NULL,
+        user_id bigint,
+        hashtags text[],
+        added_highway numeric NOT NULL DEFAULT 0,
+        modified_highway numeric NOT NULL DEFAULT 0,
+        deleted_highway numeric NOT NULL DEFAULT 0,
+        added_highway_km numeric NOT NULL DEFAULT 0,
+        modified_highway_km numeric NOT NULL DEFAULT 0,
+        deleted_highway_km numeric NOT NULL DEFAULT 0,
+        PRIMARY KEY (changeset_id, country)
+    );
+    CREATE INDEX IF NOT EXISTS changeset_country_country_created_at_idx
+        ON changeset_country (country, created_at);
+    CREATE INDEX IF NOT EXISTS changeset_country_created_at_idx
+        ON changeset_country (created_at);
+    CREATE TABLE IF NOT EXISTS country_daily_stats (
+        country text NOT NULL,
+        day date NOT NULL,
+        changesets bigint NOT NULL,
+        added_highway numeric NOT NULL,
+        modified_highway numeric NOT NULL,
+        deleted_highway numeric NOT NULL,
+        added_highway_km numeric NOT NULL,
+        modified_highway_km numeric NOT NULL,
+        deleted_highway_km numeric NOT NULL,
+        PRIMARY KEY (country, day)
+    );
+    CREATE TABLE IF NOT EXISTS country_daily_contributors (
+        country text NOT NULL,
+        day date NOT NULL,
+        user_id bigint NOT NULL,
+        PRIMARY KEY (country, day, user_id)
+    );
+    CREATE TABLE IF NOT EXISTS changeset_country_state (
+        id boolean PRIMARY KEY DEFAULT true CHECK (id),
+        last_created_at timestamp,
+        last_id bigint NOT NULL DEFAULT 0
+    );
+    INSERT INTO changeset_country_state (last_id) VALUES (0)
+        ON CONFLICT DO NOTHING;
+"""
+
+# changesets are paged by creation time, they keep changing while open so recent ones are read again
+# the order is served by changesets_created_at_id_idx declared in galaxy.schema
+SELECT_BATCH = """
+    CREATE TEMPORARY TABLE changeset_country_batch ON COMMIT DROP AS
+    SELECT id, user_id, created_at, hashtags, bbox, added, modified, deleted
+    FROM changesets
+    WHERE (created_at, id) > (%(since)s, %(since_id)s)
+    ORDER BY created_at, id
+    LIMIT %(batch_size)s
+"""
+
+ASSIGN_BATCH = """
+    DELETE FROM changeset_country AS cc
+    USING changeset_country_batch AS b
+    WHERE cc.changeset_id = b.id;
+
+    INSERT INTO changeset_country (changeset_id, country, created_at, user_id, hashtags,
+        added_highway, modified_highway, deleted_highway,
+        added_highway_km, modified_highway_km, deleted_highway_km)
+    SELECT b.id, g.name, b.created_at, b.user_id, b.hashtags,
+        coalesce((b.added -> 'highway')::numeric, 0),
+        coalesce((b.modified -> 'highway')::numeric, 0),
+        coalesce((b.deleted -> 'highway')::numeric, 0),
+        coalesce((b.added -> 'highway_km')::numeric, 0),
+        coalesce((b.modified -> 'highway_km')::numeric, 0),
+        coalesce((b.deleted -> 'highway_km')::numeric, 0)
+    FROM changeset_country_batch AS b
+    JOIN geoboundaries AS g ON g.priority = true AND ST_Intersects(b.bbox, g.boundary)
+    WHERE b.bbox IS NOT NULL
+    ON CONFLICT DO NOTHING;
+"""
+
+# days of the batch are rebuilt from changeset_country, so daily rows never drift from it
+REBUILD_DAYS = """
+    DELETE FROM country_daily_stats WHERE day BETWEEN %(first_day)s AND %(last_day)s;
+    DELETE FROM country_daily_contributors WHERE day BETWEEN %(first_day)s AND %(last_day)s;
+
+    INSERT INTO country_daily_stats
+    SELECT country, created_at::date, count(*),
+        sum(added_highway), sum(modified_highway), sum(deleted_highway),
+        sum(added_highway_km), sum(modified_highway_km), sum(deleted_highway_km)
+    FROM changeset_country
+    WHERE created_at >= %(first_day)s AND created_at < %(last_day)s::date + 1
+    GROUP BY country, created_at::date;
+
+    INSERT INTO country_daily_contributors
+    SELECT DISTINCT country, created_at::date, user_id
+    FROM changeset_country
+    WHERE created_at >= %(first_day)s AND created_at < %(last_day)s::date + 1 AND user_id IS NOT NULL;
+"""
+
+UPDATE_LOCK_ID = 7245303
+
+
+class CountryStatsIndex:
+    """changeset_country, country_daily_stats and country_daily_contributors tables of the underpass database
+
+    Changesets are read in creation order after the one recorded in changeset_country_state. Changesets created less than lookback before it are read again on each update, as their bbox and counts change until they are closed. Their country rows are replaced and the days they fall in are rebuilt
+
+    Parameters:
+        batch_size : changesets processed per transaction
+        lookback : timedelta of changesets read again
+        db_params : connection parameters, PG section by default
+    """
+
+    def __init__(self, batch_size=20000, lookback=timedelta(hours=2), db_params=None):
+        self.batch_size = batch_size
+        self.lookback = lookback
+        self.db_params = db_params
+
+    @classmethod
+    def from_config(cls):
+        return cls(batch_size=config.getint("COUNTRY_STATS", "batch_size", fallback=20000),
+                   lookback=timedelta(seconds=config.getint("COUNTRY_STATS", "lookback", fallback=7200)))
+
+    @staticmethod
+    def enabled():
+        """Whether /changesets answers country requests from the tables"""
+        return config.getboolean("COUNTRY_STATS", "enabled", fallback=False)
+
+    def connect(self):
+        return connect(**(self.db_params or get_db_params("PG")))
+
+    def create(self):
+        """Creates tables when they are missing"""
+        conn = self.connect()
+        try:
+            with conn, conn.cursor() as cur:
+                cur.execute(CREATE_STATS_TABLES)
+        finally:
+            conn.close()
+
+    def update(self):
+        """Assigns changesets created or changed since last update, returns number of changesets read or None when another update is running"""
+        conn = self.connect()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_try_advisory_lock(%s)", (UPDATE_LOCK_ID,))
+                if not cur.fetchone()[0]:
+                    return None
+                conn.commit()
+                try:
+                    return self.update_batches(conn, cur)
+                finally:
+                    cur.execute("SELECT pg_advisory_unlock(%s)", (UPDATE_LOCK_ID,))
+                    conn.commit()
+        finally:
+            conn.close()
+
+    def update_batches(self, conn, cur):
+        cur.execute("SELECT last_created_at FROM changeset_country_state")
+        last_created_at = cur.fetchone()[0]
+        if last_created_at is None:
+            since, since_id = datetime.min, 0
+        else:
+            since, since_id = last_created_at - self.lookback, 0
+        processed = 0
+        while True:
+            cur.execute(SELECT_BATCH, {"since": since, "since_id": since_id, "batch_size": self.batch_size})
+            cur.execute("""SELECT count(*), min(created_at)::date, max(created_at)::date
+                FROM changeset_country_batch""")
+            count, first_day, last_day = cur.fetchone()
+            if count == 0:
+                conn.commit()
+                break
+            cur.execute("""SELECT created_at, id FROM changeset_country_batch
+                ORDER BY created_at DESC, id DESC LIMIT 1""")
+            max_created_at, max_id = cur.fetchone()
+            cur.execute(ASSIGN_BATCH)
+            cur.execute(REBUILD_DAYS, {"first_day": first_day, "last_day": last_day})
+            cur.execute("""UPDATE changeset_country_state
+                SET last_created_at = greatest(last_created_at, %s), last_id = %s""",
+                        (max_created_at, max_id))
+            conn.commit()
+            processed += count
+            since, since_id = max_created_at, max_id
+            if count < self.batch_size:
+                break
+        return processed
+
+
+def as_datetime(value):
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime.combine(value, time.min)
+
+
+def full_days(start, end):
+    """Returns (first, last) day bounds of the days entirely inside (start, end], None bounds are open and None is returned when no day fits
+
+    start is exclusive, a changeset created at its midnight is not part of the range so the first full day is always the next one
+    """
+    first = None if start is None else start.date() + timedelta(days=1)
+    last = None if end is None else end.date()
+    if first is not None and last is not None and first >= last:
+        return None
+    return first, last
+
+
+def create_country_names_query(iso3, cur):
+    """Priority geoboundaries countries of an iso3 code, changesets are assigned to those only"""
+    return cur.mogrify("""SELECT name FROM geoboundaries
+        WHERE priority = true AND (tags -> 'name:iso_w3' = %s OR tags -> 'name:iso_a3' = %s)
+        ORDER BY name""", (iso3, iso3)).decode()
+
+
+def create_country_stats_query(names, start, end, hashtag, cur):
+    """/changesets result of countries read from the aggregate tables
+
+    Days entirely inside the range come from country_daily_stats and country_daily_contributors, the partial days at both ends from changeset_country. Hashtag filters are not kept per day, they read changeset_country for the whole range
+    """
+    start, end = as_datetime(start), as_datetime(end)
+    days = None if hashtag is not None else full_days(start, end)
+
+    partial_filters = [cur.mogrify("country = ANY(%s)", (list(names),)).decode()]
+    if hashtag is not None:
+        partial_filters.append(cur.mogrify("%s = ANY(hashtags)", (hashtag,)).decode())
+    if days is None:
+        if start is not None:
+            partial_filters.append(cur.mogrify("created_at > %s", (start,)).decode())
+        if end is not None:
+            partial_filters.append(cur.mogrify("created_at <= %s", (end,)).decode())
+    else:
+        first, last = days
+        edges = []
+        if first is not None:
+            edges.append(cur.mogrify("(created_at > %s AND created_at < %s)", (start, first)).decode())
+        if last is not None:
+            edges.append(cur.mogrify("(created_at >= %s AND created_at <= %s)", (last, end)).decode())
+        partial_filters.append(f"({' OR '.join(edges)})" if edges else "false")
+
+    day_filters = [cur.mogrify("country = ANY(%s)", (list(names),)).decode()]
+    if days is None:
+        day_filters.append("false")
+    else:
+        first, last = days
+        if first is not None:
+            day_filters.append(cur.mogrify("day >= %s", (first,)).decode())
+        if last is not None:
+            day_filters.append(cur.mogrify("day < %s", (last,)).decode())
+
+    partial_where = " AND ".join(partial_filters)
+    day_where = " AND ".join(day_filters)
+    return f"""WITH partial AS (
+            SELECT country, user_id, added_highway, modified_highway, deleted_highway,
+                added_highway_km, modified_highway_km, deleted_highway_km
+            FROM changeset_country
+            WHERE {partial_where}
+        ),
+        totals AS (
+            SELECT country, changesets, added_highway, modified_highway, deleted_highway,
+                added_highway_km, modified_highway_km, deleted_highway_km
+            FROM country_daily_stats
+            WHERE {day_where}
+            UNION ALL
+            SELECT country, 1, added_highway, modified_highway, deleted_highway,
+                added_highway_km, modified_highway_km, deleted_highway_km
+            FROM partial
+        ),
+        contributors AS (
+            SELECT country, count(DISTINCT user_id) AS contributors
+            FROM (
+                SELECT country, user_id FROM country_daily_contributors WHERE {day_where}
+                UNION ALL
+                SELECT country, user_id FROM partial
+            ) AS users
+            GROUP BY country
+        )
+        SELECT totals.country AS name,
+            sum(changesets) AS total_changesets,
+            coalesce(max(contributors.contributors), 0) AS contributors,
+            sum(added_highway) AS added_highway,
+            sum(modified_highway) AS modified_highway,
+            sum(deleted_highway) AS deleted_highway,
+            sum(added_highway_km) / 1000 AS added_highway_km,
+            sum(modified_highway_km) / 1000 AS modified_highway_km,
+            sum(deleted_highway_km) / 1000 AS deleted_highway_km
+        FROM totals
+        LEFT JOIN contributors ON contributors.country = totals.country
+        GROUP BY totals.country
+        ORDER BY totals.country"""
@@ -0,0 +1,142 @@
+# Copyright (C) 2021 Humanitarian OpenStreetmap Team
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Humanitarian OpenStreetmap Team
+# 1100 13th Street NW Suite 800 Washington, D.C. 20005
+# <info@hotosm.org>
+'''Inverted index of Insight changeset hashtags, kept up to date incrementally from osm_changeset'''
+
+from psycopg2 import connect
+
+from .config import config, get_db_params
+
+CREATE_INDEX_TABLES = """
+    CREATE TABLE IF NOT EXISTS changeset_hashtag (
+        hashtag text NOT NULL,
+        changeset_id bigint NOT NULL,
+        created_at timestamp NOT NULL,
+        PRIMARY KEY (hashtag, created_at, changeset_id)
+    );
+    CREATE INDEX IF NOT EXISTS changeset_hashtag_changeset_id_idx
+        ON changeset_hashtag (changeset_id);
+    CREATE TABLE IF NOT EXISTS changeset_hashtag_state (
+        id boolean PRIMARY KEY DEFAULT true CHECK (id),
+        last_changeset_id bigint NOT NULL
+    );
+    INSERT INTO changeset_hashtag_state (last_changeset_id) VALUES (0)
+        ON CONFLICT DO NOTHING;
+"""
+
+# hashtags field is split on ; and hashtags written in the comment are added, leading # is dropped
+UPDATE_INDEX_BATCH = """
+    WITH batch AS (
+        SELECT id, created_at, tags
+        FROM osm_changeset
+        WHERE id > %(since)s
+        ORDER BY id
+        LIMIT %(batch_size)s),
+    hashtags AS (
+        SELECT id, created_at, ltrim(trim(h), '#') AS hashtag
+        FROM batch, unnest(string_to_array(tags -> 'hashtags', ';')) AS h
+        UNION
+        SELECT id, created_at, m[1] AS hashtag
+        FROM batch, regexp_matches(tags -> 'comment', '#([^\\s#;,]+)', 'g') AS m),
+    inserted AS (
+        INSERT INTO changeset_hashtag (hashtag, changeset_id, created_at)
+        SELECT hashtag, id, created_at FROM hashtags
+        WHERE hashtag <> '' AND created_at IS NOT NULL
+        ON CONFLICT DO NOTHING)
+    SELECT max(id), count(*) FROM batch
+"""
+
+# any fixed number shared by every updater, only one of them runs at a time
+UPDATE_LOCK_ID = 7245301
+
+
+class ChangesetHashtagIndex:
+    """changeset_hashtag table of Insight database, one row per changeset and hashtag so hashtag filters are indexed equality lookups within a time range
+
+    Changesets are processed in id order after the id recorded in changeset_hashtag_state. The last overlap ids are read again on each update so changesets replicated slightly out of order are not missed
+
+    Parameters:
+        batch_size : changesets processed per transaction
+        overlap : ids before the recorded one read again
+        db_params : connection parameters, primary of INSIGHTS_PG by default
+    """
+
+    def __init__(self, batch_size=50000, overlap=1000, db_params=None):
+        self.batch_size = batch_size
+        self.overlap = overlap
+        self.db_params = db_params
+
+    @classmethod
+    def from_config(cls):
+        return cls(batch_size=config.getint("HASHTAG_INDEX", "batch_size", fallback=50000),
+                   overlap=config.getint("HASHTAG_INDEX", "overlap", fallback=1000))
+
+    @staticmethod
+    def enabled():
+        """Whether query builders filter hashtags through the index"""
+        return config.getboolean("HASHTAG_INDEX", "enabled", fallback=False)
+
+    def connect(self):
+        # writes go to the primary, never to read replicas
+        return connect(**(self.db_params or get_db_params("INSIGHTS_PG")))
+
+    def create(self):
+        """Creates index tables when they are missing"""
+        conn = self.connect()
+        try:
+            with conn, conn.cursor() as cur:
+                cur.execute(CREATE_INDEX_TABLES)
+        finally:
+            conn.close()
+
+    def update(self):
+        """Indexes changesets added since last update, returns number of changesets read or None when another update is running"""
+        conn = self.connect()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_try_advisory_lock(%s)", (UPDATE_LOCK_ID,))
+                if not cur.fetchone()[0]:
+                    return None
+                conn.commit()
+                try:
+                    return self.update_batches(conn, cur)
+                finally:
+                    cur.execute("SELECT pg_advisory_unlock(%s)", (UPDATE_LOCK_ID,))
+                    conn.commit()
+        finally:
+            conn.close()
+
+    def update_batches(self, conn, cur):
+        cur.execute("SELECT last_changeset_id FROM changeset_hashtag_state")
+        last_id = cur.fetchone()[0]
+        since = max(0, last_id - self.overlap)
+        processed = 0
+        while True:
+            cur.execute(UPDATE_INDEX_BATCH, {"since": since, "batch_size": self.batch_size})
+            max_id, count = cur.fetchone()
+            if max_id is None:
+                conn.commit()
+                break
+            processed += count
+            cur.execute("UPDATE changeset_hashtag_state SET last_changeset_id = greatest(last_changeset_id, %s)",
+                        (max_id,))
+            conn.commit()
+            since = max_id
+            if count < self.batch_size:
+                break
+        return processed
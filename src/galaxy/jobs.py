@@ -0,0 +1,317 @@
+# Copyright (C) 2021 Humanitarian OpenStreetmap Team
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Humanitarian OpenStreetmap Team
+# 1100 13th Street NW Suite 800 Washington, D.C. 20005
+# <info@hotosm.org>
+'''Report jobs run in a worker process pool, results are written to local files for later download'''
+
+import json
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from uuid import uuid4
+
+from .app import (DataQuality, DataQualityHashtags, Mapathon, json_default,
+                  report_json_default)
+from .cache import cache_key
+from .config import config
+from .validation.models import (DataQuality_TM_RequestParams,
+                                DataQuality_username_RequestParams,
+                                DataQualityHashtagParams,
+                                MapathonRequestParams, OutputType)
+
+QUEUED = "queued"
+RUNNING = "running"
+FINISHED = "finished"
+FAILED = "failed"
+
+MEDIA_TYPES = {
+    OutputType.CSV.value: "text/csv",
+    OutputType.GEOJSON.value: "application/geo+json",
+    OutputType.NDJSON.value: "application/x-ndjson",
+    OutputType.ARROW.value: "application/vnd.apache.arrow.stream",
+    OutputType.PARQUET.value: "application/vnd.apache.parquet",
+    OutputType.GRID.value: "application/geo+json",
+    "json": "application/json",
+}
+
+
+def write_chunks(chunks, path):
+    with open(path, "wb") as f:
+        for chunk in chunks:
+            f.write(chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+
+
+def write_json(result, path, default=json_default):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(result, f, default=default)
+
+
+def export_data_quality(report, output_type, path):
+    """Writes DataQuality or DataQualityHashtags report in output_type to path"""
+    if output_type == OutputType.NDJSON.value:
+        write_chunks(report.get_report_as_geojson_seq(), path)
+    elif output_type in (OutputType.ARROW.value, OutputType.PARQUET.value):
+        write_chunks(report.get_report_as_columnar(output_type), path)
+    elif output_type == OutputType.GRID.value:
+        write_json(report.get_report_as_grid(), path)
+    elif output_type == OutputType.GEOJSON.value:
+        write_json(report.get_report(), path)
+    elif isinstance(report, DataQualityHashtags):
+        write_chunks(DataQualityHashtags.to_csv_stream(report.get_report()), path)
+    else:
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            result = report.get_report_as_csv(f)
+        if isinstance(result, Exception):
+            raise result
+
+
+def run_data_quality_project(params, path):
+    export_data_quality(DataQuality(params, "TM"), params.output_type, path)
+
+
+def run_data_quality_user(params, path):
+    export_data_quality(DataQuality(params, "username"), params.output_type, path)
+
+
+def run_data_quality_hashtag(params, path):
+    export_data_quality(DataQualityHashtags(params), params.output_type, path)
+
+
+def run_mapathon_detail(params, path):
+    write_json(Mapathon(params, "insight").get_detailed_report().dict(by_alias=True), path,
+               default=report_json_default)
+
+
+def run_mapathon_summary(params, path):
+    source = "underpass" if params.source == "underpass" else "insight"
+    write_json(Mapathon(params, source).get_summary().dict(by_alias=True), path,
+               default=report_json_default)
+
+
+# job kind : (parameter model, function writing the report to a path)
+JOB_KINDS = {
+    "data-quality-project": (DataQuality_TM_RequestParams, run_data_quality_project),
+    "data-quality-user": (DataQuality_username_RequestParams, run_data_quality_user),
+    "data-quality-hashtag": (DataQualityHashtagParams, run_data_quality_hashtag),
+    "mapathon-detail": (MapathonRequestParams, run_mapathon_detail),
+    "mapathon-summary": (MapathonRequestParams, run_mapathon_summary),
+}
+
+
+# output types whose files are named after another format
+FILE_EXTENSIONS = {OutputType.GRID.value: "geojson"}
+
+
+def output_type_of(params):
+    return getattr(params, "output_type", None) or "json"
+
+
+def file_extension_of(params):
+    output_type = output_type_of(params)
+    return FILE_EXTENSIONS.get(output_type, output_type)
+
+
+def write_status(directory, job):
+    """Writes job status file atomically, so any web worker reading it sees a whole document"""
+    path = os.path.join(directory, f"{job['id']}.json")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(job, f)
+    os.replace(tmp_path, path)
+
+
+def run_job(directory, job):
+    """Entry point of worker processes, runs the report of job and records its outcome in the status file"""
+    job = dict(job, status=RUNNING, startedAt=datetime.utcnow().isoformat())
+    write_status(directory, job)
+    model, run = JOB_KINDS[job["kind"]]
+    path = os.path.join(directory, job["filename"])
+    tmp_path = f"{path}.tmp"
+    try:
+        run(model(**job["params"]), tmp_path)
+        os.replace(tmp_path, path)
+        job.update(status=FINISHED)
+    except Exception as err:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        job.update(status=FAILED, error=str(err))
+    job["finishedAt"] = datetime.utcnow().isoformat()
+    write_status(directory, job)
+    return job["status"]
+
+
+class JobQueue:
+    """Queue of report jobs run by a pool of worker processes, so web workers never hold a database connection for long exports
+
+    Job status and result live in directory, a job submitted by one web worker can be polled and downloaded through any other. Submitting the same kind, parameters and owner as a queued or running job returns that job instead of starting another one, whichever web worker queued it: the job of a key is recorded in a pending file of directory claimed atomically
+
+    Parameters:
+        directory : where status files and results are written
+        max_workers : worker processes running reports
+        result_ttl : seconds status files and results are kept once the job is done
+    """
+
+    def __init__(self, directory, max_workers=2, result_ttl=86400):
+        self.directory = directory
+        self.max_workers = max_workers
+        self.result_ttl = result_ttl
+        self.executor = None
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def from_config(cls):
+        return cls(config.get("JOBS", "directory", fallback="/tmp/galaxy-jobs"),
+                   max_workers=config.getint("JOBS", "workers", fallback=2),
+                   result_ttl=config.getint("JOBS", "result_ttl", fallback=86400))
+
+    def get_executor(self):
+        if self.executor is None:
+            # spawn, forking a threaded web server can leave locks held in children
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"))
+        return self.executor
+
+    def pending_path(self, key):
+        return os.path.join(self.directory, f"{key}.pending")
+
+    def claim(self, key, job_id):
+        """Records job_id as the job of key unless another job holds it, returns the job id holding key"""
+        path = self.pending_path(key)
+        tmp_path = f"{path}.{job_id}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(job_id)
+        try:
+            # link fails when the pending file exists, it appears with its content or not at all
+            os.link(tmp_path, path)
+            return job_id
+        except FileExistsError:
+            try:
+                with open(path, encoding="utf-8") as f:
+                    return f.read()
+            except FileNotFoundError:
+                # released meanwhile, the caller claims again
+                return None
+        finally:
+            os.remove(tmp_path)
+
+    def release(self, key, job_id):
+        """Removes pending file of key when job_id still holds it"""
+        path = self.pending_path(key)
+        released = f"{path}.{job_id}.released"
+        try:
+            # moved away first so a pending file claimed by another job meanwhile is not removed
+            os.rename(path, released)
+        except FileNotFoundError:
+            return
+        with open(released, encoding="utf-8") as f:
+            holder = f.read()
+        if holder != job_id:
+            try:
+                os.link(released, path)
+            except FileExistsError:
+                pass
+        os.remove(released)
+
+    def submit(self, kind, params, owner=None):
+        """Queues report of kind with validated params model, returns job status. owner is the id of the user the job belongs to, None when anyone may read it"""
+        if kind not in JOB_KINDS:
+            raise ValueError(f"Job kind {kind} is not supported")
+        params_dict = json.loads(params.json())
+        key = cache_key(kind, params_dict, owner)
+
+        with self.lock:
+            self.cleanup()
+            job_id = uuid4().hex
+            output_type = output_type_of(params)
+            job = {
+                "id": job_id,
+                "kind": kind,
+                "params": params_dict,
+                "owner": owner,
+                "status": QUEUED,
+                # results never share the name of status files, json reports included
+                "filename": f"{job_id}.result.{file_extension_of(params)}",
+                "mediaType": MEDIA_TYPES[output_type],
+                "createdAt": datetime.utcnow().isoformat(),
+            }
+            # status exists before the job is claimed, other workers never see a claimed job without status
+            write_status(self.directory, job)
+            while True:
+                holder = self.claim(key, job_id)
+                if holder == job_id:
+                    break
+                existing = None if holder is None else self.status(holder)
+                if existing is not None and existing["status"] in (QUEUED, RUNNING):
+                    os.remove(os.path.join(self.directory, f"{job_id}.json"))
+                    return existing
+                if holder is not None:
+                    # job of the pending file is done or gone
+                    self.release(key, holder)
+            future = self.get_executor().submit(run_job, self.directory, job)
+            future.add_done_callback(lambda f: self.done(key, job_id, f))
+        return job
+
+    def done(self, key, job_id, future):
+        self.release(key, job_id)
+        error = future.exception()
+        if error is not None:
+            # worker died before it could record the outcome
+            job = self.status(job_id) or {"id": job_id}
+            job.update(status=FAILED, error=str(error))
+            write_status(self.directory, job)
+
+    def status(self, job_id):
+        """Returns job status document, None when job does not exist"""
+        if not job_id.isalnum():
+            return None
+        try:
+            with open(os.path.join(self.directory, f"{job_id}.json"), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def result_path(self, job_id):
+        """Returns path of finished job result, None when job is missing or not finished"""
+        job = self.status(job_id)
+        if job is None or job["status"] != FINISHED:
+            return None
+        return os.path.join(self.directory, job["filename"])
+
+    def cleanup(self):
+        """Removes status files and results of jobs done more than result_ttl seconds ago"""
+        expire_before = time.time() - self.result_ttl
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not name.endswith(".json") or os.path.getmtime(path) > expire_before:
+                continue
+            job_id = name[:-len(".json")]
+            job = self.status(job_id)
+            if job is None or job["status"] not in (FINISHED, FAILED):
+                continue
+            for job_file in (path, os.path.join(self.directory, job["filename"])):
+                if os.path.exists(job_file):
+                    os.remove(job_file)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
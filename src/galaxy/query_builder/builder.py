@@ -19,6 +19,7 @@
 
 from psycopg2 import sql
 from json import dumps
+from ..hashtag_index import ChangesetHashtagIndex
 
 HSTORE_COLUMN = "tags"
 
@@ -72,6 +73,21 @@ def create_hashtag_filter_query(project_ids, hashtags, cur, conn):
     return hashtag_filter
 
 
+def create_changeset_hashtag_filter(project_ids, hashtags, from_timestamp, to_timestamp, cur, conn):
+    """returns hashtag filter of osm_changeset, an indexed lookup in changeset_hashtag within the time range when the index is enabled in config, pattern matching on tags otherwise
+
+    Changesets newer than the last one indexed are matched on their tags, so windows ending near now, or after a failed index update, miss nothing
+    """
+    pattern_filter = create_hashtag_filter_query(project_ids, hashtags, cur, conn)
+    if not ChangesetHashtagIndex.enabled():
+        return pattern_filter
+
+    values = [*[f"hotosm-project-{i}" for i in project_ids], *hashtags]
+    indexed_filter = cur.mogrify("""id IN (SELECT changeset_id FROM changeset_hashtag WHERE hashtag = ANY(%s::text[]) AND created_at BETWEEN %s AND %s)""",
+                                 (values, from_timestamp, to_timestamp)).decode()
+    return f"""{indexed_filter} OR (id > (SELECT last_changeset_id FROM changeset_hashtag_state) AND ({pattern_filter}))"""
+
+
 def create_timestamp_filter_query(column_name,from_timestamp, to_timestamp, cur):
     '''returns timestamp filter query '''
 
@@ -85,11 +101,23 @@ def create_timestamp_filter_query(column_name,from_timestamp, to_timestamp, cur)
     return timestamp_filter
 
 
+def create_increment_timestamp_filter_query(column_name, since, params, cur):
+    """returns filter of rows newer than since, since itself is excluded as it was already processed. since None is the whole mapathon window"""
+    if since is None:
+        return create_timestamp_filter_query(column_name, params.from_timestamp,
+                                             params.to_timestamp, cur)
+    to_timestamp = params.to_timestamp
+    timestamp_filter = sql.SQL("{timestamp_column} > %s AND {timestamp_column} <= %s").format(
+        timestamp_column=sql.Identifier(column_name))
+    return cur.mogrify(timestamp_filter, (since, to_timestamp)).decode()
+
+
 def create_changeset_query(params, conn, cur):
     '''returns the changeset query'''
 
-    hashtag_filter = create_hashtag_filter_query(params.project_ids,
-                                                 params.hashtags, cur, conn)
+    hashtag_filter = create_changeset_hashtag_filter(params.project_ids, params.hashtags,
+                                                     params.from_timestamp,
+                                                     params.to_timestamp, cur, conn)
     timestamp_filter = create_timestamp_filter_query("created_at",params.from_timestamp,
                                                      params.to_timestamp, cur)
 
@@ -102,6 +130,74 @@ def create_changeset_query(params, conn, cur):
     return changeset_query, hashtag_filter, timestamp_filter
 
 
+def create_mapathon_increment_query(params, since, conn, cur):
+    """returns query of mapathon changesets created after since ( None for all ) with the features of their elements, one row per changeset and element"""
+    hashtag_filter = create_changeset_hashtag_filter(
+        params.project_ids, params.hashtags,
+        params.from_timestamp if since is None else since, params.to_timestamp, cur, conn)
+    timestamp_filter = create_increment_timestamp_filter_query(
+        "created_at", since, params, cur)
+
+    query = f"""
+    WITH t1 AS (
+        SELECT id as changeset_id, user_id, created_at
+        FROM osm_changeset
+        WHERE {timestamp_filter} AND ({hashtag_filter}))
+    SELECT t1.changeset_id, t1.user_id, t1.created_at, t2.feature, t2.action, t2.id
+    FROM t1 LEFT JOIN LATERAL (
+        SELECT (each({HSTORE_COLUMN})).key AS feature, action, id
+        FROM osm_element_history WHERE changeset = t1.changeset_id
+    ) AS t2 ON true
+    """
+
+    return query
+
+
+def create_mapathon_events_column(event_filters):
+    """returns array of the positions of events whose filter matches the row"""
+    cases = ", ".join(f"CASE WHEN {event_filter} THEN {position} END"
+                      for position, event_filter in enumerate(event_filters))
+    return f"ARRAY_REMOVE(ARRAY[{cases}], NULL)"
+
+
+def create_multi_mapathon_summary_query(events, conn, cur):
+    """returns summary query of several mapathons evaluated together, changesets matching any event are read once with their elements and tagged with the position of every event they match
+
+    Rows are event, feature, action, count, plus one row per event with NULL feature and action whose count is its number of contributors
+    """
+    event_filters = []
+    for event in events:
+        hashtag_filter = create_changeset_hashtag_filter(event.project_ids, event.hashtags,
+                                                         event.from_timestamp,
+                                                         event.to_timestamp, cur, conn)
+        timestamp_filter = create_timestamp_filter_query("created_at", event.from_timestamp,
+                                                         event.to_timestamp, cur)
+        event_filters.append(f"({timestamp_filter} AND ({hashtag_filter}))")
+    window_filter = create_timestamp_filter_query("created_at",
+                                                  min(e.from_timestamp for e in events),
+                                                  max(e.to_timestamp for e in events), cur)
+    any_event_filter = " OR ".join(event_filters)
+
+    query = f"""
+    WITH t1 AS (
+        SELECT id as changeset_id, user_id, {create_mapathon_events_column(event_filters)} AS events
+        FROM osm_changeset
+        WHERE {window_filter} AND ({any_event_filter}))
+    SELECT event, t3.key AS feature, t2.action, count(distinct t2.id) AS count
+    FROM t1 JOIN osm_element_history AS t2 ON t2.changeset = t1.changeset_id,
+    unnest(t1.events) AS event,
+    LATERAL each(t2.{HSTORE_COLUMN}) AS t3
+    GROUP BY event, t3.key, t2.action
+    UNION ALL
+    SELECT event, NULL, NULL, COUNT(distinct user_id)
+    FROM t1, unnest(t1.events) AS event
+    GROUP BY event
+    ORDER BY event, count DESC
+    """
+
+    return query
+
+
 def create_osm_history_query(changeset_query, with_username):
     '''returns osm history query'''
 
@@ -222,59 +318,134 @@ def create_users_contributions_query(params, changeset_query):
 
 
 def generate_data_quality_hashtag_reports(cur, params):
+    """Generates data quality report of changesets with any of the hashtags within the time range and of validation points in the geometry.
+    Rows are the ones of the unnest and group by query this replaced, changesets without hashtags are left out and issues are repeated once per matching hashtag. Overlap predicates on both arrays are checked before they are expanded so the GIN indexes pick the candidates"""
     if params.hashtags is not None and len(params.hashtags) > 0:
-        filter_hashtags = ", ".join(["%s"] * len(params.hashtags))
-        filter_hashtags = cur.mogrify(sql.SQL(filter_hashtags), params.hashtags).decode()
-        filter_hashtags = f"AND unnest_hashtags in ({filter_hashtags})"
+        hashtags = cur.mogrify(sql.SQL("%s::text[]"), (params.hashtags,)).decode()
+        filter_hashtags = f"""AND c.hashtags && {hashtags}
+        AND h.hashtag = ANY({hashtags})"""
     else:
         filter_hashtags = ""
 
     if params.geometry is not None:
         geometry_dump = dumps(dict(params.geometry))
-        geom_filter = f"WHERE ST_CONTAINS(ST_GEOMFROMGEOJSON('{geometry_dump}'), location)"
+        # polygon is cut in pieces of at most 255 vertices so each exact test stays cheap, && lets the location index pick candidates per piece
+        geom_filter = cur.mogrify(sql.SQL("""AND EXISTS (SELECT 1 FROM ST_Subdivide(ST_GeomFromGeoJSON(%s), 255) AS area(geom)
+            WHERE v.location && area.geom AND ST_Intersects(area.geom, v.location))"""), (geometry_dump,)).decode()
     else:
         geom_filter = ""
 
-    issue_types = ", ".join(["%s"] * len(params.issue_type))
-    issue_types_str = [i for i in params.issue_type]
-    issue_types = cur.mogrify(sql.SQL(issue_types), issue_types_str).decode()
+    issue_types = cur.mogrify(sql.SQL("%s::status[]"), ([i for i in params.issue_type],)).decode()
 
-    timestamp_filter = cur.mogrify(sql.SQL("created_at BETWEEN %s AND %s"), (params.from_timestamp, params.to_timestamp)).decode()
+    timestamp_filter = cur.mogrify(sql.SQL("c.created_at BETWEEN %s AND %s"), (params.from_timestamp, params.to_timestamp)).decode()
 
     query = f"""
-        WITH t1 AS (SELECT osm_id, change_id, st_x(location) AS lat, st_y(location) AS lon, unnest(status) AS unnest_status from validation {geom_filter}),
-        t2 AS (SELECT id, created_at, unnest(hashtags) AS unnest_hashtags from changesets WHERE {timestamp_filter})
-        SELECT t1.osm_id,
-            t1.change_id as changeset_id,
-            t1.lat,
-            t1.lon,
-            t2.created_at,
-            ARRAY_TO_STRING(ARRAY_AGG(t1.unnest_status), ',') AS issues
-            FROM t1, t2 WHERE t1.change_id = t2.id
-            {filter_hashtags}
-            AND unnest_status in ({issue_types})
-            GROUP BY t1.osm_id, t1.lat, t1.lon, t2.created_at, t1.change_id;
+        SELECT v.osm_id,
+            v.change_id as changeset_id,
+            st_x(v.location) AS lat,
+            st_y(v.location) AS lon,
+            c.created_at,
+            ARRAY_TO_STRING(ARRAY_AGG(s.status), ',') AS issues
+        FROM changesets AS c
+        JOIN validation AS v ON v.change_id = c.id
+        CROSS JOIN LATERAL UNNEST(c.hashtags) AS h(hashtag)
+        CROSS JOIN LATERAL UNNEST(v.status) AS s(status)
+        WHERE {timestamp_filter}
+        {filter_hashtags}
+        AND v.status && {issue_types}
+        AND s.status = ANY({issue_types})
+        {geom_filter}
+        GROUP BY v.osm_id, st_x(v.location), st_y(v.location), c.created_at, v.change_id;
     """
 
     return query
 
 
-def create_hashtagfilter_underpass(hashtags,columnname):
-    """Generates hashtag filter query on the basis of list of hastags."""
-    
-    hashtag_filters = []
-    for i in hashtags:
-        if columnname =="username":
-            hashtag_filters.append(f"""'{i}'={columnname}""")
-        else:
-            hashtag_filters.append(f"""'{i}'=ANY({columnname})""")
-   
-    join_query = " OR ".join(hashtag_filters)
-    returnquery = f"""{join_query}"""
-    
-    return returnquery
+# grid shape : (function generating cells over bounds, function building one cell from its indices)
+GRID_FUNCTIONS = {
+    "hexagon": ("ST_HexagonGrid", "ST_Hexagon"),
+    "square": ("ST_SquareGrid", "ST_Square"),
+}
+
+
+def generate_data_quality_grid_query(cur, report_query, x_column, y_column, issues_column, issue_types, grid_shape, grid_size):
+    """Generates query counting issues of a data quality report per grid cell, returns a single geojson FeatureCollection of cells with their count per issue type
+
+    Cells are grid_size wide in EPSG:3857 units and aligned on its origin, so the cell of each point is looked up from the point alone and the grid is never generated over the whole extent.
+    issues_column holds the issue types of a row separated by comma, only the ones in issue_types are counted
+    """
+    grid_function, cell_function = GRID_FUNCTIONS[grid_shape]
+    issue_types = cur.mogrify(sql.SQL("%s::text[]"), ([str(i) for i in issue_types],)).decode()
+    grid_size = cur.mogrify(sql.SQL("%s::float8"), (grid_size,)).decode()
+
+    query = f"""
+        WITH report AS ({report_query.strip().rstrip(";")}),
+        points AS (
+            SELECT ST_Transform(ST_SetSRID(ST_MakePoint({x_column}, {y_column}), 4326), 3857) AS geom, issue
+            FROM report, UNNEST(string_to_array(trim(both '{{}}' from {issues_column}), ',')) AS issue
+            WHERE issue = ANY({issue_types})),
+        counts AS (
+            SELECT cell.i, cell.j, points.issue, count(*) AS count
+            FROM points, LATERAL (
+                SELECT c.i, c.j FROM {grid_function}({grid_size}, points.geom) AS c
+                WHERE ST_Intersects(c.geom, points.geom) LIMIT 1) AS cell
+            GROUP BY cell.i, cell.j, points.issue),
+        cells AS (
+            SELECT json_build_object('type', 'Feature',
+                'geometry', ST_AsGeoJSON(ST_Transform(ST_SetSRID({cell_function}({grid_size}, i, j), 3857), 4326))::json,
+                'properties', json_build_object('counts', json_object_agg(issue, count), 'total', sum(count))) AS feature
+            FROM counts
+            GROUP BY i, j)
+        SELECT json_build_object('type', 'FeatureCollection', 'features', COALESCE(json_agg(feature), '[]'::json))
+        FROM cells
+    """
+
+    return query
 
-def generate_data_quality_TM_query(params):
+
+def generate_data_quality_tile_query(cur, params, z, x, y):
+    """Returns query building one Mapbox Vector Tile of data quality issues, filtered the same way as hashtag reports"""
+    issue_types = [i for i in params.issue_type]
+    filters = [
+        cur.mogrify(sql.SQL("c.created_at BETWEEN %s AND %s"), (params.from_timestamp, params.to_timestamp)).decode(),
+        cur.mogrify(sql.SQL("v.status && %s::status[]"), (issue_types,)).decode(),
+    ]
+    if params.hashtags is not None and len(params.hashtags) > 0:
+        filters.append(cur.mogrify(sql.SQL("c.hashtags && %s::text[]"), (params.hashtags,)).decode())
+    filter_query = "\n            AND ".join(filters)
+
+    tile_envelope = cur.mogrify(sql.SQL("ST_TileEnvelope(%s, %s, %s)"), (z, x, y)).decode()
+    matched_issues = cur.mogrify(sql.SQL("ARRAY(SELECT s FROM UNNEST(v.status) AS s WHERE s = ANY(%s::status[]))"), (issue_types,)).decode()
+
+    query = f"""
+        WITH bounds AS (SELECT {tile_envelope} AS geom),
+        mvtgeom AS (
+            SELECT ST_AsMVTGeom(ST_Transform(v.location, 3857), bounds.geom) AS geom,
+                v.osm_id,
+                v.change_id AS changeset_id,
+                c.created_at,
+                ARRAY_TO_STRING({matched_issues}, ',') AS issues
+            FROM validation AS v
+            JOIN changesets AS c ON c.id = v.change_id, bounds
+            WHERE v.location && ST_Transform(bounds.geom, 4326)
+            AND {filter_query}
+        )
+        SELECT ST_AsMVT(mvtgeom.*, 'data_quality') FROM mvtgeom;
+    """
+
+    return query
+
+
+def create_hashtagfilter_underpass(hashtags,columnname,cur):
+    """Generates filter matching any of the given values as a single bound array predicate, hashtags and status use the array overlap served by their GIN index, username uses ANY served by its B-tree index"""
+    if len(hashtags) == 0:
+        return ""
+    if columnname == "username":
+        return cur.mogrify(f"""{columnname} = ANY(%s)""", (list(hashtags),)).decode()
+    array_type = "status" if columnname == "status" else "text"
+    return cur.mogrify(f"""{columnname} && %s::{array_type}[]""", (list(hashtags),)).decode()
+
+def generate_data_quality_TM_query(params, cur):
     '''returns data quality TM query with filters and parameteres provided'''
     print(params)
     hashtag_add_on="hotosm-project-"
@@ -289,8 +460,8 @@ def generate_data_quality_TM_query(params):
     for p in params.project_ids:
         change_ids.append(hashtag_add_on+str(p)) 
 
-    hashtagfilter=create_hashtagfilter_underpass(change_ids,"hashtags")
-    status_filter=create_hashtagfilter_underpass(issue_types,"status")
+    hashtagfilter=create_hashtagfilter_underpass(change_ids,"hashtags",cur)
+    status_filter=create_hashtagfilter_underpass(issue_types,"status",cur)
     '''Geojson output query for pydantic model'''
     # query1 = """
     #     select '{ "type": "Feature","properties": {   "Osm_id": ' || osm_id ||',"Changeset_id":  ' || change_id ||',"Changeset_timestamp": "' || timestamp ||'","Issue_type": "' || cast(status as text) ||'"},"geometry": ' || ST_AsGeoJSON(location)||'}'
@@ -323,7 +494,7 @@ def generate_data_quality_TM_query(params):
     return query
 
 
-def generate_data_quality_username_query(params):
+def generate_data_quality_username_query(params, cur):
     
     '''returns data quality username query with filters and parameteres provided'''
     print(params)
@@ -339,8 +510,8 @@ def generate_data_quality_username_query(params):
     for p in params.osm_usernames:
         osm_usernames.append(p) 
 
-    username_filter=create_hashtagfilter_underpass(osm_usernames,"username")
-    status_filter=create_hashtagfilter_underpass(issue_types,"status")
+    username_filter=create_hashtagfilter_underpass(osm_usernames,"username",cur)
+    status_filter=create_hashtagfilter_underpass(issue_types,"status",cur)
 
     '''Normal Query to feed our OUTPUT Class '''
     query =f"""   with t1 as (
@@ -370,54 +541,85 @@ def generate_data_quality_username_query(params):
     print(query)
     return query
 
-def generate_mapathon_summary_underpass_query(params,cur):
-    """Generates mapathon query from underpass"""
+def create_mapathon_hashtag_filter_underpass(params, cur):
+    """Generates filter of underpass changesets tagged with any of the mapathon projects or hashtags"""
     projectid_hashtag_add_on="hotosm-project-"
-    change_ids=[]
-    for p in params.project_ids:
-        change_ids.append(projectid_hashtag_add_on+str(p)) 
+    hashtags=[projectid_hashtag_add_on+str(p) for p in params.project_ids]
+    hashtags.extend(str(p) for p in params.hashtags)
+    return create_hashtagfilter_underpass(hashtags,"hashtags",cur)
 
-    projectidfilter=create_hashtagfilter_underpass(change_ids,"hashtags")
-    hashtags=[]
-    for p in params.hashtags:
-        hashtags.append(str(p)) 
-    hashtagfilter=create_hashtagfilter_underpass(hashtags,"hashtags")
-    timestamp_filter=create_timestamp_filter_query("created_at",params.from_timestamp, params.to_timestamp,cur)
 
-    base_where_query=f"""where  ({timestamp_filter}) """
-    if hashtagfilter != '' and projectidfilter != '':
-        base_where_query+= f"""AND ({hashtagfilter} OR {projectidfilter})"""
-    elif hashtagfilter == '' and projectidfilter != '':
-        base_where_query+= f"""AND ({projectidfilter})"""
-    else:
-        base_where_query+= f"""AND ({hashtagfilter})"""
-    summary_query= f"""with t1 as (
-        select  *
+def create_mapathon_where_underpass(params, timestamp_filter, cur):
+    """Generates where clause of underpass changesets of mapathon projects and hashtags"""
+    hashtagfilter=create_mapathon_hashtag_filter_underpass(params, cur)
+
+    base_where_query=f"""where  ({timestamp_filter}) AND ({hashtagfilter})"""
+    return base_where_query
+
+
+def generate_mapathon_increment_underpass_query(params, since, cur):
+    """Generates query of mapathon changesets created after since ( None for all ) with their created and modified features, one row per changeset and feature"""
+    timestamp_filter = create_increment_timestamp_filter_query("created_at", since, params, cur)
+    base_where_query = create_mapathon_where_underpass(params, timestamp_filter, cur)
+    query = f"""with t1 as (
+        select id, user_id, created_at, added, modified
         from changesets
         {base_where_query})
-        ,
-        t2 as (
-        select (each(added)).key as feature , (each(added)).value::Integer as count, 'create'::text as action
-        from t1
-        union all 
-        select  (each(modified)).key as feature , (each(modified)).value::Integer as count, 'modify'::text as action
-        from t1
-        )
-        select feature,action ,sum(count) as count
-        from t2
-        group by feature ,action 
+        select t1.id as changeset_id, t1.user_id, t1.created_at, t2.feature, t2.action, t2.count
+        from t1 left join lateral (
+            select key as feature, value::Integer as count, 'create'::text as action
+            from each(t1.added)
+            union all
+            select key as feature, value::Integer as count, 'modify'::text as action
+            from each(t1.modified)
+        ) as t2 on true """
+    return query
+
+
+def generate_mapathon_summary_underpass_query(params,cur):
+    """Generates mapathon query from underpass"""
+    timestamp_filter=create_timestamp_filter_query("created_at",params.from_timestamp, params.to_timestamp,cur)
+    base_where_query=create_mapathon_where_underpass(params, timestamp_filter, cur)
+    # both hstores of a changeset go through a single each() so changesets are read once for create and modify counts
+    summary_query= f"""select t2.key as feature, t1.action, sum(t2.value::Integer) as count
+        from changesets,
+        lateral (values ('create'::text, added), ('modify'::text, modified)) as t1(action, tags),
+        lateral each(t1.tags) as t2
+        {base_where_query}
+        group by t2.key, t1.action
         order by count desc """
     total_contributor_query= f"""select  COUNT(distinct user_id) as contributors_count
         from changesets
         {base_where_query}
         """
-    # print(summary_query)
-    # print("\n")
-
-    # print(total_contributor_query)
-    
     return summary_query,total_contributor_query
 
+def generate_multi_mapathon_summary_underpass_query(events, cur):
+    """Generates summary query of several mapathons from underpass in one pass over changesets, rows are laid out as in create_multi_mapathon_summary_query"""
+    event_filters = []
+    for event in events:
+        timestamp_filter = create_timestamp_filter_query("created_at", event.from_timestamp, event.to_timestamp, cur)
+        event_filters.append(f"({timestamp_filter} AND {create_mapathon_hashtag_filter_underpass(event, cur)})")
+    window_filter = create_timestamp_filter_query("created_at",
+                                                  min(e.from_timestamp for e in events),
+                                                  max(e.to_timestamp for e in events), cur)
+    any_event_filter = " OR ".join(event_filters)
+    query = f"""with t1 as (
+        select user_id, added, modified, {create_mapathon_events_column(event_filters)} as events
+        from changesets
+        where {window_filter} AND ({any_event_filter}))
+        select event, t3.key as feature, t2.action, sum(t3.value::Integer) as count
+        from t1, unnest(t1.events) as event,
+        lateral (values ('create'::text, t1.added), ('modify'::text, t1.modified)) as t2(action, tags),
+        lateral each(t2.tags) as t3
+        group by event, t3.key, t2.action
+        union all
+        select event, NULL, NULL, COUNT(distinct user_id)
+        from t1, unnest(t1.events) as event
+        group by event
+        order by event, count desc """
+    return query
+
 def generate_training_organisations_query():
     """Generates query for listing out all the organisations listed in training table from underpass
     """
@@ -0,0 +1,142 @@
+# Copyright (C) 2021 Humanitarian OpenStreetmap Team
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Humanitarian OpenStreetmap Team
+# 1100 13th Street NW Suite 800 Washington, D.C. 20005
+# <info@hotosm.org>
+'''Read replica routing for report queries'''
+
+import logging
+import threading
+import time
+
+from psycopg2 import connect, OperationalError
+
+from .config import config, get_db_params, get_read_params
+
+logger = logging.getLogger(__name__)
+
+REPLICATION_LAG_QUERY = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+
+
+class Endpoint:
+    """One read endpoint with its health and the number of connections currently using it"""
+
+    def __init__(self, params):
+        self.params = params
+        self.outstanding = 0
+        self.healthy = True
+        self.lag = 0
+        self.checked_at = None
+
+    @property
+    def name(self):
+        return f"{self.params.get('host')}:{self.params.get('port', 5432)}"
+
+
+class ReplicaSet:
+    """Read endpoints of one config section
+
+    Connections are handed to the healthy replica with least outstanding connections. Replicas are health checked by a background thread every health_check_interval seconds, so requests only read the cached health state. A replica that can not be reached or lags more than max_replication_lag seconds behind is skipped until its next check. The primary is used when no replica is available.
+    """
+
+    sets = {}
+    sets_lock = threading.Lock()
+
+    def __init__(self, primary, replicas, max_lag=30, check_interval=10):
+        self.primary = Endpoint(primary)
+        self.replicas = [Endpoint(r) for r in replicas]
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.checker = None
+        self.stopped = threading.Event()
+
+    @classmethod
+    def for_section(cls, section):
+        """Returns replica set of config section, shared by every Database of the process"""
+        with cls.sets_lock:
+            if section not in cls.sets:
+                cls.sets[section] = cls(
+                    get_db_params(section), get_read_params(section),
+                    max_lag=config.getfloat(section, "max_replication_lag", fallback=30),
+                    check_interval=config.getfloat(section, "health_check_interval", fallback=10))
+            return cls.sets[section]
+
+    def check(self, endpoint):
+        """Connects to endpoint and reads its replication lag"""
+        try:
+            conn = connect(**endpoint.params, connect_timeout=3)
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(REPLICATION_LAG_QUERY)
+                    endpoint.lag = float(cur.fetchone()[0])
+            finally:
+                conn.close()
+            endpoint.healthy = endpoint.lag <= self.max_lag
+            if not endpoint.healthy:
+                logger.warning("Replica %s lags %.1f seconds behind", endpoint.name, endpoint.lag)
+        except OperationalError as err:
+            logger.warning("Replica %s is not reachable: %s", endpoint.name, err)
+            endpoint.healthy = False
+        endpoint.checked_at = time.monotonic()
+
+    def run_checks(self):
+        """Health checks every replica each check_interval seconds until stopped"""
+        while not self.stopped.is_set():
+            for endpoint in self.replicas:
+                self.check(endpoint)
+            self.stopped.wait(self.check_interval)
+
+    def start(self):
+        """Starts the background health checks, once per replica set"""
+        with self.lock:
+            if self.checker is None and self.replicas:
+                self.checker = threading.Thread(target=self.run_checks, name="replica-health-check", daemon=True)
+                self.checker.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.checker is not None:
+            self.checker.join()
+
+    def candidates(self):
+        """Returns healthy replicas ordered by outstanding connections, followed by primary
+
+        Health state is the one cached by the background checks, replicas count as healthy until their first check.
+        """
+        self.start()
+        with self.lock:
+            healthy = sorted((e for e in self.replicas if e.healthy),
+                             key=lambda e: e.outstanding)
+        return [*healthy, self.primary]
+
+    def acquire(self, endpoint):
+        with self.lock:
+            endpoint.outstanding += 1
+
+    def release(self, endpoint):
+        with self.lock:
+            endpoint.outstanding -= 1
+
+    def mark_failed(self, endpoint):
+        endpoint.healthy = False
+        endpoint.checked_at = time.monotonic()
@@ -0,0 +1,175 @@
+# Copyright (C) 2021 Humanitarian OpenStreetmap Team
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Humanitarian OpenStreetmap Team
+# 1100 13th Street NW Suite 800 Washington, D.C. 20005
+# <info@hotosm.org>
+'''Indexes the report queries rely on, checked at startup and created from the command line
+
+    python -m src.galaxy.schema check
+    python -m src.galaxy.schema create --database underpass
+'''
+
+import argparse
+import sys
+from collections import namedtuple
+
+from psycopg2 import connect
+
+from .config import config, get_db_params
+
+# database key of each config section
+DATABASES = {"underpass": "UNDERPASS", "insight": "INSIGHTS_PG"}
+
+# method is the postgres access method, columns are matched in order against the leading columns of existing indexes
+Index = namedtuple("Index", ["database", "table", "columns", "method", "name"])
+
+REQUIRED_INDEXES = [
+    Index("underpass", "changesets", ("created_at",), "brin", "changesets_created_at_idx"),
+    Index("underpass", "changesets", ("created_at", "id"), "btree", "changesets_created_at_id_idx"),
+    Index("underpass", "changesets", ("hashtags",), "gin", "changesets_hashtags_idx"),
+    Index("underpass", "changesets", ("user_id",), "btree", "changesets_user_id_idx"),
+    Index("underpass", "validation", ("change_id",), "btree", "validation_change_id_idx"),
+    Index("underpass", "validation", ("user_id",), "btree", "validation_user_id_idx"),
+    Index("underpass", "validation", ("status",), "gin", "validation_status_idx"),
+    Index("underpass", "validation", ("location",), "gist", "validation_location_idx"),
+    Index("underpass", "users", ("username",), "btree", "users_username_idx"),
+    Index("insight", "osm_changeset", ("created_at",), "brin", "osm_changeset_created_at_idx"),
+    Index("insight", "osm_changeset", ("tags",), "gin", "osm_changeset_tags_idx"),
+    Index("insight", "osm_changeset", ("user_id",), "btree", "osm_changeset_user_id_idx"),
+    Index("insight", "osm_element_history", ("changeset",), "btree", "osm_element_history_changeset_idx"),
+    Index("insight", "osm_element_history", ("uid", "timestamp"), "btree", "osm_element_history_uid_timestamp_idx"),
+]
+
+# existing access methods accepted for a declared one, a btree serves the range scans a brin is declared for
+ACCEPTED_METHODS = {"brin": ("brin", "btree")}
+
+# access method and leading columns of every valid index of the given tables
+EXISTING_INDEXES_QUERY = """
+    SELECT t.relname, am.amname,
+        ARRAY(SELECT a.attname::text
+              FROM unnest(ix.indkey::int2[]) WITH ORDINALITY AS k(attnum, position)
+              JOIN pg_attribute AS a ON a.attrelid = t.oid AND a.attnum = k.attnum
+              ORDER BY k.position)
+    FROM pg_index AS ix
+    JOIN pg_class AS t ON t.oid = ix.indrelid
+    JOIN pg_class AS i ON i.oid = ix.indexrelid
+    JOIN pg_am AS am ON am.oid = i.relam
+    WHERE t.relname = ANY(%s) AND t.relkind IN ('r', 'p') AND ix.indisvalid
+"""
+
+
+def create_index_statement(index):
+    """CREATE INDEX statement of index, built concurrently so the table stays writable"""
+    columns = ", ".join(index.columns)
+    return (f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index.name} "
+            f"ON {index.table} USING {index.method} ({columns})")
+
+
+def required_indexes(database):
+    return [index for index in REQUIRED_INDEXES if index.database == database]
+
+
+def connect_database(database):
+    return connect(**get_db_params(DATABASES[database]))
+
+
+def missing_indexes(conn, indexes):
+    """Returns declared indexes not covered by an existing valid index of an accepted method whose leading columns are the declared ones, whatever its name"""
+    tables = sorted({index.table for index in indexes})
+    with conn.cursor() as cur:
+        cur.execute(EXISTING_INDEXES_QUERY, (tables,))
+        existing = cur.fetchall()
+    missing = []
+    for index in indexes:
+        methods = ACCEPTED_METHODS.get(index.method, (index.method,))
+        covered = any(table == index.table and method in methods
+                      and tuple(columns[:len(index.columns)]) == index.columns
+                      for table, method, columns in existing)
+        if not covered:
+            missing.append(index)
+    return missing
+
+
+def create_indexes(conn, indexes):
+    """Creates indexes one by one, CREATE INDEX CONCURRENTLY can not run inside a transaction"""
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        for index in indexes:
+            print(f"Creating {index.name} on {index.table}")
+            cur.execute(create_index_statement(index))
+
+
+def check_indexes(mode=None):
+    """Startup check of required indexes of every database, mode comes from check of SCHEMA section
+
+    off skips it, warn prints missing indexes, fail raises RuntimeError so the server does not start
+    Returns missing indexes
+    """
+    mode = mode or config.get("SCHEMA", "check", fallback="warn")
+    if mode == "off":
+        return []
+    missing = []
+    for database in DATABASES:
+        try:
+            conn = connect_database(database)
+        except Exception as err:
+            print(f"Indexes of {database} could not be checked: {err}")
+            continue
+        try:
+            missing.extend(missing_indexes(conn, required_indexes(database)))
+        finally:
+            conn.close()
+    for index in missing:
+        print(f"Missing index on {index.database} {index.table} ({', '.join(index.columns)}) using {index.method}, "
+              f"create it with : {create_index_statement(index)}")
+    if missing and mode == "fail":
+        raise RuntimeError(f"{len(missing)} required indexes are missing")
+    return missing
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Checks and creates indexes used by galaxy reports")
+    parser.add_argument("command", choices=["check", "create", "sql"],
+                        help="check lists missing indexes, create builds them concurrently, sql prints every statement")
+    parser.add_argument("--database", choices=list(DATABASES), action="append",
+                        help="database to work on, all by default")
+    args = parser.parse_args(argv)
+    databases = args.database or list(DATABASES)
+
+    if args.command == "sql":
+        for database in databases:
+            for index in required_indexes(database):
+                print(f"{create_index_statement(index)};")
+        return 0
+
+    missing_count = 0
+    for database in databases:
+        conn = connect_database(database)
+        try:
+            missing = missing_indexes(conn, required_indexes(database))
+            if args.command == "create":
+                create_indexes(conn, missing)
+                missing = missing_indexes(conn, required_indexes(database))
+        finally:
+            conn.close()
+        for index in missing:
+            print(f"Missing index on {database} {index.table} ({', '.join(index.columns)}) using {index.method}")
+        missing_count += len(missing)
+    return 1 if missing_count else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
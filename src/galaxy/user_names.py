@@ -0,0 +1,254 @@
+# Copyright (C) 2021 Humanitarian OpenStreetmap Team
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Humanitarian OpenStreetmap Team
+# 1100 13th Street NW Suite 800 Washington, D.C. 20005
+# <info@hotosm.org>
+'''OSM user name to user id resolution, from an osm_user_days table of Insight kept up to date incrementally and cached in process'''
+
+from bisect import bisect_left, bisect_right
+from datetime import date, datetime, time, timedelta, timezone
+
+from psycopg2 import connect
+
+from .cache import TTLCache
+from .config import config, get_db_params
+
+CREATE_USERS_TABLES = """
+    CREATE TABLE IF NOT EXISTS osm_user_days (
+        user_name text NOT NULL,
+        user_id bigint NOT NULL,
+        day date NOT NULL,
+        PRIMARY KEY (user_name, user_id, day)
+    );
+    CREATE TABLE IF NOT EXISTS osm_user_days_state (
+        id boolean PRIMARY KEY DEFAULT true CHECK (id),
+        last_changeset_id bigint NOT NULL,
+        indexed_until timestamp
+    );
+    INSERT INTO osm_user_days_state (last_changeset_id) VALUES (0)
+        ON CONFLICT DO NOTHING;
+"""
+
+# changesets read again are harmless, a day is only recorded once
+UPDATE_USERS_BATCH = """
+    WITH batch AS (
+        SELECT id, user_id, user_name, created_at
+        FROM osm_changeset
+        WHERE id > %(since)s
+        ORDER BY id
+        LIMIT %(batch_size)s),
+    inserted AS (
+        INSERT INTO osm_user_days (user_name, user_id, day)
+        SELECT DISTINCT user_name, user_id, created_at::date
+        FROM batch
+        WHERE user_name IS NOT NULL AND user_id IS NOT NULL AND created_at IS NOT NULL
+        ON CONFLICT DO NOTHING)
+    SELECT max(id), count(*), max(created_at) FROM batch
+"""
+
+LOOKUP_USERS_QUERY = """
+    SELECT s.indexed_until, u.user_name, u.user_id, u.day
+    FROM osm_user_days_state AS s
+    LEFT JOIN osm_user_days AS u ON u.user_name = ANY(%s)
+    ORDER BY u.user_name, u.user_id, u.day
+"""
+
+# changesets of the time range, for names the table can not answer at day precision or not yet
+CHANGESET_USERS_QUERY = """
+    SELECT DISTINCT user_id, user_name FROM osm_changeset
+    WHERE created_at >= %s AND created_at <= %s AND user_name = ANY(%s)
+"""
+
+UPDATE_LOCK_ID = 7245302
+
+
+def as_datetime(value):
+    """Dates are compared as their midnight, as postgres does against timestamps, and aware timestamps as naive UTC as changesets are stored"""
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            return value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+    if isinstance(value, date):
+        return datetime.combine(value, time.min)
+    return value
+
+
+class OsmUsersIndex:
+    """osm_user_days table of Insight database, one row per user name, user id and day the name was used by the id
+
+    Changesets are processed in id order after the id recorded in osm_user_days_state, which also records the newest changeset timestamp read as indexed_until. The last overlap ids are read again on each update so changesets replicated slightly out of order are not missed
+
+    Parameters:
+        batch_size : changesets processed per transaction
+        overlap : ids before the recorded one read again
+        db_params : connection parameters, primary of INSIGHTS_PG by default
+    """
+
+    def __init__(self, batch_size=50000, overlap=1000, db_params=None):
+        self.batch_size = batch_size
+        self.overlap = overlap
+        self.db_params = db_params
+
+    @classmethod
+    def from_config(cls):
+        return cls(batch_size=config.getint("OSM_USERS", "batch_size", fallback=50000),
+                   overlap=config.getint("OSM_USERS", "overlap", fallback=1000))
+
+    @staticmethod
+    def enabled():
+        """Whether user names are resolved through the table"""
+        return config.getboolean("OSM_USERS", "enabled", fallback=False)
+
+    def connect(self):
+        return connect(**(self.db_params or get_db_params("INSIGHTS_PG")))
+
+    def create(self):
+        """Creates user days tables when they are missing"""
+        conn = self.connect()
+        try:
+            with conn, conn.cursor() as cur:
+                cur.execute(CREATE_USERS_TABLES)
+        finally:
+            conn.close()
+
+    def update(self):
+        """Adds users of changesets added since last update, returns number of changesets read or None when another update is running"""
+        conn = self.connect()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_try_advisory_lock(%s)", (UPDATE_LOCK_ID,))
+                if not cur.fetchone()[0]:
+                    return None
+                conn.commit()
+                try:
+                    return self.update_batches(conn, cur)
+                finally:
+                    cur.execute("SELECT pg_advisory_unlock(%s)", (UPDATE_LOCK_ID,))
+                    conn.commit()
+        finally:
+            conn.close()
+
+    def update_batches(self, conn, cur):
+        cur.execute("SELECT last_changeset_id FROM osm_user_days_state")
+        last_id = cur.fetchone()[0]
+        since = max(0, last_id - self.overlap)
+        processed = 0
+        while True:
+            cur.execute(UPDATE_USERS_BATCH, {"since": since, "batch_size": self.batch_size})
+            max_id, count, max_created_at = cur.fetchone()
+            if max_id is None:
+                conn.commit()
+                break
+            processed += count
+            cur.execute("""UPDATE osm_user_days_state
+                SET last_changeset_id = greatest(last_changeset_id, %s),
+                    indexed_until = greatest(indexed_until, %s)""", (max_id, max_created_at))
+            conn.commit()
+            since = max_id
+            if count < self.batch_size:
+                break
+        return processed
+
+
+class UserNameResolver:
+    """Resolves user names to the ids that used them within a time range
+
+    Names are cached with the days each of their ids used them and how far the table was indexed when they were read, a name without any id is cached as well. Only names missing from the cache are looked up, all of them in one query. An id used on a day entirely inside the range is matched from the days alone, ids used only on the partial days at the ends of the range are checked against the changesets of those partial days. Changesets newer than the table are always read for the end of the range it was not indexed that far yet
+
+    Parameters:
+        maxsize : number of names kept
+        ttl : seconds a name stays cached
+    """
+
+    def __init__(self, maxsize=100000, ttl=600):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    @classmethod
+    def from_config(cls):
+        return cls(maxsize=config.getint("OSM_USERS", "cache_maxsize", fallback=100000),
+                   ttl=config.getint("OSM_USERS", "cache_ttl", fallback=600))
+
+    @staticmethod
+    def query(database, query, params):
+        """Runs query on database, connecting it on first use"""
+        if getattr(database, "conn", None) is None:
+            database.connect()
+        result = database.executequery(database.cur.mogrify(query, params))
+        if result is None:
+            raise RuntimeError("User names could not be resolved")
+        return result
+
+    def lookup(self, database, user_names):
+        """Reads names from osm_user_days into the cache"""
+        rows = self.query(database, LOOKUP_USERS_QUERY, (list(user_names),))
+        indexed_until = rows[0][0] if rows else None
+        days = {name: {} for name in user_names}
+        for _, user_name, user_id, day in rows:
+            if user_name is not None:
+                days[user_name].setdefault(user_id, []).append(day)
+        for name, id_days in days.items():
+            self.cache.set(name, (indexed_until, {user_id: tuple(d) for user_id, d in id_days.items()}))
+
+    def resolve(self, database, user_names, from_timestamp, to_timestamp):
+        """Returns (user_id, user_name) of ids that used the names between from_timestamp and to_timestamp, both included, database is only connected when some name is not cached, only used on partial days of the range or not indexed yet"""
+        user_names = list(dict.fromkeys(user_names))
+        from_timestamp, to_timestamp = as_datetime(from_timestamp), as_datetime(to_timestamp)
+        entries = {name: self.cache.get(name) for name in user_names}
+        missing = [name for name, entry in entries.items() if entry is None]
+        if missing:
+            self.lookup(database, missing)
+            entries.update((name, self.cache.get(name)) for name in missing)
+
+        # days entirely inside the range, the others are only partly covered by it
+        first_day, last_day = from_timestamp.date(), to_timestamp.date()
+        if from_timestamp > datetime.combine(first_day, time.min):
+            first_day += timedelta(days=1)
+        if to_timestamp < datetime.combine(last_day, time.max):
+            last_day -= timedelta(days=1)
+
+        users = set()
+        partial = []
+        # names to look up in changesets newer than the table, by the timestamp the table was indexed until
+        unindexed = {}
+        for name, (indexed_until, id_days) in entries.items():
+            for user_id, days in id_days.items():
+                if bisect_right(days, last_day) > bisect_left(days, first_day):
+                    users.add((user_id, name))
+                elif bisect_right(days, to_timestamp.date()) > bisect_left(days, from_timestamp.date()):
+                    partial.append(name)
+            if indexed_until is None or indexed_until < to_timestamp:
+                unindexed.setdefault(indexed_until, []).append(name)
+
+        if partial:
+            partial = list(dict.fromkeys(partial))
+            ranges = []
+            if first_day > last_day:
+                ranges.append((from_timestamp, to_timestamp))
+            else:
+                if from_timestamp.date() < first_day:
+                    ranges.append((from_timestamp, datetime.combine(first_day, time.min) - timedelta(microseconds=1)))
+                if last_day < to_timestamp.date():
+                    ranges.append((datetime.combine(last_day + timedelta(days=1), time.min), to_timestamp))
+            for since, until in ranges:
+                rows = self.query(database, CHANGESET_USERS_QUERY, (since, until, partial))
+                users.update((row[0], row[1]) for row in rows)
+
+        for indexed_until, names in unindexed.items():
+            since = from_timestamp if indexed_until is None else max(from_timestamp, indexed_until)
+            if since <= to_timestamp:
+                rows = self.query(database, CHANGESET_USERS_QUERY, (since, to_timestamp, names))
+                users.update((row[0], row[1]) for row in rows)
+        return sorted(users)
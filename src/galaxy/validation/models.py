@@ -24,8 +24,8 @@ from pydantic import validator
 from datetime import datetime, date, timedelta
 from pydantic import BaseModel as PydanticModel
 
-from pydantic import conlist
-from geojson_pydantic import Feature, FeatureCollection, Point, Polygon
+from pydantic import conint, conlist
+from geojson_pydantic import Feature, FeatureCollection, MultiPolygon, Point, Polygon
 
 from datetime import datetime
 
@@ -74,6 +74,14 @@ class MapathonSummary(BaseModel):
     mapped_features: List[MappedFeature]
 
 
+class MapathonEventSummary(MapathonSummary):
+    name: str
+
+
+class MultiMapathonSummary(BaseModel):
+    events: List[MapathonEventSummary]
+
+
 class MapathonDetail(BaseModel):
     mapped_features: List[MappedFeatureWithUser]
     contributors: List[MapathonContributor]
@@ -132,6 +140,36 @@ class MapathonRequestParams(TimeStampParams):
         else:
             raise ValueError('Source '+str(value)+" does not exist")   
 
+MAX_MAPATHON_EVENTS = 50
+
+
+class MapathonEvent(MapathonRequestParams):
+    """One mapathon of a multi mapathon request, its source is ignored in favour of the one of the request"""
+    name: str
+
+
+class MultiMapathonRequestParams(BaseModel):
+    '''validation class for several mapathons summarised together'''
+
+    events: conlist(MapathonEvent, min_items=1, max_items=MAX_MAPATHON_EVENTS)
+    source: Optional[str]
+
+    @validator("events", allow_reuse=True)
+    def check_event_names(cls, value, **kwargs):
+        '''event names identify summaries in the response'''
+        names = [event.name for event in value]
+        if len(set(names)) != len(names):
+            raise ValueError("Event names must be unique")
+        return value
+
+    @validator("source", allow_reuse=True)
+    def check_source(cls, value, **kwargs):
+        '''checks the either source  is supported or not '''
+        if value is None or value == "insight" or value == "underpass":
+            return value
+        raise ValueError('Source '+str(value)+" does not exist")
+
+
 class UsersListParams(BaseModel):
     user_names: List[str]
     from_timestamp: Union[datetime, date]
@@ -157,8 +195,27 @@ class IssueType(Enum):
 class OutputType(Enum):
     CSV = "csv"
     GEOJSON = "geojson"
+    ARROW = "arrow"
+    PARQUET = "parquet"
+    NDJSON = "ndjson"
+    GRID = "grid"
+
+
+class GridShape(Enum):
+    HEXAGON = "hexagon"
+    SQUARE = "square"
+
+
+MIN_GRID_SIZE = 100 # m
+MAX_GRID_SIZE = 500000 # m
 
-class DataQuality_TM_RequestParams(BaseModel):
+
+class GridParams(BaseModel):
+    '''Cells of data quality reports aggregated with "grid" output type, grid size is the cell width in meters of web mercator'''
+    grid_shape: GridShape = GridShape.HEXAGON.value
+    grid_size: conint(ge=MIN_GRID_SIZE, le=MAX_GRID_SIZE) = 10000
+
+class DataQuality_TM_RequestParams(GridParams):
     '''Request Parameteres validation for DataQuality Class Tasking Manager Project ID
     
     Parameters:
@@ -175,7 +232,7 @@ class DataQuality_TM_RequestParams(BaseModel):
     issue_types: List[IssueType]
     output_type: OutputType
 
-class DataQuality_username_RequestParams(TimeStampParams):
+class DataQuality_username_RequestParams(TimeStampParams, GridParams):
     '''Request Parameteres validation for DataQuality Class Username
     
     Parameters:
@@ -211,11 +268,11 @@ class DataQualityPointCollection(FeatureCollection):
     features: List[DataQualityPointFeature]
 
 
-class DataQualityHashtagParams(TimeStampParams):
+class DataQualityHashtagParams(TimeStampParams, GridParams):
     hashtags: Optional[List[str]]
     issue_type: List[IssueType]
     output_type: OutputType
-    geometry: Optional[Polygon]
+    geometry: Optional[Union[Polygon, MultiPolygon]]
 
     @validator("geometry", always=True)
     def check_not_defined_fields(cls, value, values):
@@ -236,6 +293,17 @@ class DataQualityHashtagParams(TimeStampParams):
         return value
 
 
+class DataQualityTileParams(TimeStampParams):
+    """Filters of data quality vector tiles, the tile itself is the geometry filter"""
+    hashtags: Optional[List[str]]
+    issue_type: conlist(IssueType, min_items=1)
+
+
+class Country(BaseModel):
+    name: str
+    iso3: Optional[str]
+
+
 class Source(Enum):
     UNDERPASS ="underpass"
     INSIGHT = "insight"
@@ -0,0 +1,43 @@
+CREATE EXTENSION if not exists hstore;
+CREATE EXTENSION if not exists postgis;
+
+CREATE TABLE if not exists geoboundaries (
+	id serial PRIMARY KEY,
+	name text,
+	tags hstore,
+	priority bool,
+	boundary geometry(multipolygon, 4326)
+);
+
+CREATE TABLE if not exists changesets (
+	id int8 NOT NULL,
+	editor text NULL,
+	user_id int8 NULL,
+	created_at timestamp NULL,
+	closed_at timestamp NULL,
+	updated_at timestamp NULL,
+	added hstore NULL,
+	modified hstore NULL,
+	deleted hstore NULL,
+	hashtags text[] NULL,
+	source text NULL,
+	bbox geometry(polygon, 4326) NULL,
+	CONSTRAINT changesets_pkey PRIMARY KEY (id)
+);
+
+INSERT INTO geoboundaries (name, tags, priority, boundary) VALUES
+	('Nepal', '"name:iso_w3"=>"NPL", "name:iso_a3"=>"NPL"', true, ST_Multi(ST_MakeEnvelope(80, 26, 88, 30, 4326))),
+	('India', '"name:iso_w3"=>"IND", "name:iso_a3"=>"IND"', true, ST_Multi(ST_MakeEnvelope(68, 8, 88, 26, 4326)));
+
+INSERT INTO changesets (id, user_id, created_at, added, modified, deleted, hashtags, bbox) VALUES
+	(1001, 11, '2022-03-01 08:00:00', '"highway"=>"2", "highway_km"=>"1500", "building"=>"4"', '"highway"=>"1", "highway_km"=>"200"', NULL, '{hotosm-project-1}', ST_MakeEnvelope(84, 27, 84.1, 27.1, 4326)),
+	(1002, 12, '2022-03-01 10:30:00', '"highway"=>"3", "highway_km"=>"800"', NULL, '"highway"=>"1", "highway_km"=>"50"', '{}', ST_MakeEnvelope(85, 28, 85.2, 28.2, 4326)),
+	(1003, 11, '2022-03-01 18:45:00', '"building"=>"12"', '"highway"=>"2", "highway_km"=>"300"', NULL, '{hotosm-project-1,mapathon}', ST_MakeEnvelope(84.5, 25.9, 84.6, 26.1, 4326)),
+	(1004, 13, '2022-03-02 00:00:00', '"highway"=>"5", "highway_km"=>"2500"', NULL, NULL, '{mapathon}', ST_MakeEnvelope(77, 20, 77.1, 20.1, 4326)),
+	(1005, 14, '2022-03-02 13:10:00', NULL, '"highway"=>"4", "highway_km"=>"900"', '"highway"=>"2", "highway_km"=>"120"', '{hotosm-project-1}', ST_MakeEnvelope(86, 29, 86.3, 29.1, 4326)),
+	(1006, 12, '2022-03-03 09:00:00', '"highway"=>"1", "highway_km"=>"100"', '"building"=>"3"', NULL, NULL, ST_MakeEnvelope(81, 27, 81.1, 27.1, 4326)),
+	(1007, 15, '2022-03-03 23:59:59', '"highway"=>"7", "highway_km"=>"4200"', NULL, NULL, '{mapathon}', ST_MakeEnvelope(70, 10, 70.5, 10.5, 4326)),
+	(1008, 11, '2022-03-04 07:30:00', '"highway"=>"2", "highway_km"=>"600"', NULL, NULL, '{hotosm-project-1}', ST_MakeEnvelope(83, 28, 83.1, 28.1, 4326)),
+	(1009, 16, '2022-03-04 08:00:00', NULL, NULL, NULL, '{}', NULL),
+	(1010, 13, '2022-03-04 09:15:00', '"highway"=>"1", "highway_km"=>"75"', NULL, NULL, '{mapathon}', ST_MakeEnvelope(87, 26.5, 87.1, 26.6, 4326)),
+	(1011, 14, '2022-03-05 11:00:00', '"highway"=>"3", "highway_km"=>"950"', '"highway"=>"1", "highway_km"=>"30"', NULL, '{hotosm-project-1}', ST_MakeEnvelope(82, 25.5, 82.2, 26.5, 4326));
@@ -0,0 +1,49 @@
+CREATE EXTENSION if not exists hstore;
+CREATE EXTENSION if not exists postgis;
+
+DO $$ BEGIN
+	CREATE TYPE status AS ENUM ('notags', 'complete', 'incomplete', 'badvalue', 'correct', 'badgeom', 'incomplete_tags');
+EXCEPTION
+	WHEN duplicate_object THEN NULL;
+END $$;
+
+CREATE TABLE if not exists changesets (
+	id int8 NOT NULL,
+	editor text NULL,
+	user_id int8 NULL,
+	created_at timestamp NULL,
+	closed_at timestamp NULL,
+	updated_at timestamp NULL,
+	added hstore NULL,
+	modified hstore NULL,
+	deleted hstore NULL,
+	hashtags text[] NULL,
+	source text NULL,
+	bbox geometry(polygon, 4326) NULL,
+	CONSTRAINT changesets_pkey PRIMARY KEY (id)
+);
+
+CREATE TABLE if not exists validation (
+	osm_id int8 NOT NULL,
+	change_id int8 NOT NULL,
+	user_id int8 NULL,
+	"type" text NULL,
+	status status[] NULL,
+	"timestamp" timestamp NULL,
+	location geometry(point, 4326) NULL
+);
+
+INSERT INTO changesets (id, user_id, created_at, hashtags) VALUES
+	(2001, 21, '2022-04-01 10:00:00', '{missingmaps,hotosm-project-1}'),
+	(2002, 22, '2022-04-01 11:00:00', '{}'),
+	(2003, 23, '2022-04-01 12:00:00', NULL),
+	(2004, 24, '2022-04-01 13:00:00', '{mapathon}'),
+	(2005, 21, '2022-05-01 10:00:00', '{missingmaps}');
+
+INSERT INTO validation (osm_id, change_id, user_id, "type", status, location) VALUES
+	(1, 2001, 21, 'way', '{badgeom,badvalue}', ST_SetSRID(ST_MakePoint(85.3, 27.7), 4326)),
+	(2, 2001, 21, 'way', '{complete}', ST_SetSRID(ST_MakePoint(85.3, 27.7), 4326)),
+	(3, 2002, 22, 'way', '{badgeom}', ST_SetSRID(ST_MakePoint(85.31, 27.71), 4326)),
+	(4, 2003, 23, 'way', '{badgeom}', ST_SetSRID(ST_MakePoint(85.32, 27.72), 4326)),
+	(5, 2004, 24, 'node', '{badvalue,badgeom}', ST_SetSRID(ST_MakePoint(86.5, 27.5), 4326)),
+	(6, 2005, 21, 'way', '{badgeom}', ST_SetSRID(ST_MakePoint(85.3, 27.7), 4326));
@@ -22,11 +22,37 @@ import testing.postgresql
 import pytest
 from src.galaxy.validation import models as mapathon_validation
 from src.galaxy.query_builder import builder as mapathon_query_builder
-from src.galaxy.query_builder.builder import create_UserStats_get_statistics_query,create_userstats_get_statistics_with_hashtags_query,generate_data_quality_TM_query,generate_data_quality_username_query,generate_data_quality_hashtag_reports
-from src.galaxy.validation.models import UserStatsParams,DataQuality_TM_RequestParams,DataQuality_username_RequestParams,DataQualityHashtagParams
-from src.galaxy import Output
+from src.galaxy.query_builder.builder import create_UserStats_get_statistics_query,create_userstats_get_statistics_with_hashtags_query,generate_data_quality_TM_query,generate_data_quality_username_query,generate_data_quality_hashtag_reports,generate_data_quality_tile_query,generate_data_quality_grid_query
+from src.galaxy.validation.models import MapathonRequestParams,TrainingParams,Trainings,TrainingOrganisations,UsersListParams,UserStatsParams,DataQuality_TM_RequestParams,DataQuality_username_RequestParams,DataQualityHashtagParams,DataQualityTileParams
+from src.galaxy import Output, config
+from src.galaxy.hashtag_index import ChangesetHashtagIndex
+from src.galaxy import schema
+from src.galaxy import batch, cli, jobs, replicas
+from src.galaxy.countries import CountryIndex
+from src.galaxy.country_stats import CountryStatsIndex, full_days, create_country_stats_query
+from API.changesets import FilterParams
+from API.changesets.routers import ChangesetResult, create_changesets_query, fetch_changesets, fetch_country_stats
+from src.galaxy.user_names import OsmUsersIndex, UserNameResolver
+from API import live, metrics, utils
+from API import data_quality as data_quality_api
+from fastapi import FastAPI, HTTPException
+from API.middleware import AdmissionControlMiddleware, CompressionMiddleware, EndpointClass, ReportCacheMiddleware
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse, StreamingResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+import asyncio
+import contextvars
+import io
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import os.path
+import psycopg2
 from pydantic import ValidationError as PydanticError
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
 
 # Reference to testing.postgresql db instance
 postgresql = None
@@ -99,6 +125,8 @@ def test_db_insert():
 
 def test_populate_data():
     database.executequery(slurp('tests/src/fixtures/mapathon_summary.sql'))
+    # committed so indexes maintained on their own connections see the fixtures
+    con.commit()
 
 
 def test_mapathon_osm_history_mapathon_query_builder():
@@ -122,7 +150,7 @@ def test_data_quality_hashtags_query_builder():
         "toTimestamp": "2020-12-11T00:00:00"
     }
 
-    test_data_quality_hashtags_query = "\n        WITH t1 AS (SELECT osm_id, change_id, st_x(location) AS lat, st_y(location) AS lon, unnest(status) AS unnest_status from validation ),\n        t2 AS (SELECT id, created_at, unnest(hashtags) AS unnest_hashtags from changesets WHERE created_at BETWEEN '2020-12-10T00:00:00'::timestamp AND '2020-12-11T00:00:00'::timestamp)\n        SELECT t1.osm_id,\n            t1.change_id as changeset_id,\n            t1.lat,\n            t1.lon,\n            t2.created_at,\n            ARRAY_TO_STRING(ARRAY_AGG(t1.unnest_status), ',') AS issues\n            FROM t1, t2 WHERE t1.change_id = t2.id\n            AND unnest_hashtags in ('missingmaps')\n            AND unnest_status in ('badgeom')\n            GROUP BY t1.osm_id, t1.lat, t1.lon, t2.created_at, t1.change_id;\n    "
+    test_data_quality_hashtags_query = "\n        SELECT v.osm_id,\n            v.change_id as changeset_id,\n            st_x(v.location) AS lat,\n            st_y(v.location) AS lon,\n            c.created_at,\n            ARRAY_TO_STRING(ARRAY_AGG(s.status), ',') AS issues\n        FROM changesets AS c\n        JOIN validation AS v ON v.change_id = c.id\n        CROSS JOIN LATERAL UNNEST(c.hashtags) AS h(hashtag)\n        CROSS JOIN LATERAL UNNEST(v.status) AS s(status)\n        WHERE c.created_at BETWEEN '2020-12-10T00:00:00'::timestamp AND '2020-12-11T00:00:00'::timestamp\n        AND c.hashtags && ARRAY['missingmaps']::text[]\n        AND h.hashtag = ANY(ARRAY['missingmaps']::text[])\n        AND v.status && ARRAY['badgeom']::status[]\n        AND s.status = ANY(ARRAY['badgeom']::status[])\n        \n        GROUP BY v.osm_id, st_x(v.location), st_y(v.location), c.created_at, v.change_id;\n    "
 
     params = DataQualityHashtagParams(**test_params)
     query = generate_data_quality_hashtag_reports(cur, params)
@@ -166,12 +194,22 @@ def test_data_quality_hashtags_query_builder():
         }
     }
 
-    test_data_quality_hashtags_query_no_hashtags = '\n        WITH t1 AS (SELECT osm_id, change_id, st_x(location) AS lat, st_y(location) AS lon, unnest(status) AS unnest_status from validation WHERE ST_CONTAINS(ST_GEOMFROMGEOJSON(\'{"coordinates": [[[-74.80708971619606, 11.002032789290594], [-74.80621799826622, 11.002032789290594], [-74.80621799826622, 11.00265678856572], [-74.80708971619606, 11.00265678856572], [-74.80708971619606, 11.002032789290594]]], "type": "Polygon"}\'), location)),\n        t2 AS (SELECT id, created_at, unnest(hashtags) AS unnest_hashtags from changesets WHERE created_at BETWEEN \'2020-12-10T00:00:00\'::timestamp AND \'2020-12-11T00:00:00\'::timestamp)\n        SELECT t1.osm_id,\n            t1.change_id as changeset_id,\n            t1.lat,\n            t1.lon,\n            t2.created_at,\n            ARRAY_TO_STRING(ARRAY_AGG(t1.unnest_status), \',\') AS issues\n            FROM t1, t2 WHERE t1.change_id = t2.id\n            \n            AND unnest_status in (\'badgeom\')\n            GROUP BY t1.osm_id, t1.lat, t1.lon, t2.created_at, t1.change_id;\n    '
+    test_data_quality_hashtags_query_no_hashtags = '\n        SELECT v.osm_id,\n            v.change_id as changeset_id,\n            st_x(v.location) AS lat,\n            st_y(v.location) AS lon,\n            c.created_at,\n            ARRAY_TO_STRING(ARRAY_AGG(s.status), \',\') AS issues\n        FROM changesets AS c\n        JOIN validation AS v ON v.change_id = c.id\n        CROSS JOIN LATERAL UNNEST(c.hashtags) AS h(hashtag)\n        CROSS JOIN LATERAL UNNEST(v.status) AS s(status)\n        WHERE c.created_at BETWEEN \'2020-12-10T00:00:00\'::timestamp AND \'2020-12-11T00:00:00\'::timestamp\n        \n        AND v.status && ARRAY[\'badgeom\']::status[]\n        AND s.status = ANY(ARRAY[\'badgeom\']::status[])\n        AND EXISTS (SELECT 1 FROM ST_Subdivide(ST_GeomFromGeoJSON(\'{"coordinates": [[[-74.80708971619606, 11.002032789290594], [-74.80621799826622, 11.002032789290594], [-74.80621799826622, 11.00265678856572], [-74.80708971619606, 11.00265678856572], [-74.80708971619606, 11.002032789290594]]], "type": "Polygon"}\'), 255) AS area(geom)\n            WHERE v.location && area.geom AND ST_Intersects(area.geom, v.location))\n        GROUP BY v.osm_id, st_x(v.location), st_y(v.location), c.created_at, v.change_id;\n    '
     params = DataQualityHashtagParams(**test_params)
     query = generate_data_quality_hashtag_reports(cur, params)
 
     assert query == test_data_quality_hashtags_query_no_hashtags
 
+    # Test multipolygon geometry, same area as a single part.
+    test_params["geometry"] = {
+        "type": "MultiPolygon",
+        "coordinates": [test_params["geometry"]["coordinates"]]
+    }
+    params = DataQualityHashtagParams(**test_params)
+    query = generate_data_quality_hashtag_reports(cur, params)
+
+    assert '"type": "MultiPolygon"' in query
+
     # Test no geometry, no hashtags. Raise a pydantic error.
     test_params = {
         "fromTimestamp": "2020-12-11T00:00:00",
@@ -225,6 +263,47 @@ def test_data_quality_hashtags_query_builder():
         params = DataQualityHashtagParams(**test_params)
 
 
+def test_data_quality_hashtag_report_rows():
+    """Hashtag report rows on the fixture, changesets without hashtags are left out and issues repeat once per matching hashtag"""
+    database.executequery(slurp('tests/src/fixtures/data_quality.sql'))
+    window = {"fromTimestamp": "2022-04-01T00:00:00", "toTimestamp": "2022-04-02T00:00:00", "outputType": "geojson"}
+    area = {"type": "Polygon", "coordinates": [[[85.2, 27.6], [85.4, 27.6], [85.4, 27.8], [85.2, 27.8], [85.2, 27.6]]]}
+
+    def report(**params):
+        query = generate_data_quality_hashtag_reports(cur, DataQualityHashtagParams(**window, **params))
+        return sorted((r["osm_id"], r["changeset_id"], r["lat"], r["lon"], str(r["created_at"]),
+                       sorted(r["issues"].split(","))) for r in database.executequery(query))
+
+    try:
+        assert report(hashtags=["missingmaps", "hotosm-project-1"], issueType=["badgeom", "badvalue"]) == [
+            (1, 2001, 85.3, 27.7, "2022-04-01 10:00:00", ["badgeom", "badgeom", "badvalue", "badvalue"])]
+        assert report(hashtags=["missingmaps"], issueType=["badgeom"]) == [
+            (1, 2001, 85.3, 27.7, "2022-04-01 10:00:00", ["badgeom"])]
+        assert report(geometry=area, issueType=["badgeom"]) == [
+            (1, 2001, 85.3, 27.7, "2022-04-01 10:00:00", ["badgeom", "badgeom"])]
+        assert report(hashtags=["mapathon"], issueType=["badvalue", "incomplete_tags"]) == [
+            (5, 2004, 86.5, 27.5, "2022-04-01 13:00:00", ["badvalue"])]
+        assert report(hashtags=["mapathon"], geometry=area, issueType=["badvalue"]) == []
+    finally:
+        # changesets are shared with the country stats fixture, which counts every changeset
+        database.executequery("DELETE FROM validation WHERE change_id BETWEEN 2001 AND 2005")
+        database.executequery("DELETE FROM changesets WHERE id BETWEEN 2001 AND 2005")
+
+def test_data_quality_tile_query():
+    """Function to test data quality vector tile query generator """
+    test_params = {
+        "hashtags": ["missingmaps"],
+        "issueType": ["badgeom"],
+        "fromTimestamp": "2020-12-10T00:00:00",
+        "toTimestamp": "2020-12-11T00:00:00"
+    }
+    expected_result = "\n        WITH bounds AS (SELECT ST_TileEnvelope(12, 100, 200) AS geom),\n        mvtgeom AS (\n            SELECT ST_AsMVTGeom(ST_Transform(v.location, 3857), bounds.geom) AS geom,\n                v.osm_id,\n                v.change_id AS changeset_id,\n                c.created_at,\n                ARRAY_TO_STRING(ARRAY(SELECT s FROM UNNEST(v.status) AS s WHERE s = ANY(ARRAY['badgeom']::status[])), ',') AS issues\n            FROM validation AS v\n            JOIN changesets AS c ON c.id = v.change_id, bounds\n            WHERE v.location && ST_Transform(bounds.geom, 4326)\n            AND c.created_at BETWEEN '2020-12-10T00:00:00'::timestamp AND '2020-12-11T00:00:00'::timestamp\n            AND v.status && ARRAY['badgeom']::status[]\n            AND c.hashtags && ARRAY['missingmaps']::text[]\n        )\n        SELECT ST_AsMVT(mvtgeom.*, 'data_quality') FROM mvtgeom;\n    "
+    params = DataQualityTileParams(**test_params)
+    query = generate_data_quality_tile_query(cur, params, 12, 100, 200)
+
+    assert query == expected_result
+
+
 def test_mapathon_total_contributor_mapathon_query_builder():
     default_total_contributor_query = '\n                SELECT COUNT(distinct user_id) as contributors_count\n                FROM osm_changeset\n                WHERE "created_at" between \'2021-08-27T09:00:00\'::timestamp AND \'2021-08-27T11:00:00\'::timestamp AND (("tags" -> \'hashtags\') ~~ \'%hotosm-project-11224;%\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-10042;%\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-9906;%\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-1381;%\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-11203;%\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-10681;%\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-8055;%\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-8732;%\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-11193;%\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-7305;%\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-11210;%\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-10985;%\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-10988;%\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-11190;%\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-6658;%\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-5644;%\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-10913;%\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-6495;%\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-4229;%\' OR ("tags" -> \'hashtags\') ~~ \'%mapandchathour2021;%\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-11224 %\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-10042 %\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-9906 %\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-1381 %\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-11203 %\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-10681 %\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-8055 %\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-8732 %\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-11193 %\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-7305 %\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-11210 %\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-10985 %\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-10988 %\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-11190 %\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-6658 %\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-5644 %\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-10913 %\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-6495 %\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-4229 %\' OR ("tags" -> \'comment\') ~~ \'%mapandchathour2021 %\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-11224\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-11224\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-10042\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-10042\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-9906\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-9906\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-1381\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-1381\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-11203\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-11203\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-10681\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-10681\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-8055\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-8055\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-8732\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-8732\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-11193\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-11193\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-7305\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-7305\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-11210\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-11210\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-10985\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-10985\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-10988\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-10988\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-11190\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-11190\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-6658\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-6658\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-5644\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-5644\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-10913\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-10913\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-6495\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-6495\' OR ("tags" -> \'hashtags\') ~~ \'%hotosm-project-4229\' OR ("tags" -> \'comment\') ~~ \'%hotosm-project-4229\' OR ("tags" -> \'hashtags\') ~~ \'%mapandchathour2021\' OR ("tags" -> \'comment\') ~~ \'%mapandchathour2021\')\n            '
     params = mapathon_validation.MapathonRequestParams(**test_param)
@@ -264,6 +343,238 @@ def test_mapathon_summary():
     expected_report=[['building', 'create', 827], ['natural', 'create', 117], ['building', 'modify', 27], ['highway', 'modify', 19], ['highway', 'create', 17], ['name', 'modify', 15], ['landuse', 'modify', 9], ['surface', 'modify', 8], ['addr:street', 'modify', 6], ['plinthlevel:height', 'modify', 6], ['roof:material', 'modify', 6], ['visual:condition', 'modify', 6], ['building:form', 'modify', 6], ['building:levels', 'modify', 6], ['building:material', 'modify', 6], ['landuse', 'create', 5], ['water', 'create', 4], ['natural', 'modify', 4], ['maxspeed', 'modify', 2], ['source', 'modify', 2], ['water', 'modify', 1], ['damage:event', 'modify', 1], ['ford', 'create', 1], ['ford', 'modify', 1], ['idp:camp_site', 'modify', 1], ['int_ref', 'modify', 1], ['man_made', 'modify', 1], ['name:en', 'modify', 1], ['name:ne', 'modify', 1], ['ref', 'modify', 1], ['shop', 'modify', 1], ['source:geometry', 'modify', 1], ['addr:housenumber', 'modify', 1]]
     assert result == expected_report
 
+def test_live_mapathon_increment():
+    """Live mapathon aggregate merged from increments matches the full mapathon summary"""
+    params = mapathon_validation.MapathonRequestParams(**test_param)
+    changeset_query, _, _ = mapathon_query_builder.create_changeset_query(params, con, cur)
+    expected_report = database.executequery(
+        mapathon_query_builder.create_osm_history_query(changeset_query, with_username=False))
+
+    state = app.LiveMapathonState(distinct=True, lookback=timedelta(hours=1),
+                                  to_timestamp=params.to_timestamp)
+    state.merge(database.executequery(
+        mapathon_query_builder.create_mapathon_increment_query(params, None, con, cur)))
+    # polling again without new changesets leaves the summary unchanged
+    state.merge(database.executequery(
+        mapathon_query_builder.create_mapathon_increment_query(params, state.since(), con, cur)))
+    result = [[f.feature, f.action, f.count] for f in state.summary().mapped_features]
+
+    assert sorted(result) == sorted([list(r) for r in expected_report])
+
+def test_changeset_hashtag_index():
+    """Mapathon summary filtered through changeset_hashtag matches the one filtered on changeset tags"""
+    params = mapathon_validation.MapathonRequestParams(**test_param)
+    changeset_query, _, _ = mapathon_query_builder.create_changeset_query(params, con, cur)
+    expected_report = database.executequery(
+        mapathon_query_builder.create_osm_history_query(changeset_query, with_username=False))
+
+    hashtag_index = ChangesetHashtagIndex(db_params=db_dict)
+    hashtag_index.create()
+    hashtag_index.update()
+
+    if not config.has_section("HASHTAG_INDEX"):
+        config.add_section("HASHTAG_INDEX")
+    config.set("HASHTAG_INDEX", "enabled", "true")
+    try:
+        changeset_query, _, _ = mapathon_query_builder.create_changeset_query(params, con, cur)
+        assert "changeset_hashtag" in changeset_query
+        result = database.executequery(
+            mapathon_query_builder.create_osm_history_query(changeset_query, with_username=False))
+    finally:
+        config.set("HASHTAG_INDEX", "enabled", "false")
+
+    assert sorted(result) == sorted(expected_report)
+
+def test_changeset_hashtag_index_unindexed_tail():
+    """Changesets created after the last index update are still counted through their tags"""
+    params = mapathon_validation.MapathonRequestParams(**test_param)
+    hashtag_index = ChangesetHashtagIndex(db_params=db_dict)
+    hashtag_index.create()
+    hashtag_index.update()
+
+    def contributors():
+        changeset_query, _, _ = mapathon_query_builder.create_changeset_query(params, con, cur)
+        return database.executequery(
+            f"SELECT COUNT(*), COUNT(*) FILTER (WHERE user_id = 990101) FROM ({changeset_query}) AS t1")[0]
+
+    if not config.has_section("HASHTAG_INDEX"):
+        config.add_section("HASHTAG_INDEX")
+    config.set("HASHTAG_INDEX", "enabled", "true")
+    try:
+        count, _ = contributors()
+        database.executequery(cur.mogrify(
+            """INSERT INTO osm_changeset (id, user_id, created_at, user_name, tags)
+               VALUES (%s, %s, %s, %s, hstore('hashtags', %s))""",
+            (910000001, 990101, "2021-08-27T10:30:00", "late-mapper", "mapandchathour2021")))
+        con.commit()
+        # not indexed yet
+        assert contributors() == (count + 1, 1)
+        hashtag_index.update()
+        assert contributors() == (count + 1, 1)
+    finally:
+        config.set("HASHTAG_INDEX", "enabled", "false")
+        database.executequery("DELETE FROM osm_changeset WHERE id = 910000001")
+        database.executequery("DELETE FROM changeset_hashtag WHERE changeset_id = 910000001")
+        con.commit()
+
+def test_multi_mapathon_summary():
+    """Every event of a multi mapathon query has the summary it gets on its own"""
+    events = [
+        dict(test_param, name="projects", hashtags=[]),
+        dict(test_param, name="hashtag", project_ids=[], fromTimestamp="2021-08-27T10:00:00"),
+    ]
+    params = mapathon_validation.MultiMapathonRequestParams(events=events)
+    rows = database.executequery(
+        mapathon_query_builder.create_multi_mapathon_summary_query(params.events, con, cur))
+
+    for position, event in enumerate(params.events):
+        changeset_query, _, _ = mapathon_query_builder.create_changeset_query(event, con, cur)
+        expected_features = database.executequery(
+            mapathon_query_builder.create_osm_history_query(changeset_query, with_username=False))
+        expected_contributors = database.executequery(
+            f"SELECT COUNT(distinct user_id) FROM ({changeset_query}) AS t1")[0][0]
+        features = [(r[1], r[2], r[3]) for r in rows if r[0] == position and r[1] is not None]
+        contributors = [r[3] for r in rows if r[0] == position and r[1] is None]
+        assert sorted(features) == sorted(tuple(r) for r in expected_features)
+        # events without changesets have no contributors row
+        assert (contributors or [0]) == [expected_contributors]
+
+def test_osm_users_resolution():
+    """User names resolved through osm_users give the users found in changesets of the time range"""
+    params = mapathon_validation.MapathonRequestParams(**test_param)
+    user_names = [r[0] for r in database.executequery(cur.mogrify(
+        "SELECT DISTINCT user_name FROM osm_changeset WHERE created_at BETWEEN %s AND %s",
+        (params.from_timestamp, params.to_timestamp)))]
+    user_names.append("not-a-mapper")
+    expected_users = database.executequery(cur.mogrify(
+        "SELECT DISTINCT user_id, user_name FROM osm_changeset WHERE created_at BETWEEN %s AND %s AND user_name = ANY(%s)",
+        (params.from_timestamp, params.to_timestamp, user_names)))
+
+    osm_users = OsmUsersIndex(db_params=db_dict)
+    osm_users.create()
+    osm_users.update()
+
+    resolver = UserNameResolver()
+    for _ in range(2):
+        # second round is served from the cache
+        users_db = app.Database(db_dict)
+        users = resolver.resolve(users_db, user_names, params.from_timestamp, params.to_timestamp)
+        assert sorted(users) == sorted(tuple(r) for r in expected_users)
+
+def test_osm_users_resolution_gaps():
+    """Ids are only matched by changesets inside the time range, with aware timestamps, and names taken after the table was indexed are found"""
+    changeset = "INSERT INTO osm_changeset (id, user_id, created_at, user_name) VALUES (%s, %s, %s, 'gap-mapper')"
+    for changeset_id, user_id, created_at in ((900000001, 990001, "2021-08-01T10:00:00"),
+                                              (900000002, 990001, "2021-08-20T10:00:00")):
+        database.executequery(cur.mogrify(changeset, (changeset_id, user_id, created_at)))
+    con.commit()
+    try:
+        osm_users = OsmUsersIndex(db_params=db_dict)
+        osm_users.create()
+        osm_users.update()
+        resolver = UserNameResolver()
+        users_db = app.Database(db_dict)
+        try:
+            window = UsersListParams(userNames=["gap-mapper"], fromTimestamp="2021-08-05T00:00:00Z",
+                                     toTimestamp="2021-08-15T00:00:00+02:00")
+            assert resolver.resolve(users_db, window.user_names, window.from_timestamp, window.to_timestamp) == []
+            # 10:00 UTC is inside a range starting at 11:30 of UTC+2
+            edge = UsersListParams(userNames=["gap-mapper"], fromTimestamp="2021-08-20T11:30:00+02:00",
+                                   toTimestamp="2021-08-21T00:00:00Z")
+            assert resolver.resolve(users_db, edge.user_names, edge.from_timestamp, edge.to_timestamp) == [(990001, "gap-mapper")]
+            assert resolver.resolve(users_db, ["gap-mapper"], edge.to_timestamp, edge.to_timestamp) == []
+
+            # name taken by another id after the table was indexed, the cached name still finds it
+            database.executequery(cur.mogrify(changeset, (900000003, 990002, "2021-09-01T10:00:00")))
+            con.commit()
+            users = resolver.resolve(users_db, ["gap-mapper"], datetime(2021, 8, 1), datetime(2021, 9, 2))
+            assert sorted(users) == [(990001, "gap-mapper"), (990002, "gap-mapper")]
+        finally:
+            users_db.close_conn()
+    finally:
+        database.executequery("DELETE FROM osm_changeset WHERE id IN (900000001, 900000002, 900000003)")
+        con.commit()
+
+def test_schema_indexes():
+    """Missing insight indexes are created concurrently and found by the check afterwards"""
+    indexes = schema.required_indexes("insight")
+    index_con = psycopg2.connect(**db_dict)
+    try:
+        missing = schema.missing_indexes(index_con, indexes)
+        schema.create_indexes(index_con, missing)
+        assert schema.missing_indexes(index_con, indexes) == []
+    finally:
+        index_con.close()
+
+def test_country_index_lookup():
+    """Point and bbox lookups of the in process country index respect holes and every part of multipolygons"""
+    index = CountryIndex([
+        ({"name": "square", "iso3": "SQR"},
+         {"type": "Polygon", "coordinates": [[[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]],
+                                             [[4, 4], [6, 4], [6, 6], [4, 6], [4, 4]]]}),
+        ({"name": "islands", "iso3": "ISL"},
+         {"type": "MultiPolygon", "coordinates": [[[[20, 0], [22, 0], [22, 2], [20, 0]]],
+                                                  [[[-50, -50], [-48, -50], [-48, -48], [-50, -48], [-50, -50]]]]}),
+    ])
+    assert index.lookup_point(1, 1) == [{"name": "square", "iso3": "SQR"}]
+    assert index.lookup_point(5, 5) == []
+    assert index.lookup_point(-49, -49) == [{"name": "islands", "iso3": "ISL"}]
+    assert index.lookup_bbox(4.5, 4.5, 5.5, 5.5) == []
+    assert index.lookup_bbox(1, 1, 2, 2) == [{"name": "square", "iso3": "SQR"}]
+    assert index.lookup_bbox(21.5, 0.1, 30, 0.2) == [{"name": "islands", "iso3": "ISL"}]
+    assert index.lookup_bbox(22.1, 1.5, 30, 1.6) == []
+    assert [c["name"] for c in index.lookup_bbox(-60, -60, 60, 60)] == ["square", "islands"]
+
+def test_country_stats_query():
+    """Full days of a /changesets range are read from daily country stats and only the partial ends from changeset_country"""
+    start, end = datetime(2022, 3, 1, 10, 30), datetime(2022, 3, 4, 8, 0)
+    assert full_days(start, end) == (date(2022, 3, 2), date(2022, 3, 4))
+    assert full_days(start, datetime(2022, 3, 2, 12, 0)) is None
+    assert full_days(None, end) == (None, date(2022, 3, 4))
+
+    query = create_country_stats_query(["Nepal"], start, end, None, cur)
+    assert "day >= '2022-03-02'::date AND day < '2022-03-04'::date" in query
+    assert "(created_at > '2022-03-01T10:30:00'::timestamp AND created_at < '2022-03-02'::date)" in query
+    assert "(created_at >= '2022-03-04'::date AND created_at <= '2022-03-04T08:00:00'::timestamp)" in query
+
+    hashtag_query = create_country_stats_query(["Nepal"], start, end, "hotosm-project-1", cur)
+    assert "'hotosm-project-1' = ANY(hashtags)" in hashtag_query
+    assert "created_at > '2022-03-01T10:30:00'::timestamp AND created_at <= '2022-03-04T08:00:00'::timestamp" in hashtag_query
+    assert "AND false" in hashtag_query
+
+def test_country_stats_matches_changesets():
+    """/changesets answered from the country aggregates matches the query reading changesets, also after an open changeset changed"""
+    database.executequery(slurp('tests/src/fixtures/country_stats.sql'))
+    con.commit()
+    country_stats = CountryStatsIndex(batch_size=3, db_params=db_dict)
+    country_stats.create()
+    assert country_stats.update() == 11
+
+    def compare():
+        for iso3 in ("NPL", "IND"):
+            for start, end, hashtag in (("2022-03-01T10:30:00", "2022-03-04T08:00:00", None),
+                                        ("2022-03-01T10:30:00", "2022-03-04T08:00:00", "hotosm-project-1"),
+                                        ("2022-03-02", "2022-03-04", None),
+                                        ("2022-03-01T12:00:00", "2022-03-01T23:00:00", None),
+                                        (None, None, None)):
+                params = FilterParams(type="iso3", value=iso3, hashtag=hashtag,
+                                      startDatetime=start, endDatetime=end)
+                expected = fetch_changesets(create_changesets_query(params), db_dict)
+                expected = ChangesetResult(**dict(expected[0])) if expected else None
+                result = fetch_country_stats(params, db_dict)
+                if expected is None:
+                    assert result.total_changesets == 0
+                else:
+                    assert result == expected, (iso3, start, end, hashtag)
+
+    compare()
+    # the last changeset is still open and keeps growing, it is inside the lookback of the next update
+    database.executequery("""UPDATE changesets SET added = added || '"highway"=>"9", "highway_km"=>"3100"'::hstore
+        WHERE id = 1011""")
+    con.commit()
+    assert country_stats.update() > 0
+    compare()
+
 def test_output_JSON():
     """Function to test to_json functionality of Output Class """
     global summary_query
@@ -280,6 +591,13 @@ def test_output_JSON():
     # print(jsonresult)
     assert jsonresult == exp_result
 
+def test_output_JSON_types():
+    """Numeric and timestamp columns are written as JSON numbers and ISO timestamps"""
+    query = "SELECT 1.5::numeric AS c, '2021-01-01 00:00:00'::timestamp AS d, '2021-01-02'::date AS e, 3 AS n"
+    assert Output(query, con).to_JSON() == '[{"c":1.5,"d":"2021-01-01T00:00:00","e":"2021-01-02","n":3}]'
+    rows = [{"c": Decimal("1.5"), "d": datetime(2021, 1, 1), "n": 3}]
+    assert Output(rows).to_JSON() == '[{"c":1.5,"d":"2021-01-01T00:00:00","n":3}]'
+
 def test_output_CSV():
     """Function to test to_CSV functionality of Output Class """
     global filepath
@@ -288,6 +606,38 @@ def test_output_CSV():
     # print(csv_out)
     assert os.path.isfile(filepath) == True
 
+def test_output_pandas_backend():
+    """Function to test native Output results match the pandas backend """
+    native = Output(summary_query, con)
+    dataframe = Output(summary_query, con, backend="pandas")
+    assert native.to_JSON() == dataframe.to_JSON()
+    assert native.to_list() == dataframe.to_list()
+    assert native.to_dict() == dataframe.to_dict()
+
+def test_output_parquet():
+    """Function to test to_parquet functionality of Output Class """
+    import io
+    import pyarrow.parquet
+    stream = io.BytesIO()
+    Output(summary_query, con).to_parquet(stream)
+    table = pyarrow.parquet.read_table(io.BytesIO(stream.getvalue()))
+    assert table.to_pylist() == Output(summary_query, con).to_dict()
+
+def test_mapathon_summary_underpass_query():
+    """Mapathon summary of underpass expands added and modified tags of changesets in one pass"""
+    test_params = {
+        "fromTimestamp": "2021-08-27T9:00:00",
+        "toTimestamp": "2021-08-27T11:00:00",
+        "projectIds": [11224, 10042],
+        "hashtags": ["mapandchathour2021"]
+    }
+    validated_params = mapathon_validation.MapathonRequestParams(**test_params)
+    expected_summary_query = 'select t2.key as feature, t1.action, sum(t2.value::Integer) as count\n        from changesets,\n        lateral (values (\'create\'::text, added), (\'modify\'::text, modified)) as t1(action, tags),\n        lateral each(t1.tags) as t2\n        where  ("created_at" between \'2021-08-27T09:00:00\'::timestamp AND \'2021-08-27T11:00:00\'::timestamp) AND (hashtags && ARRAY[\'hotosm-project-11224\',\'hotosm-project-10042\',\'mapandchathour2021\']::text[])\n        group by t2.key, t1.action\n        order by count desc '
+    expected_contributor_query = 'select  COUNT(distinct user_id) as contributors_count\n        from changesets\n        where  ("created_at" between \'2021-08-27T09:00:00\'::timestamp AND \'2021-08-27T11:00:00\'::timestamp) AND (hashtags && ARRAY[\'hotosm-project-11224\',\'hotosm-project-10042\',\'mapandchathour2021\']::text[])\n        '
+    summary_query, contributor_query = mapathon_query_builder.generate_mapathon_summary_underpass_query(validated_params, cur)
+    assert summary_query == expected_summary_query
+    assert contributor_query == expected_contributor_query
+
 def test_data_quality_TM_query():
     """Function to test data quality TM query generator of Data Quality Class """
     data_quality_params= {
@@ -298,12 +648,28 @@ def test_data_quality_TM_query():
         "output_type": "geojson"
     }
     validated_params=DataQuality_TM_RequestParams(**data_quality_params)
-    expected_result="   with t1 as (\n        select id\n                From changesets \n                WHERE\n                  'hotosm-project-9928'=ANY(hashtags) OR 'hotosm-project-4730'=ANY(hashtags) OR 'hotosm-project-5663'=ANY(hashtags)\n            ),\n        t2 AS (\n             SELECT osm_id as Osm_id,\n                change_id as Changeset_id,\n                timestamp::text as Changeset_timestamp,\n                status::text as Issue_type,\n                ST_X(location::geometry) as lng,\n                ST_Y(location::geometry) as lat\n\n        FROM validation join t1 on change_id = t1.id\n        WHERE\n        'badgeom'=ANY(status) OR 'badvalue'=ANY(status)\n                )\n        select *\n        from t2\n        "
-    query_result=generate_data_quality_TM_query(validated_params)
+    expected_result="   with t1 as (\n        select id\n                From changesets \n                WHERE\n                  hashtags && ARRAY['hotosm-project-9928','hotosm-project-4730','hotosm-project-5663']::text[]\n            ),\n        t2 AS (\n             SELECT osm_id as Osm_id,\n                change_id as Changeset_id,\n                timestamp::text as Changeset_timestamp,\n                status::text as Issue_type,\n                ST_X(location::geometry) as lng,\n                ST_Y(location::geometry) as lat\n\n        FROM validation join t1 on change_id = t1.id\n        WHERE\n        status && ARRAY['badgeom','badvalue']::status[]\n                )\n        select *\n        from t2\n        "
+    query_result=generate_data_quality_TM_query(validated_params,cur)
     # print(query_result.encode('utf-8'))
 
     assert query_result == expected_result
 
+def test_data_quality_grid_query():
+    """Function to test grid aggregation query of data quality reports"""
+    data_quality_params = {
+        "projectIds": [9928],
+        "issueTypes": ["badgeom"],
+        "outputType": "grid",
+        "gridShape": "square",
+        "gridSize": 5000
+    }
+    validated_params = DataQuality_TM_RequestParams(**data_quality_params)
+    expected_result = "\n        WITH report AS (SELECT 1 AS lng, 2 AS lat, 'badgeom' AS issue_type),\n        points AS (\n            SELECT ST_Transform(ST_SetSRID(ST_MakePoint(lng, lat), 4326), 3857) AS geom, issue\n            FROM report, UNNEST(string_to_array(trim(both '{}' from issue_type), ',')) AS issue\n            WHERE issue = ANY(ARRAY['badgeom']::text[])),\n        counts AS (\n            SELECT cell.i, cell.j, points.issue, count(*) AS count\n            FROM points, LATERAL (\n                SELECT c.i, c.j FROM ST_SquareGrid(5000::float8, points.geom) AS c\n                WHERE ST_Intersects(c.geom, points.geom) LIMIT 1) AS cell\n            GROUP BY cell.i, cell.j, points.issue),\n        cells AS (\n            SELECT json_build_object('type', 'Feature',\n                'geometry', ST_AsGeoJSON(ST_Transform(ST_SetSRID(ST_Square(5000::float8, i, j), 3857), 4326))::json,\n                'properties', json_build_object('counts', json_object_agg(issue, count), 'total', sum(count))) AS feature\n            FROM counts\n            GROUP BY i, j)\n        SELECT json_build_object('type', 'FeatureCollection', 'features', COALESCE(json_agg(feature), '[]'::json))\n        FROM cells\n    "
+    query_result = generate_data_quality_grid_query(
+        cur, "SELECT 1 AS lng, 2 AS lat, 'badgeom' AS issue_type", "lng", "lat", "issue_type",
+        validated_params.issue_types, validated_params.grid_shape, validated_params.grid_size)
+    assert query_result == expected_result
+
 def test_data_quality_username_query():
     """Function to test data quality username query generator of Data Quality Class """
     data_quality_params= {
@@ -316,8 +682,8 @@ def test_data_quality_username_query():
     "output_type": "geojson"
 }
     validated_params=DataQuality_username_RequestParams(**data_quality_params)
-    expected_result="   with t1 as (\n        select id,username as username\n                From users \n                WHERE\n                  'MANUEL_PC'=username OR 'piticasuno'=username OR 'LCrawford1833'=username\n            ),\n        t2 AS (\n             SELECT osm_id as Osm_id,\n                change_id as Changeset_id,\n                timestamp::text as Changeset_timestamp,\n                status::text as Issue_type,\n                t1.username as username,\n                ST_X(location::geometry) as lng,\n                ST_Y(location::geometry) as lat\n                \n        FROM validation join t1 on user_id = t1.id  \n        WHERE\n        ('badgeom'=ANY(status) OR 'badvalue'=ANY(status)) AND (timestamp between '2021-10-07 09:00:00' and  '2021-10-07 11:00:00')\n                )\n        select *\n        from t2\n        order by username\n        "
-    query_result=generate_data_quality_username_query(validated_params)
+    expected_result="   with t1 as (\n        select id,username as username\n                From users \n                WHERE\n                  username = ANY(ARRAY['MANUEL_PC','piticasuno','LCrawford1833'])\n            ),\n        t2 AS (\n             SELECT osm_id as Osm_id,\n                change_id as Changeset_id,\n                timestamp::text as Changeset_timestamp,\n                status::text as Issue_type,\n                t1.username as username,\n                ST_X(location::geometry) as lng,\n                ST_Y(location::geometry) as lat\n                \n        FROM validation join t1 on user_id = t1.id  \n        WHERE\n        (status && ARRAY['badgeom','badvalue']::status[]) AND (timestamp between '2021-10-07 09:00:00' and  '2021-10-07 11:00:00')\n                )\n        select *\n        from t2\n        order by username\n        "
+    query_result=generate_data_quality_username_query(validated_params,cur)
     print(query_result.encode('utf-8'))
     assert query_result == expected_result
 
@@ -355,3 +721,853 @@ def test_userstats_get_statistics_query():
     query_result=create_UserStats_get_statistics_query(validated_params,con,cur)
     # print(query_result)
     assert query_result == expected_result.encode('utf-8')
+
+
+def report_test_client(**cache_options):
+    """Test client of a small app behind the report cache and compression middlewares, calls counts how many times each report was computed"""
+    calls = {"report": 0, "stream": 0, "tile": 0, "edition": ""}
+
+    async def report(request):
+        calls["report"] += 1
+        return PlainTextResponse("x" * 2000 + request.headers.get("access-token", "") + calls["edition"])
+
+    async def stream(request):
+        calls["stream"] += 1
+
+        def chunks():
+            for i in range(3):
+                yield f"{i}\n" * 1000
+        return StreamingResponse(chunks(), media_type="application/x-ndjson")
+
+    async def tile(request):
+        calls["tile"] += 1
+        return PlainTextResponse("tile")
+
+    app = Starlette(routes=[Route("/data-quality/report", report, methods=["GET", "POST"]),
+                            Route("/data-quality/stream", stream),
+                            Route("/data-quality/tiles/1/0/0.mvt", tile)])
+    app = ReportCacheMiddleware(app, paths=("/data-quality",), exclude_paths=("/data-quality/tiles",),
+                                **cache_options)
+    app = CompressionMiddleware(app, minimum_size=1024)
+    return TestClient(app), calls
+
+def test_report_cache_etag():
+    """Repeated reports are served from the cache and a matching If-None-Match is answered with 304"""
+    client, calls = report_test_client()
+    first = client.post("/data-quality/report", data=b"{}")
+    assert first.status_code == 200 and "etag" in first.headers
+    second = client.post("/data-quality/report", data=b"{}")
+    assert second.headers["etag"] == first.headers["etag"]
+    assert second.text == first.text
+    not_modified = client.post("/data-quality/report", data=b"{}",
+                               headers={"If-None-Match": first.headers["etag"]})
+    assert not_modified.status_code == 304 and not_modified.content == b""
+    assert calls["report"] == 1
+    client.post("/data-quality/report", data=b'{"other": 1}')
+    assert calls["report"] == 2
+
+def test_report_cache_etag_stable():
+    """ETag depends on the request and the content only, so it is the same on every worker and after the entry is filled again"""
+    client, calls = report_test_client()
+    other_worker, other_calls = report_test_client()
+    etag = client.get("/data-quality/report").headers["etag"]
+    assert other_worker.get("/data-quality/report").headers["etag"] == etag
+    # the other worker does not have the report cached yet, it is computed but not sent again
+    other_worker.app.app.cache.clear()
+    not_modified = other_worker.get("/data-quality/report", headers={"If-None-Match": etag})
+    assert not_modified.status_code == 304 and not_modified.headers["etag"] == etag
+    assert other_calls["report"] == 2
+
+    client.app.app.cache.clear()
+    assert client.get("/data-quality/report").headers["etag"] == etag
+    client.app.app.cache.clear()
+    calls["edition"] = "2"
+    changed = client.get("/data-quality/report", headers={"If-None-Match": etag})
+    assert changed.status_code == 200 and changed.text.endswith("2")
+    assert changed.headers["etag"] != etag
+
+def test_report_cache_access_token_isolation():
+    """Responses cached for one access token are never served to another one"""
+    client, calls = report_test_client()
+    first = client.get("/data-quality/report", headers={"Access-Token": "one"})
+    second = client.get("/data-quality/report", headers={"Access-Token": "two"})
+    assert first.text.endswith("one") and second.text.endswith("two")
+    assert first.headers["etag"] != second.headers["etag"]
+    client.get("/data-quality/report", headers={"Access-Token": "one"})
+    assert calls["report"] == 2
+
+def test_report_cache_passthrough():
+    """Bodies above the size cutoff, streamed reports and excluded paths are not cached"""
+    client, calls = report_test_client(max_body_size=1000)
+    for _ in range(2):
+        response = client.get("/data-quality/report")
+        assert len(response.text) == 2000 and "etag" not in response.headers
+    assert calls["report"] == 2
+
+    client, calls = report_test_client()
+    for _ in range(2):
+        response = client.get("/data-quality/stream")
+        assert response.text.count("\n") == 3000 and "etag" not in response.headers
+        client.get("/data-quality/tiles/1/0/0.mvt")
+    assert calls["stream"] == 2 and calls["tile"] == 2
+
+def test_compression_headers():
+    """Bodies above the minimum size are compressed with Vary and Content-Encoding, small ones are sent as they are"""
+    client, calls = report_test_client()
+    response = client.get("/data-quality/report", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["vary"]
+    assert response.text == "x" * 2000
+    streamed = client.get("/data-quality/stream", headers={"Accept-Encoding": "gzip"})
+    assert streamed.headers["content-encoding"] == "gzip"
+    assert streamed.text.count("\n") == 3000
+    small = client.get("/data-quality/tiles/1/0/0.mvt", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in small.headers and small.text == "tile"
+    plain = client.get("/data-quality/report", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in plain.headers
+
+
+def write_manifest(directory, entries):
+    path = directory.join("manifest.json")
+    path.write(json.dumps(entries))
+    return str(path)
+
+project_report = {"name": "project-9928", "kind": "data-quality-project",
+                  "params": {"projectIds": [9928], "issueTypes": ["badgeom"], "outputType": "csv"}}
+
+def test_batch_read_manifest(tmpdir):
+    """Manifest entries are validated before anything runs, unnamed reports are named after kind and parameters"""
+    unnamed = {"kind": "data-quality-project", "params": dict(project_report["params"], outputType="grid")}
+    reports = batch.read_manifest(write_manifest(tmpdir, [project_report, unnamed]))
+    assert [report.filename for report in reports][0] == "project-9928.csv"
+    assert reports[1].name.startswith("data-quality-project-") and reports[1].filename.endswith(".geojson")
+
+    for entries, message in (([{"kind": "unknown", "params": {}}], "Report 0 of manifest is invalid"),
+                             ([project_report, {"kind": "data-quality-project", "params": {}}], "Report 1"),
+                             ([project_report, project_report], "not unique : project-9928")):
+        with pytest.raises(ValueError) as err:
+            batch.read_manifest(write_manifest(tmpdir, entries))
+        assert message in str(err.value)
+
+def test_batch_cli_invalid_manifest(tmpdir, capsys):
+    """An invalid manifest is reported as a message with a non zero exit status instead of a traceback"""
+    assert cli.main(["batch", write_manifest(tmpdir, [{"kind": "unknown"}])]) != 0
+    assert "Report 0 of manifest is invalid" in capsys.readouterr().err
+    tmpdir.join("broken.json").write("[{")
+    assert cli.main(["batch", str(tmpdir.join("broken.json"))]) != 0
+    assert cli.main(["batch", str(tmpdir.join("missing.json"))]) != 0
+
+def test_batch_resume(tmpdir, monkeypatch):
+    """Reports already written are skipped on the next run and timings are printed slowest first"""
+    def write_report(params, path):
+        with open(path, "w") as f:
+            f.write(",".join(str(project_id) for project_id in params.project_ids))
+
+    monkeypatch.setitem(batch.JOB_KINDS, "data-quality-project",
+                        (batch.JOB_KINDS["data-quality-project"][0], write_report))
+    second_report = dict(project_report, name="project-11224",
+                         params=dict(project_report["params"], projectIds=[11224]))
+    reports = batch.read_manifest(write_manifest(tmpdir, [project_report, second_report]))
+    output = tmpdir.join("reports")
+    output.mkdir()
+    output.join("project-9928.csv").write("already written")
+
+    summary = batch.run_batch(reports, str(output), workers=2, threads=True, progress=None)
+    assert [record["status"] for record in summary] == [batch.SKIPPED, batch.FINISHED]
+    assert output.join("project-9928.csv").read() == "already written"
+    assert output.join("project-11224.csv").read() == "11224"
+    assert json.loads(output.join(batch.SUMMARY_FILENAME).read()) == summary
+
+    summary = batch.run_batch(reports, str(output), threads=True, progress=None)
+    assert [record["status"] for record in summary] == [batch.SKIPPED, batch.SKIPPED]
+
+    out = io.StringIO()
+    batch.print_timings([{"name": "fast", "status": batch.FINISHED, "seconds": 0.5},
+                         {"name": "slow", "status": batch.FINISHED, "seconds": 2.0},
+                         {"name": "broken", "status": batch.FAILED, "seconds": None},
+                         {"name": "kept", "status": batch.SKIPPED, "seconds": None}], out=out)
+    lines = out.getvalue().splitlines()
+    assert lines[0].endswith("slow") and lines[1].endswith("fast")
+    assert lines[2] == "2 finished, 1 failed, 1 skipped, 2.500s of report time"
+
+
+def mapathon_summary(total_contributors, **counts):
+    return mapathon_validation.MapathonSummary(
+        total_contributors=total_contributors,
+        mapped_features=[mapathon_validation.MappedFeature(feature=f, action="create", count=c)
+                         for f, c in counts.items()])
+
+def live_feed_params(from_timestamp, to_timestamp):
+    return {"from_timestamp": from_timestamp, "to_timestamp": to_timestamp,
+            "project_ids": [11224], "hashtags": [], "source": "insight"}
+
+def test_live_feed_window():
+    """Live windows compare timestamps as naive UTC whatever their time zones"""
+    aware = datetime(2021, 8, 27, 11, 0, tzinfo=timezone(timedelta(hours=2)))
+    feed = live.MapathonFeed("key", live_feed_params(aware, datetime(2021, 8, 27, 9, 30)), "insight")
+    params = feed.window_params()
+    assert (params.from_timestamp, params.to_timestamp) == (datetime(2021, 8, 27, 9, 0), datetime(2021, 8, 27, 9, 30))
+    feed = live.MapathonFeed("key", live_feed_params(datetime(2021, 8, 27, 9, 0),
+                                                     datetime(2021, 8, 27, 12, 0, tzinfo=timezone.utc)), "insight")
+    assert feed.window_params().to_timestamp == datetime(2021, 8, 27, 12, 0)
+    upcoming = datetime.now(timezone.utc) + timedelta(hours=1)
+    assert live.MapathonFeed("key", live_feed_params(upcoming, None), "insight").window_params() is None
+    # same mapathon in another time zone is the same feed
+    try:
+        assert live.get_feed(live_feed_params(aware, None), "insight") is live.get_feed(
+            live_feed_params(datetime(2021, 8, 27, 9, 0), None), "insight")
+    finally:
+        live.feeds.clear()
+
+def test_live_feed_events():
+    """Subscribers get a snapshot then deltas of changed counts, a subscriber that fell behind is resynchronised with a snapshot"""
+    feed = live.MapathonFeed("key", live_feed_params(datetime(2021, 8, 27, 9, 0), None), "insight")
+    assert feed.update(mapathon_summary(2, building=10, highway=3)).startswith("event: snapshot")
+    assert feed.update(mapathon_summary(2, building=10, highway=3)) is None
+    delta = feed.update(mapathon_summary(3, building=12, highway=3))
+    assert delta.startswith("event: delta")
+    data = json.loads(delta.split("data: ", 1)[1])
+    assert data["contributorsChange"] == 1
+    assert data["mappedFeatures"] == [{"feature": "building", "action": "create", "count": 12, "change": 2}]
+
+    queue = asyncio.Queue(maxsize=2)
+    feed.subscribers.add(queue)
+    for _ in range(3):
+        feed.publish("event: delta\n\n")
+    assert queue.qsize() == 1 and queue.get_nowait().startswith("event: snapshot")
+
+def test_live_feed_stream(caplog):
+    """Feeds stream events computed in the background, failed computations are logged and the feed keeps going"""
+    summaries = [RuntimeError("database went away"), mapathon_summary(1, building=1), mapathon_summary(2, building=4)]
+
+    class Feed(live.MapathonFeed):
+        def compute(self):
+            result = summaries.pop(0) if summaries else mapathon_summary(2, building=4)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+    async def read_events():
+        feed = Feed("stream", live_feed_params(datetime(2021, 8, 27, 9, 0), None), "insight", interval=0.01)
+        live.feeds[feed.key] = feed
+        stream = live.stream_feed(feed)
+        events = [await stream.__anext__(), await stream.__anext__()]
+        await stream.aclose()
+        await asyncio.wait_for(feed.task, 1)
+        return feed, events
+
+    feed, events = asyncio.run(read_events())
+    assert events[0].startswith("event: snapshot") and events[1].startswith("event: delta")
+    assert feed.subscribers == set() and "stream" not in live.feeds
+    assert "Live mapathon stream update failed" in caplog.text
+
+
+class ThreadJobQueue(jobs.JobQueue):
+    """Job queue running jobs in threads, so reports can be replaced in tests"""
+
+    def get_executor(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        return self.executor
+
+def wait_for_job(queue, job_id, statuses=(jobs.FINISHED, jobs.FAILED)):
+    for _ in range(500):
+        job = queue.status(job_id)
+        if job["status"] in statuses:
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"Job {job_id} is {job['status']}")
+
+def test_job_queue(tmpdir, monkeypatch):
+    """Jobs with the same parameters are run once across queues sharing a directory, results are readable once finished"""
+    release = threading.Event()
+
+    def write_report(params, path):
+        release.wait(5)
+        with open(path, "w") as f:
+            f.write(",".join(str(project_id) for project_id in params.project_ids))
+
+    monkeypatch.setitem(jobs.JOB_KINDS, "data-quality-project",
+                        (jobs.JOB_KINDS["data-quality-project"][0], write_report))
+    params = DataQuality_TM_RequestParams(projectIds=[9928], issueTypes=["badgeom"], outputType="csv")
+    first_queue, second_queue = ThreadJobQueue(str(tmpdir)), ThreadJobQueue(str(tmpdir))
+    try:
+        job = first_queue.submit("data-quality-project", params)
+        # another web worker sharing the directory gets the job already queued
+        assert second_queue.submit("data-quality-project", params)["id"] == job["id"]
+        owned = second_queue.submit("data-quality-project", params, owner=1)
+        assert owned["id"] != job["id"]
+        assert first_queue.result_path(job["id"]) is None
+        release.set()
+        assert wait_for_job(first_queue, job["id"])["status"] == jobs.FINISHED
+        wait_for_job(second_queue, owned["id"])
+        with open(second_queue.result_path(job["id"])) as f:
+            assert f.read() == "9928"
+        assert first_queue.status("missing") is None and first_queue.status("../etc") is None
+
+        # done jobs are not returned again
+        for _ in range(100):
+            if not os.path.exists(first_queue.pending_path(jobs.cache_key(
+                    "data-quality-project", json.loads(params.json()), None))):
+                break
+            time.sleep(0.01)
+        assert first_queue.submit("data-quality-project", params)["id"] != job["id"]
+    finally:
+        release.set()
+        first_queue.executor.shutdown()
+        second_queue.executor.shutdown()
+
+def test_job_routes(tmpdir, monkeypatch):
+    """Job status and download need a login and owned jobs are only readable by their owner"""
+    from fastapi import FastAPI
+    from API import jobs as jobs_api
+    from API.auth import login_required
+
+    def write_report(params, path):
+        with open(path, "w") as f:
+            f.write("report")
+
+    monkeypatch.setitem(jobs.JOB_KINDS, "mapathon-detail", (MapathonRequestParams, write_report))
+    queue = ThreadJobQueue(str(tmpdir))
+    monkeypatch.setattr(jobs_api, "job_queue", queue)
+    api = FastAPI()
+    api.include_router(jobs_api.router)
+    client = TestClient(api)
+    try:
+        assert client.post("/jobs/mapathon/detail", json=test_param).status_code == 422
+        user = {"id": 1, "username": "mapper", "img_url": None}
+        api.dependency_overrides[login_required] = lambda: user
+        job = client.post("/jobs/mapathon/detail", json=test_param).json()
+        wait_for_job(queue, job["id"])
+        status = client.get(f"/jobs/{job['id']}").json()
+        assert status["status"] == jobs.FINISHED and "owner" not in status
+        download = client.get(status["downloadUrl"])
+        assert download.status_code == 200 and download.text == "report"
+
+        api.dependency_overrides[login_required] = lambda: {"id": 2, "username": "other", "img_url": None}
+        assert client.get(f"/jobs/{job['id']}").status_code == 404
+        assert client.get(f"/jobs/{job['id']}/download").status_code == 404
+        del api.dependency_overrides[login_required]
+        assert client.get(f"/jobs/{job['id']}").status_code == 422
+        assert client.get(f"/jobs/{job['id']}/download").status_code == 422
+    finally:
+        queue.shutdown()
+
+
+def training_catalogue():
+    catalogue = app.TrainingCatalogue()
+    trainings = [Trainings(tid=tid, name=f"training {tid}", organization=organization, eventtype=eventtype,
+                           topictype=topictype, hours=2, date=date(2021, 1, 1) + timedelta(days=day))
+                 for tid, (organization, eventtype, topictype, day) in enumerate([
+                     ("1", "virtual", "remote", 0), ("2", "inperson", "field", 3), ("1", "inperson", "remote", 3),
+                     ("3", "virtual", "other", 10), ("2", "virtual", "field", 31), ("1", "virtual", "other", 45),
+                     (None, None, None, 45)])]
+    catalogue.index([TrainingOrganisations(id=1, name="first")], trainings)
+    catalogue.loaded_at = time.monotonic()
+    return catalogue
+
+def test_training_catalogue_filters():
+    """Catalogue answers every filter combination of TrainingParams as the training query does"""
+    catalogue = training_catalogue()
+
+    def expected(params):
+        return [t.tid for t in catalogue.trainings
+                if (not params.oid or t.organization == str(params.oid))
+                and (not params.topic_type or t.topictype in params.topic_type)
+                and (not params.event_type or t.eventtype == params.event_type)
+                and (params.from_datestamp is None or t.date >= params.from_datestamp)
+                and (params.to_datestamp is None or t.date <= params.to_datestamp)]
+
+    combinations = 0
+    for oid in (None, 1, 2, 4):
+        for topic_type in (None, ["remote"], ["field", "other"]):
+            for event_type in (None, "virtual", "inperson"):
+                for from_datestamp, to_datestamp in ((None, None), ("2021-01-04", None), (None, "2021-01-04"),
+                                                     ("2021-01-04", "2021-02-01"), ("2021-03-01", "2021-03-02")):
+                    filters = dict(oid=oid, topic_type=topic_type, event_type=event_type,
+                                   from_datestamp=from_datestamp, to_datestamp=to_datestamp)
+                    params = TrainingParams(**{k: v for k, v in filters.items() if v is not None})
+                    assert [t.tid for t in catalogue.query(params)] == expected(params), params
+                    combinations += 1
+    assert combinations == 180
+    assert [t.tid for t in catalogue.query(TrainingParams())] == list(range(7))
+    assert [t.tid for t in catalogue.query(TrainingParams(oid=1, from_datestamp="2021-01-04"))] == [2, 5]
+
+def test_training_catalogue_refresh_failure():
+    """A failed reload keeps the previous copy, a failed first load is raised"""
+    catalogue = training_catalogue()
+
+    def failing_load():
+        raise RuntimeError("underpass is down")
+
+    catalogue.load = failing_load
+    catalogue.loaded_at = time.monotonic() - catalogue.refresh_interval - 1
+    assert len(catalogue.query(TrainingParams())) == 7
+    assert catalogue.get_organisations()[0].name == "first"
+
+    empty = app.TrainingCatalogue()
+    empty.load = failing_load
+    with pytest.raises(RuntimeError):
+        empty.query(TrainingParams())
+
+
+class FakeReplicaConnection:
+    def __init__(self, lag):
+        self.lag = lag
+
+    def cursor(self):
+        conn = self
+
+        class Cursor:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+            def execute(self, query):
+                pass
+
+            def fetchone(self):
+                return (conn.lag,)
+        return Cursor()
+
+    def close(self):
+        pass
+
+def test_replica_set(monkeypatch):
+    """Requests read cached replica health, the background checks skip dead and lagging replicas"""
+    lags = {"fast": 0, "slow": 120, "dead": None}
+    checked = []
+
+    def fake_connect(host, connect_timeout):
+        checked.append(host)
+        if lags[host] is None:
+            time.sleep(0.3)
+            raise psycopg2.OperationalError("timeout expired")
+        return FakeReplicaConnection(lags[host])
+
+    monkeypatch.setattr(replicas, "connect", fake_connect)
+    replica_set = replicas.ReplicaSet({"host": "primary"}, [{"host": "dead"}, {"host": "fast"}, {"host": "slow"}],
+                                      max_lag=30, check_interval=0.05)
+    try:
+        started = time.monotonic()
+        names = [e.params["host"] for e in replica_set.candidates()]
+        assert time.monotonic() - started < 0.1
+        assert names == ["dead", "fast", "slow", "primary"]
+
+        deadline = time.monotonic() + 5
+        while checked.count("slow") < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        started = time.monotonic()
+        assert [e.params["host"] for e in replica_set.candidates()] == ["fast", "primary"]
+        assert time.monotonic() - started < 0.1
+        assert replica_set.replicas[2].lag == 120
+
+        lags["dead"] = 0
+        fast = replica_set.replicas[1]
+        replica_set.acquire(fast)
+        deadline = time.monotonic() + 5
+        while not replica_set.replicas[0].healthy and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert [e.params["host"] for e in replica_set.candidates()] == ["dead", "fast", "primary"]
+        replica_set.release(fast)
+    finally:
+        replica_set.stop()
+    assert not replica_set.checker.is_alive()
+    assert "primary" not in checked
+    replica_set.mark_failed(fast)
+    assert fast not in replica_set.candidates()
+
+
+def test_data_quality_tile_failure_not_cached(monkeypatch):
+    """Tile that could not be read closes its connection, is answered with 5xx and is not cached as an empty tile"""
+    closed = []
+    failure = []
+
+    class Cursor:
+        def execute(self, query):
+            if failure:
+                raise failure[0]
+
+        def fetchall(self):
+            return [(None,)]
+
+        def close(self):
+            pass
+
+    class Connection:
+        closed = 0
+
+        def cursor(self, cursor_factory=None):
+            return Cursor()
+
+        def rollback(self):
+            pass
+
+        def close(self):
+            closed.append(True)
+
+    def connect_for_request(params):
+        if failure and isinstance(failure[0], str):
+            raise psycopg2.OperationalError(failure[0])
+        return Connection()
+
+    monkeypatch.setattr(app, "connect_for_request", connect_for_request)
+    monkeypatch.setattr(app.Database, "for_reads", classmethod(lambda cls, section: cls({})))
+    monkeypatch.setattr(app, "generate_data_quality_tile_query", lambda cur, params, z, x, y: "SELECT tile")
+    params = DataQualityTileParams(issueType=["badgeom"], fromTimestamp="2020-12-10T00:00:00",
+                                   toTimestamp="2020-12-11T00:00:00")
+    key = app.cache_key("data-quality-tile", params, 12, 3011, 1716)
+    app.DataQualityTiles.cache.clear()
+
+    def get_tile_route():
+        return data_quality_api.data_quality_tiles(12, 3011, 1716, from_timestamp=params.from_timestamp,
+                                                   to_timestamp=params.to_timestamp,
+                                                   issue_type=params.issue_type, hashtags=None)
+
+    for error, status_code in ((psycopg2.errors.QueryCanceled("canceling statement due to statement timeout"), 504),
+                               (psycopg2.OperationalError("server closed the connection unexpectedly"), 503),
+                               ("could not connect to server", 503)):
+        failure[:] = [error]
+        closed.clear()
+        with pytest.raises(HTTPException) as err:
+            get_tile_route()
+        assert err.value.status_code == status_code
+        assert app.DataQualityTiles.cache.get(key) is None
+        # connection that was opened is closed
+        assert closed == ([] if isinstance(error, str) else [True])
+
+    failure.clear()
+    assert get_tile_route().body == b""
+    assert app.DataQualityTiles.cache.get(key) == b""
+    app.DataQualityTiles.cache.clear()
+
+
+class FakeOutputConnection:
+    """Connection whose server side cursor returns the given rows and records the transaction end"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.closed = 0
+        self.rollbacks = 0
+        self.open_cursors = 0
+
+    def cursor(self, name):
+        conn = self
+
+        class Cursor:
+            description = [("id", 20), ("lat", 701), ("lng", 701)]
+
+            def __enter__(self):
+                conn.open_cursors += 1
+                self.position = 0
+                return self
+
+            def __exit__(self, *exc):
+                conn.open_cursors -= 1
+                return False
+
+            def execute(self, query):
+                pass
+
+            def fetchmany(self, size):
+                rows = conn.rows[self.position:self.position + size]
+                self.position += len(rows)
+                return rows
+        return Cursor()
+
+    def rollback(self):
+        self.rollbacks += 1
+
+def test_iter_query_ends_transaction():
+    """Server side cursor transaction ends when the output is read to the end or the consumer stops early"""
+    rows = [(i, 27.7, 85.3) for i in range(5)]
+    conn = FakeOutputConnection(rows)
+    batches = list(Output.iter_query("SELECT 1", conn, batch_size=2))
+    assert [len(batch[2]) for batch in batches] == [2, 2, 1]
+    assert conn.rollbacks == 1 and conn.open_cursors == 0
+
+    for encode in (lambda batches: Output.iter_geojson_seq(batches, Output.point_feature("lat", "lng")),
+                   lambda batches: Output.iter_columnar(batches, "arrow"),
+                   lambda batches: Output.iter_columnar(batches, "parquet")):
+        conn = FakeOutputConnection(rows)
+        chunks = encode(Output.iter_query("SELECT 1", conn, batch_size=2))
+        next(chunks)
+        assert conn.rollbacks == 0 and conn.open_cursors == 1
+        # client disconnect closes the response generator
+        chunks.close()
+        assert conn.rollbacks == 1 and conn.open_cursors == 0
+
+    conn = FakeOutputConnection(rows)
+    assert len(b"".join(Output.iter_columnar(Output.iter_query("SELECT 1", conn, batch_size=2), "arrow"))) > 0
+    assert conn.rollbacks == 1
+
+
+class ReportRequest:
+    """Request of a report run with run_cancellable, disconnected tells whether its client went away"""
+
+    def __init__(self, disconnected=False):
+        self.disconnected = disconnected
+
+    async def is_disconnected(self):
+        return self.disconnected
+
+def cancellable_mapathon_detail(monkeypatch, executed, sleep=None, timeout=0):
+    """Runs the insight mapathon detail report on the test database through run_cancellable, the history query sleeps when sleep is given and executed queries are appended to executed"""
+    executequery = app.Database.executequery
+
+    def recording_executequery(self, query):
+        executed.append(query)
+        return executequery(self, query)
+
+    monkeypatch.setattr(app.Database, "executequery", recording_executequery)
+    monkeypatch.setattr(app.Database, "for_reads", classmethod(lambda cls, section: cls(db_dict)))
+    monkeypatch.setattr(utils, "get_statement_timeout", lambda endpoint: timeout)
+    if sleep is not None:
+        create_osm_history_query = app.create_osm_history_query
+        monkeypatch.setattr(app, "create_osm_history_query", lambda changeset_query, with_username: (
+            f"SELECT t.* FROM ({create_osm_history_query(changeset_query, with_username)}) AS t, pg_sleep({sleep})"))
+
+    def detailed_report():
+        return app.Mapathon(test_param, "insight").get_detailed_report()
+
+    request = ReportRequest(disconnected=sleep is not None and timeout == 0)
+    return asyncio.run(utils.run_cancellable(request, "mapathon_detail", detailed_report))
+
+def test_mapathon_report_cancellable(monkeypatch):
+    """Mapathon report run with run_cancellable answers the report"""
+    executed = []
+    report = cancellable_mapathon_detail(monkeypatch, executed)
+    assert len(executed) == 2
+    assert len(report.mapped_features) > 0 and len(report.contributors) > 0
+
+def test_mapathon_report_statement_timeout(monkeypatch):
+    """Report query stopped by the statement timeout is answered with 504, the contributors query is not issued"""
+    executed = []
+    with pytest.raises(HTTPException) as err:
+        cancellable_mapathon_detail(monkeypatch, executed, sleep=5, timeout=1)
+    assert err.value.status_code == 504
+    assert "pg_sleep" in executed[-1]
+
+def test_mapathon_report_disconnect(monkeypatch):
+    """Report of a gone client is cancelled on the backend and issues no further query"""
+    executed = []
+    started = time.monotonic()
+    with pytest.raises(HTTPException) as err:
+        cancellable_mapathon_detail(monkeypatch, executed, sleep=60)
+    assert err.value.status_code == 499
+    assert time.monotonic() - started < 30
+    assert "pg_sleep" in executed[-1]
+
+def test_executequery_after_cancel():
+    """Query of a cancelled request is not sent to the database"""
+    sent = []
+
+    class Cursor:
+        def execute(self, query):
+            sent.append(query)
+
+        def fetchall(self):
+            return []
+
+    class Connection:
+        closed = 0
+
+        def rollback(self):
+            pass
+
+    database = app.Database({})
+    database.conn, database.cur = Connection(), Cursor()
+    cancelled = threading.Event()
+
+    def executequery():
+        app.request_cancelled.set(cancelled)
+        database.executequery("SELECT 1")
+        cancelled.set()
+        database.executequery("SELECT 2")
+
+    with pytest.raises(psycopg2.errors.QueryCanceled):
+        contextvars.copy_context().run(executequery)
+    assert sent == ["SELECT 1"]
+
+
+def admission_app(gates, started):
+    """ASGI app sending the first body chunk of every request, then waiting for the gate of its path before finishing, paths ending with fail raise instead"""
+
+    async def app(scope, receive, send):
+        started.append(scope["path"])
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"first", "more_body": True})
+        await gates.setdefault(scope["path"], asyncio.Event()).wait()
+        if scope["path"].endswith("fail"):
+            raise RuntimeError("report failed mid stream")
+        await send({"type": "http.response.body", "body": b"last"})
+
+    return app
+
+async def call_asgi(app, path):
+    """Returns status, headers and body app answered for a GET of path"""
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await app({"type": "http", "method": "GET", "path": path, "query_string": b"", "headers": []}, receive, send)
+    headers = dict(messages[0]["headers"])
+    return messages[0]["status"], headers, b"".join(m.get("body", b"") for m in messages[1:])
+
+async def settle():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+def test_admission_limit_fifo():
+    """Requests of a class above its limit wait and get the freed slots in arrival order, other paths are not limited"""
+    reports = EndpointClass("reports", ["/mapathon"], limit=2, queue_size=5, queue_timeout=5)
+
+    async def run():
+        gates, started = {}, []
+        app = AdmissionControlMiddleware(admission_app(gates, started), [reports])
+        tasks = []
+        for i in range(1, 5):
+            tasks.append(asyncio.ensure_future(call_asgi(app, f"/mapathon/{i}")))
+            await settle()
+        assert started == ["/mapathon/1", "/mapathon/2"]
+        assert reports.active == 2 and reports.metrics()["queueDepth"] == 2
+
+        gates["/countries"] = asyncio.Event()
+        gates["/countries"].set()
+        assert (await call_asgi(app, "/countries"))[0] == 200
+
+        gates["/mapathon/2"].set()
+        await settle()
+        assert started[-1] == "/mapathon/3"
+        gates["/mapathon/1"].set()
+        await settle()
+        assert started[-1] == "/mapathon/4"
+        assert reports.active == 2 and reports.metrics()["queueDepth"] == 0
+        for i in (3, 4):
+            gates[f"/mapathon/{i}"].set()
+        results = await asyncio.gather(*tasks)
+        assert [r[0] for r in results] == [200] * 4 and results[0][2] == b"firstlast"
+
+    asyncio.run(run())
+    metrics = reports.metrics()
+    assert metrics["active"] == 0 and metrics["admitted"] == 4 and metrics["rejected"] == 0
+    assert metrics["maxWait"] > 0
+
+def test_admission_rejections():
+    """Requests finding the queue full, or waiting longer than queue_timeout, get 429 with Retry-After"""
+    reports = EndpointClass("reports", ["/mapathon"], limit=1, queue_size=1, queue_timeout=0.1)
+
+    async def run():
+        gates, started = {}, []
+        app = AdmissionControlMiddleware(admission_app(gates, started), [reports])
+        holder = asyncio.ensure_future(call_asgi(app, "/mapathon/1"))
+        await settle()
+        waiting = asyncio.ensure_future(call_asgi(app, "/mapathon/2"))
+        await settle()
+
+        status, headers, body = await call_asgi(app, "/mapathon/3")
+        assert status == 429 and b"queue is full" in body
+        assert int(headers[b"retry-after"]) >= 1
+
+        status, headers, body = await waiting
+        assert status == 429 and b"timed out" in body
+        assert int(headers[b"retry-after"]) >= 1
+        assert reports.metrics()["queueDepth"] == 0
+
+        gates["/mapathon/1"].set()
+        assert (await holder)[0] == 200
+        assert started == ["/mapathon/1"]
+
+    asyncio.run(run())
+    metrics = reports.metrics()
+    assert metrics["active"] == 0 and metrics["admitted"] == 1
+    assert metrics["rejected"] == 1 and metrics["timedOut"] == 1
+
+def test_admission_release_on_error():
+    """Slot is freed when the app raises after part of a streamed body was sent"""
+    reports = EndpointClass("reports", ["/mapathon"], limit=1, queue_size=1, queue_timeout=5)
+
+    async def run():
+        gates, started = {}, []
+        app = AdmissionControlMiddleware(admission_app(gates, started), [reports])
+        failing = asyncio.ensure_future(call_asgi(app, "/mapathon/fail"))
+        await settle()
+        waiting = asyncio.ensure_future(call_asgi(app, "/mapathon/2"))
+        await settle()
+        gates["/mapathon/fail"].set()
+        with pytest.raises(RuntimeError):
+            await failing
+        await settle()
+        assert started == ["/mapathon/fail", "/mapathon/2"]
+        gates["/mapathon/2"].set()
+        assert (await waiting)[0] == 200
+
+    asyncio.run(run())
+    assert reports.active == 0
+
+def test_admission_cancelled_waiters():
+    """Cancelled waiters leave the queue, a slot handed to a waiter cancelled at the same time is passed on and never lost"""
+    reports = EndpointClass("reports", ["/mapathon"], limit=1, queue_size=5, queue_timeout=5)
+
+    async def run():
+        await reports.acquire()
+        cancelled = asyncio.ensure_future(reports.acquire())
+        await settle()
+        cancelled.cancel()
+        await settle()
+        assert reports.metrics()["queueDepth"] == 0 and reports.active == 1
+
+        # slot goes to the first waiter while it is being cancelled, which of the two lands first depends on the asyncio version
+        for release_first in (True, False):
+            handed_over = asyncio.ensure_future(reports.acquire())
+            next_waiter = asyncio.ensure_future(reports.acquire())
+            await settle()
+            if release_first:
+                reports.release()
+                handed_over.cancel()
+            else:
+                handed_over.cancel()
+                await asyncio.sleep(0)
+                reports.release()
+            outcome = (await asyncio.gather(handed_over, return_exceptions=True))[0]
+            if not isinstance(outcome, asyncio.CancelledError):
+                # the waiter got the slot before the cancel reached it, it is released like a served request
+                reports.release()
+            await next_waiter
+            assert reports.active == 1 and reports.metrics()["queueDepth"] == 0
+        reports.release()
+
+    asyncio.run(run())
+    assert reports.active == 0 and reports.rejected == 0 and reports.timed_out == 0
+
+def test_admission_metrics_route():
+    """/metrics/admission reports the counters of every endpoint class"""
+    reports = EndpointClass("reports", ["/mapathon"], limit=1, queue_size=0, queue_timeout=5)
+    cheap = EndpointClass("cheap", ["/countries"], limit=4, queue_size=4)
+
+    async def run():
+        gates, started = {}, []
+        app = AdmissionControlMiddleware(admission_app(gates, started), [reports, cheap])
+        holder = asyncio.ensure_future(call_asgi(app, "/mapathon/1"))
+        await settle()
+        assert (await call_asgi(app, "/mapathon/2"))[0] == 429
+        gates["/mapathon/1"].set()
+        await holder
+
+    asyncio.run(run())
+    api = FastAPI()
+    api.include_router(metrics.router)
+    api.state.admission_classes = [reports, cheap]
+    response = TestClient(api).get("/metrics/admission")
+    assert response.status_code == 200
+    body = response.json()
+    assert set(body) == {"reports", "cheap"}
+    assert body["reports"]["admitted"] == 1 and body["reports"]["rejected"] == 1
+    assert body["reports"]["active"] == 0 and body["reports"]["queueDepth"] == 0
+    assert body["reports"]["limit"] == 1 and body["cheap"]["admitted"] == 0